@@ -1,203 +1,3805 @@
-from flask import Flask, request, jsonify, render_template_string, send_from_directory
+from flask import Flask, Response, g, has_app_context, request, jsonify, stream_with_context
+from werkzeug.exceptions import HTTPException, RequestedRangeNotSatisfiable
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import wrap_file
+import asyncio
+import atexit
+import base64
+import bisect
+import collections
+import contextlib
+import contextvars
+import csv
+import gzip
+import hashlib
+import heapq
+import hmac
+import http.client
+import io
+import ipaddress
+import itertools
 import json
+import math
 import os
+import random
+import re
+import secrets
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import weakref
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the in-process lock only
+    fcntl = None
+try:
+    import brotli
+except ImportError:  # optional: responses are gzipped only
+    brotli = None
 
 app = Flask(__name__)
+app.logger.setLevel(os.environ.get('LAB_LOG_LEVEL', 'INFO'))
 
 # Configuration file
 CONFIG_FILE = 'lab_config.json'
 ASSIGNMENTS_FILE = 'lab_assignments.json'
+ASSIGNMENTS_JOURNAL = 'lab_assignments.journal'
+ASSIGNMENTS_LOCK = 'lab_assignments.lock'
+
+# How long a worker trusts its cached lab config before checking for edits
+# made by other processes (0 checks on every request)
+CONFIG_CHECK_INTERVAL = float(os.environ.get('LAB_CONFIG_CHECK_INTERVAL', '1'))
+
+# Journal compaction: fold into ASSIGNMENTS_FILE after this many entries or seconds
+COMPACT_EVERY = int(os.environ.get('LAB_COMPACT_EVERY', '100'))
+COMPACT_INTERVAL = float(os.environ.get('LAB_COMPACT_INTERVAL', '30'))
+# Assignment snapshot format: 'json' (the readable lab_assignments.json layout)
+# or 'columnar' (gzipped, emails in one column indexed by user number: several
+# times smaller and faster to load for labs of tens of thousands of seats).
+# Snapshots in either format are read whatever the setting
+SNAPSHOT_FORMAT = os.environ.get('LAB_SNAPSHOT_FORMAT', 'json')
+# fsync every journal write (and SQLite commit) before answering the request;
+# '0' trades durability on power loss for lower write latency
+FSYNC = os.environ.get('LAB_FSYNC', '1') != '0'
+
+# A reset moves the lab's config and assignments into a gzipped JSON archive
+# in this directory (inside each lab's own directory)
+ARCHIVE_DIR = os.environ.get('LAB_ARCHIVE_DIR', 'archives')
+ARCHIVE_NAME = re.compile(r'lab-\d{8}T\d{6}Z(?:-\d+)?\.json\.gz')
+
+# Storage backend: 'json' (files above), 'sqlite' (single WAL-mode database)
+# or 'remote' (a shared allocation authority, see `python app.py authority`)
+STORAGE_BACKEND = os.environ.get('LAB_STORAGE', 'json')
+DB_FILE = os.environ.get('LAB_DB_FILE', 'lab_portal.db')
+AUTHORITY_URL = os.environ.get('LAB_AUTHORITY_URL', 'http://127.0.0.1:8765')
+AUTHORITY_TOKEN = os.environ.get('LAB_AUTHORITY_TOKEN', '')
+
+# Lab instructions PDF; files up to README_CACHE_MAX bytes are served from memory
+README_DIR = os.environ.get('LAB_README_DIR', '/home/cdsw')
+README_NAME = 'lab-readme.pdf'
+README_CACHE_MAX = int(os.environ.get('LAB_README_CACHE_MAX', str(64 * 1024 * 1024)))
+
+# Change events kept in memory for the admin event stream (resume window)
+EVENT_BACKLOG = int(os.environ.get('LAB_EVENT_BACKLOG', '1000'))
+# How often an event stream checks for changes made by other processes
+EVENT_POLL_INTERVAL = float(os.environ.get('LAB_EVENT_POLL_INTERVAL', '1'))
+
+# Further labs live in LABS_DIR/<slug>/ and are served under /lab/<slug>/;
+# a lab unused for LAB_IDLE_TIMEOUT seconds is unloaded until its next request
+LABS_DIR = os.environ.get('LAB_LABS_DIR', 'labs')
+LAB_IDLE_TIMEOUT = float(os.environ.get('LAB_IDLE_TIMEOUT', '900'))
+LAB_SLUG = re.compile(r'[a-z0-9](?:[a-z0-9-]{0,62}[a-z0-9])?')
+
+# Production mode: gunicorn workers/threads per replica (1 worker = Flask dev server)
+WORKERS = int(os.environ.get('LAB_WORKERS', '1'))
+THREADS = int(os.environ.get('LAB_THREADS', '8'))
+# 'wsgi' (Flask dev server / gunicorn threads) or 'asgi' (uvicorn, see asgi_app)
+SERVER = os.environ.get('LAB_SERVER', 'wsgi')
+# With several workers each one writes its metrics to a file in this folder
+# every METRICS_SHARE_INTERVAL seconds, and /metrics adds them all up
+# (default: a new temporary folder each time the server starts)
+METRICS_DIR = os.environ.get('LAB_METRICS_DIR', '')
+METRICS_SHARE_INTERVAL = float(os.environ.get('LAB_METRICS_SHARE_INTERVAL', '1'))
+
+# Reverse proxies in front of the portal; the client IP is taken from X-Forwarded-For
+PROXY_HOPS = int(os.environ.get('LAB_PROXY_HOPS', '0'))
+# Sign-up rate limits: '<requests>/<seconds>' token buckets per client IP and
+# per email domain ('0' disables), tracked for at most RATE_LIMIT_KEYS keys.
+# The per-IP limit is on by default only behind PROXY_HOPS proxies: without
+# them every attendee has the proxy's (or the venue NAT's) address
+RATE_LIMIT_IP = os.environ.get('LAB_RATE_LIMIT_IP', '120/60' if PROXY_HOPS else '0')
+RATE_LIMIT_DOMAIN = os.environ.get('LAB_RATE_LIMIT_DOMAIN', '0')
+RATE_LIMIT_KEYS = int(os.environ.get('LAB_RATE_LIMIT_KEYS', '10000'))
+# Comma-separated email domains allowed to sign up (subdomains included); empty allows all
+ALLOWED_DOMAINS = {domain.strip().lower().lstrip('@')
+                   for domain in os.environ.get('LAB_ALLOWED_DOMAINS', '').split(',')
+                   if domain.strip()}
+
+# Compress HTML, JSON, CSS and JS responses of at least COMPRESS_MIN_SIZE bytes
+# for clients that accept it: brotli when installed, else gzip ('0' disables)
+COMPRESS = os.environ.get('LAB_COMPRESS', '1') != '0'
+COMPRESS_MIN_SIZE = int(os.environ.get('LAB_COMPRESS_MIN_SIZE', '1024'))
+
+# Provisioning: assignment changes pushed to the lab system in the background.
+# The sink is an http(s):// webhook URL, script:<command> (batch as NDJSON on
+# stdin), file:<directory> (one NDJSON file per batch) or fake (kept in
+# memory for testing; fake:<rate> fails that share of deliveries); empty is off
+PROVISION_SINK = os.environ.get('LAB_PROVISION_SINK', '')
+PROVISION_TOKEN = os.environ.get('LAB_PROVISION_TOKEN', '')
+# Batches of up to PROVISION_BATCH entries, collected for up to PROVISION_BATCH_WAIT seconds
+PROVISION_BATCH = int(os.environ.get('LAB_PROVISION_BATCH', '100'))
+PROVISION_BATCH_WAIT = float(os.environ.get('LAB_PROVISION_BATCH_WAIT', '1'))
+PROVISION_QUEUE = int(os.environ.get('LAB_PROVISION_QUEUE', '10000'))
+PROVISION_RETRIES = int(os.environ.get('LAB_PROVISION_RETRIES', '5'))
+PROVISION_TIMEOUT = float(os.environ.get('LAB_PROVISION_TIMEOUT', '30'))
+# Entries the sink never accepted (or that did not fit in the queue), for
+# `python app.py provision-replay`
+PROVISION_DEAD_LETTER = os.environ.get('LAB_PROVISION_DEAD_LETTER', 'provision_failed.ndjson')
+
+DEFAULT_CONFIG = {
+    'max_users': 0,
+    'lab_name': 'Hands-On Lab',
+    'password': '',
+    'url': '',
+    # Release seats not confirmed within this many minutes (0 = never)
+    'seat_expiry_minutes': 0,
+    # Queue attendees for released seats once the lab is full
+    'waitlist': False,
+    # Give every seat its own generated password instead of 'password'
+    'per_seat_passwords': False
+}
+
+# Per-seat passwords are random bytes, base64url-encoded into one string kept
+# with the config ('seat_passwords'); seat n's password is the nth fixed-width slice
+SEAT_PASSWORD_BYTES = 9
+SEAT_PASSWORD_LENGTH = SEAT_PASSWORD_BYTES * 4 // 3
+
+# Latency histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _label_pairs(names, values):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in zip(names, values))
+
+class Counter:
+    """Prometheus counter, one series per combination of label values"""
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._series[values] = self._series.get(values, 0) + amount
+
+    def state(self):
+        """The series as JSON-ready [label values, value] pairs, see merge()"""
+        with self._lock:
+            return [[list(values), value] for values, value in self._series.items()]
+
+    @staticmethod
+    def merge(series, state):
+        """Add a state() (of another process) into series, a {label values: value} dict"""
+        for values, count in state:
+            values = tuple(values)
+            series[values] = series.get(values, 0) + count
+
+    def expose(self, series=None):
+        """Exposition lines for series (default: this process's own)"""
+        if series is None:
+            with self._lock:
+                series = dict(self._series)
+        for values, count in sorted(series.items()):
+            labels = _label_pairs(self.labels, values)
+            yield f'{self.name}{{{labels}}} {count}' if labels else f'{self.name} {count}'
+
+class Histogram(Counter):
+    """Prometheus histogram with fixed buckets; observe() is a bisect and two adds"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, seconds, *values):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += seconds
+
+    @contextlib.contextmanager
+    def time(self, *values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *values)
+
+    def state(self):
+        with self._lock:
+            return [[list(values), [list(counts), total]]
+                    for values, (counts, total) in self._series.items()]
+
+    @staticmethod
+    def merge(series, state):
+        for values, (counts, total) in state:
+            values = tuple(values)
+            if values not in series:
+                series[values] = [[0] * len(counts), 0.0]
+            merged = series[values]
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+
+    def expose(self, series=None):
+        if series is None:
+            with self._lock:
+                series = {values: (list(counts), total)
+                          for values, (counts, total) in self._series.items()}
+        for values, (counts, total) in sorted(series.items()):
+            labels = _label_pairs(self.labels, values)
+            prefix = labels + ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+            suffix = f'{{{labels}}}' if labels else ''
+            yield f'{self.name}_sum{suffix} {total}'
+            yield f'{self.name}_count{suffix} {cumulative}'
+
+class Gauge(Counter):
+    """Prometheus gauge of a per-process value, read when metrics are written (see process_gauges)"""
+    kind = 'gauge'
+
+REQUESTS = Counter('lab_http_requests_total', 'HTTP requests handled',
+                   ('route', 'method', 'status'))
+REQUEST_SECONDS = Histogram('lab_http_request_duration_seconds',
+                            'Time until the response headers were ready', ('route',))
+STORAGE_SECONDS = Histogram('lab_storage_duration_seconds', 'Time spent in storage calls',
+                            ('op',))
+LOCK_WAIT_SECONDS = Histogram('lab_storage_lock_wait_seconds',
+                              'Time spent waiting for the assignment store write lock')
+README_BYTES = Counter('lab_readme_bytes_total', 'Readme PDF bytes served', ('source',))
+SIGNUPS_REJECTED = Counter('lab_signups_rejected_total',
+                           'Sign-up requests rejected before any storage access', ('reason',))
+STORAGE_RECOVERIES = Counter('lab_storage_recoveries_total',
+                             'Damaged journal tails and snapshots set aside at load', ('kind',))
+PROVISION_ENTRIES = Counter('lab_provision_entries_total',
+                            'Assignment changes handled by the provisioning pipeline', ('outcome',))
+PROVISION_SECONDS = Histogram('lab_provision_duration_seconds',
+                              'Time spent delivering a batch to the provisioning sink', ('result',))
+COMPRESSED_BYTES = Counter('lab_compressed_bytes_total',
+                           'Response bytes before and after compression', ('coding', 'stage'))
+LABS_LOADED = Gauge('lab_labs_loaded', 'Labs held in memory, summed over the workers')
+RATE_LIMITED_KEYS = Gauge('lab_rate_limit_keys', 'Keys tracked by the sign-up rate limiters',
+                          ('limiter',))
+PROVISION_QUEUED = Gauge('lab_provision_queue_length',
+                         'Assignment changes waiting for the provisioning sink')
+METRICS = [REQUESTS, REQUEST_SECONDS, STORAGE_SECONDS, LOCK_WAIT_SECONDS, README_BYTES,
+           SIGNUPS_REJECTED, STORAGE_RECOVERIES, PROVISION_ENTRIES, PROVISION_SECONDS,
+           COMPRESSED_BYTES]
+
+class SharedMetrics:
+    """Metrics of all the workers of one server, through a file per worker
+
+    A thread in each worker writes the state() of every metric in METRICS,
+    plus its process gauges (see process_gauges), to <pid>.json every
+    METRICS_SHARE_INTERVAL seconds and when the worker exits. /metrics sums
+    the files, so a scrape sees every worker whichever one answers it. A
+    worker that exits keeps its file, minus its gauges, so the counters of
+    the server never go down while it runs.
+    """
+
+    def __init__(self):
+        self.directory = ''
+
+    def start(self, directory=METRICS_DIR):
+        """Called by the server process before it starts its workers"""
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            for name in os.listdir(directory):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(directory, name))
+        else:
+            directory = tempfile.mkdtemp(prefix='lab-metrics-')
+            atexit.register(self._remove, os.getpid())
+        self.directory = directory
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _remove(self, server_pid):
+        # Workers inherit this atexit hook; only the server removes the folder
+        if os.getpid() == server_pid:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _after_fork(self):
+        atexit.register(self.write)
+        threading.Thread(target=self._run, name='lab-metrics', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(METRICS_SHARE_INTERVAL)
+            self.write()
+
+    def write(self):
+        """Write this worker's metrics to its file"""
+        state = {'metrics': {metric.name: metric.state() for metric in METRICS},
+                 'gauges': process_gauges()}
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    def retire(self, pid):
+        """Drop the gauges of a worker that has exited (its counters stay)"""
+        path = os.path.join(self.directory, f'{pid}.json')
+        with contextlib.suppress(FileNotFoundError, ValueError):
+            with open(path) as f:
+                state = json.load(f)
+            state.pop('gauges', None)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(path + '.tmp', path)
+
+    def collect(self):
+        """({metric name: series}, {gauge name: series}) summed over all workers, or None"""
+        if not self.directory:
+            return None
+        self.write()
+        metrics = {metric.name: {} for metric in METRICS}
+        gauges = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue  # a worker's file is replaced, never half-written; it may be gone
+            for metric in METRICS:
+                metric.merge(metrics[metric.name], state['metrics'].get(metric.name, ()))
+            for gauge, series in state.get('gauges', {}).items():
+                Counter.merge(gauges.setdefault(gauge, {}), series)
+        return metrics, gauges
+
+shared_metrics = SharedMetrics()
+
+def process_gauges():
+    """This process's gauge values, {gauge name: series in the Counter.state() format}"""
+    gauges = {LABS_LOADED.name: [[[], len(labs.loaded())]],
+              RATE_LIMITED_KEYS.name: [[[name], len(limiter)] for name, limiter in
+                                       (('ip', ip_limiter), ('domain', domain_limiter))
+                                       if limiter is not None]}
+    if provisioner is not None:
+        gauges[PROVISION_QUEUED.name] = [[[], len(provisioner)]]
+    return gauges
+
+class TokenBuckets:
+    """Per-key token buckets in a bounded LRU table
+
+    Each key may spend capacity requests at once, refilled at capacity per
+    period seconds. Past max_keys the least recently seen key is evicted; it
+    starts over with a full bucket, so eviction only ever lets requests in.
+    """
+
+    def __init__(self, capacity, period, max_keys=RATE_LIMIT_KEYS):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()  # key -> (tokens, monotonic time)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key):
+        """Spend a token for key; returns 0, or the seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            tokens = self.capacity if bucket is None else min(
+                self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1 if wait == 0 else tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+def _rate_limiter(spec):
+    """TokenBuckets for a '<requests>/<seconds>' spec, or None when disabled"""
+    requests, _, seconds = spec.partition('/')
+    if not int(requests or 0):
+        return None
+    return TokenBuckets(int(requests), float(seconds or 1))
+
+ip_limiter = _rate_limiter(RATE_LIMIT_IP)
+domain_limiter = _rate_limiter(RATE_LIMIT_DOMAIN)
+
+def current_storage():
+    """Storage of the lab the current request is for (the default lab otherwise)"""
+    lab = g.get('lab') if has_app_context() else None
+    return (lab or labs.default).storage
+
+def load_config(at_version=None):
+    """Load lab configuration (at least as new as state version at_version)"""
+    with STORAGE_SECONDS.time('load_config'):
+        return current_storage().load_config(at_version=at_version)
+
+def save_config(config):
+    """Save lab configuration"""
+    with STORAGE_SECONDS.time('save_config'):
+        current_storage().save_config(config)
+
+def load_assignments():
+    """Load user assignments"""
+    with STORAGE_SECONDS.time('load_assignments'):
+        return current_storage().snapshot()
+
+def save_assignments(assignments):
+    """Save user assignments"""
+    with STORAGE_SECONDS.time('save_assignments'):
+        current_storage().replace(assignments['email_to_user'])
+
+class StorageUnavailable(Exception):
+    """The allocation authority could not be reached"""
+
+# Storages reopen locks and connections in forked worker processes
+_open_storages = weakref.WeakSet()
+
+def _reopen_after_fork():
+    for opened in list(_open_storages):
+        opened._after_fork()
+
+os.register_at_fork(after_in_child=_reopen_after_fork)
+
+def normalize_email(email):
+    """Canonical form of an email address used as the assignment key"""
+    return (email or '').lower().strip()
+
+def username_for(user_num):
+    return f"user{str(user_num).zfill(3)}"
+
+def generate_seat_passwords(count, existing=''):
+    """Extend the per-seat password string to cover count seats, keeping existing ones"""
+    missing = count - len(existing) // SEAT_PASSWORD_LENGTH
+    if missing <= 0:
+        return existing
+    return existing + base64.urlsafe_b64encode(
+        secrets.token_bytes(missing * SEAT_PASSWORD_BYTES)).decode()
+
+def seat_password(config, user_num):
+    """The password for a seat: its own in per-seat mode, else the shared one"""
+    if config['per_seat_passwords']:
+        start = (user_num - 1) * SEAT_PASSWORD_LENGTH
+        password = config.get('seat_passwords', '')[start:start + SEAT_PASSWORD_LENGTH]
+        if password:
+            return password
+    return config['password']
+
+def rotate_seat_passwords(config, user_nums):
+    """Return config with new passwords for seats user_nums, or None if it has none to change
+
+    Called as seats are released, so the next holder of a seat never gets
+    the password its previous holder was shown.
+    """
+    passwords = config.get('seat_passwords', '')
+    if not (config['per_seat_passwords'] and passwords and user_nums):
+        return None
+    seats = [passwords[start:start + SEAT_PASSWORD_LENGTH]
+             for start in range(0, len(passwords), SEAT_PASSWORD_LENGTH)]
+    fresh = generate_seat_passwords(len(user_nums))
+    for i, user_num in enumerate(user_nums):
+        if user_num <= len(seats):
+            seats[user_num - 1] = fresh[i * SEAT_PASSWORD_LENGTH:(i + 1) * SEAT_PASSWORD_LENGTH]
+    return dict(config, seat_passwords=''.join(seats))
+
+def public_config(config):
+    """The config as shown on the dashboard, without the per-seat passwords"""
+    return {key: value for key, value in config.items() if key != 'seat_passwords'}
+
+def _with_defaults(config):
+    """Add default values for keys missing from a stored config"""
+    if config is None:
+        return dict(DEFAULT_CONFIG)
+    # Add default values for password and url if they don't exist
+    config.setdefault('password', '')
+    config.setdefault('url', '')
+    config.setdefault('seat_expiry_minutes', 0)
+    config.setdefault('waitlist', False)
+    config.setdefault('per_seat_passwords', False)
+    return config
+
+class ConfigCache:
+    """Storage mixin keeping the parsed lab config in memory
+
+    Backends implement _read_config() and config_version(). The cached
+    config is trusted for CONFIG_CHECK_INTERVAL seconds; after that one
+    config_version() call (a stat() for JSON files) decides whether it has
+    to be read again. Saving or deleting the config in this process drops
+    the cached copy straight away.
+    """
+
+    # (config version, config, monotonic time of the last version check,
+    #  state version it was checked at)
+    _config = None
+
+    def cached_config(self, fresh=False, at_version=None):
+        """Return (config version, config); the config must not be modified
+
+        fresh=True checks the version now instead of trusting the cache. So
+        does at_version, a current_version() value, when the cache was
+        checked at another one: config changes move the state version too,
+        so a response tagged with at_version never carries an older config.
+        """
+        cached = self._config
+        now = time.monotonic()
+        if (cached is not None and not fresh and now - cached[2] < CONFIG_CHECK_INTERVAL
+                and (at_version is None or at_version == cached[3])):
+            return cached[0], cached[1]
+        version = self.config_version()
+        if cached is None or cached[0] != version:
+            # Read after taking the version: a concurrent edit at worst costs one more read
+            cached = (version, self._read_config(), now, at_version)
+        else:
+            cached = (version, cached[1], now, at_version)
+        self._config = cached
+        return cached[0], cached[1]
+
+    def load_config(self, fresh=False, at_version=None):
+        return dict(self.cached_config(fresh, at_version)[1])
+
+    def _config_changed(self):
+        self._config = None
+
+class Archives:
+    """Storage mixin keeping the state of every reset lab as a compressed archive
+
+    Backends implement exchange(), which swaps the config and the whole
+    assignment state in one locked step, so no sign-up lands in the new lab
+    under the old config. The archive is written and fsynced inside that
+    step, before the old state is dropped: if writing it fails, the lab is
+    left as it was.
+    """
+
+    archive_dir = ARCHIVE_DIR
+
+    def archive_and_reset(self):
+        """Move the config and assignments into a new archive
+
+        Returns the archive name, or None if there was nothing to keep.
+        """
+        return self.exchange(keep=self._write_archive)
+
+    def restore_archive(self, name):
+        """Bring back the lab in archive name; the state it replaces is archived first
+
+        Returns {'restored': name, 'archive': name of the new archive or None},
+        or None if there is no such archive.
+        """
+        data = self.read_archive(name)
+        if data is None:
+            return None
+        document = json.loads(gzip.decompress(data))
+        restored_config = document['config'] if document['config']['max_users'] else None
+        archive = self.exchange(document['assignments'], restored_config, self._write_archive)
+        return {'restored': name, 'archive': archive}
+
+    def archives(self):
+        """List the archives, newest first"""
+        try:
+            names = [name for name in os.listdir(self.archive_dir) if ARCHIVE_NAME.fullmatch(name)]
+        except FileNotFoundError:
+            return []
+        archives = []
+        for name in names:
+            st = os.stat(os.path.join(self.archive_dir, name))
+            archives.append({'name': name, 'size': st.st_size, 'mtime': st.st_mtime})
+        archives.sort(key=lambda archive: (archive['mtime'], archive['name']), reverse=True)
+        return [{'name': archive['name'], 'size': archive['size'],
+                 'archived_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(archive['mtime']))}
+                for archive in archives]
+
+    def read_archive(self, name, encoded=False):
+        """Return the gzipped archive name (base64 text if encoded), or None"""
+        if not ARCHIVE_NAME.fullmatch(name):
+            return None
+        try:
+            with open(os.path.join(self.archive_dir, name), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return base64.b64encode(data).decode() if encoded else data
+
+    def _write_archive(self, config, assignments):
+        if not (assignments['email_to_user'] or assignments.get('waitlist') or config['max_users']):
+            return None
+        now = time.gmtime()
+        document = {
+            'archived_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', now),
+            'config': config,
+            'assignments': assignments
+        }
+        data = gzip.compress(json.dumps(document).encode(), compresslevel=6)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.archive.', dir=self.archive_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            # Link the complete file under the first free name; never overwrite an archive
+            stamp = time.strftime('%Y%m%dT%H%M%SZ', now)
+            for n in itertools.count(1):
+                name = f'lab-{stamp}.json.gz' if n == 1 else f'lab-{stamp}-{n}.json.gz'
+                try:
+                    os.link(tmp_path, os.path.join(self.archive_dir, name))
+                    return name
+                except FileExistsError:
+                    continue
+        finally:
+            os.remove(tmp_path)
+
+def _link_over(path, link_path):
+    """Hard-link path as link_path, replacing what was there"""
+    with contextlib.suppress(FileNotFoundError):
+        if os.path.samefile(path, link_path):
+            return
+    tmp_path = f'{link_path}.{os.getpid()}.tmp'
+    try:
+        os.link(path, tmp_path)
+    except FileExistsError:
+        os.remove(tmp_path)
+        os.link(path, tmp_path)
+    os.replace(tmp_path, link_path)
+
+def _file_id(path):
+    """Identify a file version by inode and mtime, or None if missing"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns)
+
+def atomic_write_json(path, data):
+    """Write JSON to a temp file next to path, then rename it into place"""
+    atomic_write(path, json.dumps(data, indent=2).encode())
+
+def atomic_write(path, data):
+    """Write bytes to a temp file next to path, then rename it into place"""
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_dir(path)
+
+def _fsync_dir(path):
+    """Make a new or renamed file in path's directory durable (POSIX only)"""
+    if os.name != 'posix':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _set_aside(path, data=None):
+    """Move a damaged file (or write data) to path.corrupt-<time> for inspection"""
+    aside = f'{path}.corrupt-{time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())}'
+    if data is None:
+        os.replace(path, aside)
+    else:
+        with open(aside, 'ab') as f:
+            f.write(data)
+    return aside
+
+def _read_snapshot(path):
+    """Parse an assignments snapshot ({} if missing); ValueError if it is damaged
+
+    Columnar snapshots (gzipped) come back in the lab_assignments.json layout.
+    """
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return {}
+    if raw[:2] == b'\x1f\x8b':
+        try:
+            raw = gzip.decompress(raw)
+        except (OSError, EOFError, zlib.error) as e:
+            raise ValueError(f'bad gzip data: {e}')
+    data = json.loads(raw)
+    if isinstance(data, dict) and data.get('format') == 'columnar':
+        try:
+            emails = data['emails']
+            data = dict(data, email_to_user={email: n for n, email in enumerate(emails, 1)
+                                             if email is not None},
+                        unconfirmed={emails[n - 1]: at for n, at in data.get('unconfirmed', ())})
+        except (KeyError, IndexError, TypeError) as e:
+            raise ValueError(f'bad columnar snapshot: {e!r}')
+    if not isinstance(data, dict) or not isinstance(data.get('email_to_user', {}), dict):
+        raise ValueError('not an assignments snapshot')
+    return data
+
+def _encode_entry(entry):
+    """One journal line: CRC-32 of the JSON entry in hex, a space, the entry"""
+    payload = json.dumps(entry, separators=(',', ':'))
+    return f'{zlib.crc32(payload.encode()):08x} {payload}\n'
+
+def _decode_entry(line):
+    """Parse a journal line; None if it is cut short or fails its checksum"""
+    if not line.endswith(b'\n'):
+        return None
+    if line.startswith(b'{'):
+        payload = line  # written before journal lines carried a checksum
+    else:
+        checksum, _, payload = line[:-1].partition(b' ')
+        try:
+            if int(checksum, 16) != zlib.crc32(payload):
+                return None
+        except ValueError:
+            return None
+    try:
+        entry = json.loads(payload)
+    except ValueError:
+        return None
+    return entry if isinstance(entry, dict) and 'op' in entry else None
+
+class AssignmentStore:
+    """Resident assignment state, persisted through an append-only journal
+
+    The snapshot in ASSIGNMENTS_FILE keeps its original JSON format unless
+    LAB_SNAPSHOT_FORMAT=columnar. Every
+    new assignment is appended to the journal as one checksummed JSON line
+    (fsynced before the caller sees it, see LAB_FSYNC) and the journal is
+    periodically folded back into the snapshot (compaction). Entries carry
+    the version they produce, so replaying one twice is harmless.
+
+    Compaction keeps the replaced snapshot and the folded journal as
+    <file>.prev: a damaged snapshot is rebuilt from them plus the current
+    journal. A damaged or torn journal tail is moved aside and cut off.
+
+    Writes are serialized by a thread lock plus an flock on lock_path, so
+    several worker processes can share the same files. Each process catches
+    up on the others' journal entries when it takes the lock.
+
+    Free user numbers are tracked as a high-water mark plus a min-heap of
+    numbers below it that are not in use, so the lowest free number is
+    found in O(log n). Numbers are removed from the heap lazily: a number
+    that turns out to be assigned is discarded when it reaches the top.
+    The email holding each number is kept in a list indexed by user number
+    (None where the number is free), which serves listings in user order
+    without a second dict or sorted index; a sorted index by email serves
+    prefix searches. All of them share the email string objects of
+    email_to_user.
+
+    Every journal entry (including config changes) bumps a persisted
+    version number; the most recent entries are kept as change events for
+    the admin event stream.
+
+    Seats taken through allocate() stay unconfirmed until confirm(), in
+    assignment order, so expire() only looks at the oldest ones. Emails
+    waiting for a seat are kept in arrival order; every change that frees a
+    seat hands it to the head of the waitlist before anyone new gets one.
+    """
+
+    def __init__(self, path, journal_path, lock_path):
+        self.path = path
+        self.journal_path = journal_path
+        self.lock_path = lock_path
+        self.email_to_user = {}
+        self._emails = []  # user number - 1 -> email, None if free
+        self.free_users = []
+        self.unconfirmed = collections.OrderedDict()  # email -> assignment time
+        self.waiting = collections.OrderedDict()  # email -> arrival number, in arrival order
+        self._arrivals = 0
+        # Arrival numbers left behind the head of the waitlist, sorted (see _position)
+        self._skipped = []
+        self._by_email = []
+        self.high_water = 0
+        self.version = 0
+        self.events = collections.deque(maxlen=EVENT_BACKLOG)
+        self._changed = threading.Condition()
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._journal = None
+        self._journal_pos = 0
+        self._snapshot_id = None
+        self._journal_id = None
+        self._pending = 0
+        self._last_compact = time.monotonic()
+        self.refresh()
+        _open_storages.add(self)
+
+    def _after_fork(self):
+        # The lock file description is shared with the parent, so flock on it
+        # would not exclude the parent; open a fresh one on next use
+        self._lock = threading.Lock()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self._close_journal()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the store lock across threads and processes"""
+        started = time.perf_counter()
+        with self._lock:
+            if fcntl is None:
+                LOCK_WAIT_SECONDS.observe(time.perf_counter() - started)
+                self._sync()
+                yield
+                return
+            if self._lock_file is None:
+                self._lock_file = open(self.lock_path, 'a')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            LOCK_WAIT_SECONDS.observe(time.perf_counter() - started)
+            try:
+                self._sync()
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def load(self):
+        """Load the snapshot and replay the journal over it
+
+        A snapshot that does not parse is set aside and the state rebuilt
+        from the previous snapshot and journal plus the current journal,
+        then written out as a new snapshot. Call with the store lock held.
+        """
+        self._close_journal()
+        recovering = False
+        try:
+            data = _read_snapshot(self.path)
+        except ValueError as e:
+            aside = _set_aside(self.path)
+            STORAGE_RECOVERIES.inc('snapshot')
+            app.logger.error('Assignments snapshot is damaged (%s), moved to %s; '
+                             'rebuilding from %s.prev', e, aside, self.path)
+            recovering = True
+            try:
+                data = _read_snapshot(self.path + '.prev')
+            except ValueError as e:
+                app.logger.error('Previous snapshot is damaged too (%s); replaying journals only', e)
+                data = {}
+        self._snapshot_id = _file_id(self.path)
+        self._set_state(data.get('email_to_user', {}), data.get('high_water', 0),
+                        data.get('free_users'), data.get('unconfirmed'), data.get('waitlist', ()))
+        self.version = data.get('version', 0)
+        self.events.clear()
+        self._pending = 0
+        self._journal_pos = 0
+        self._journal_id = None
+        if recovering:
+            self._replay_file(self.journal_path + '.prev')
+        self._read_journal()
+        if recovering:
+            self._pending = max(self._pending, 1)
+            self._compact()
+            app.logger.warning('Recovered %d assignments at version %d',
+                               len(self.email_to_user), self.version)
+
+    def _set_state(self, email_to_user, high_water=0, free_users=None, unconfirmed=None,
+                   waitlist=()):
+        """Install assignments and the waitlist, and rebuild the free-number heap"""
+        self.email_to_user = dict(email_to_user)
+        self.high_water = max(high_water, max(self.email_to_user.values(), default=0))
+        self._emails = [None] * self.high_water
+        for email, n in self.email_to_user.items():
+            self._emails[n - 1] = email
+        self._by_email = sorted(self.email_to_user)
+        if free_users is None:
+            # Files written before the heap was persisted: every gap is free
+            free_users = range(1, self.high_water + 1)
+        self.free_users = sorted(n for n in free_users
+                                 if 0 < n <= self.high_water and self._emails[n - 1] is None)
+        # Keyed by the email objects already held in _emails rather than copies
+        self.unconfirmed = collections.OrderedDict(sorted(
+            ((self._emails[self.email_to_user[email] - 1], at)
+             for email, at in (unconfirmed or {}).items()
+             if email in self.email_to_user), key=lambda item: item[1]))
+        self.waiting = collections.OrderedDict(
+            (email, n) for n, email in enumerate(
+                (email for email in waitlist if email not in self.email_to_user), 1))
+        self._arrivals = len(self.waiting)
+        self._skipped = []
+
+    def _read_journal(self):
+        """Apply journal entries written since the last read
+
+        Under the store lock no other writer is mid-entry, so a line that is
+        cut short or fails its checksum is the tail of a write interrupted by
+        a crash: it is set aside with everything after it and the journal is
+        truncated to the last good entry, where the next append continues.
+        """
+        try:
+            f = open(self.journal_path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            self._journal_id = os.fstat(f.fileno()).st_ino
+            f.seek(self._journal_pos)
+            for line in f:
+                entry = _decode_entry(line)
+                if entry is None:
+                    if fcntl is None and not line.endswith(b'\n'):
+                        break  # no flock: another process may still be writing it
+                    f.seek(self._journal_pos)
+                    aside = _set_aside(self.journal_path, f.read())
+                    os.truncate(self.journal_path, self._journal_pos)
+                    STORAGE_RECOVERIES.inc('journal')
+                    app.logger.error('Damaged journal entry at byte %d of %s; cut off and moved '
+                                     'to %s', self._journal_pos, self.journal_path, aside)
+                    break
+                self._replay(entry)
+                self._pending += 1
+                self._journal_pos += len(line)
+
+    def _replay_file(self, path):
+        """Apply the entries of an old journal, up to its first damaged line"""
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                entry = _decode_entry(line)
+                if entry is None:
+                    break
+                self._replay(entry)
+
+    def _replay(self, entry):
+        """Apply a journal entry unless the state already includes it"""
+        if 'v' in entry:
+            if entry['v'] <= self.version:
+                return
+            if entry['v'] > self.version + 1:
+                app.logger.warning('Journal skips from version %d to %d', self.version, entry['v'])
+            self.version = entry['v'] - 1
+        self._apply(entry)
+
+    def _sync(self):
+        """Catch up with writes made by other processes"""
+        if _file_id(self.path) != self._snapshot_id:
+            self.load()
+            return
+        try:
+            st = os.stat(self.journal_path)
+        except FileNotFoundError:
+            if self._journal_id is not None:
+                self.load()
+            return
+        if self._journal_id is not None and st.st_ino != self._journal_id:
+            self.load()
+        elif st.st_size > self._journal_pos:
+            self._read_journal()
+
+    def _apply(self, entry):
+        entry.setdefault('v', self.version + 1)
+        event = {'op': entry['op']}
+        if entry['op'] == 'assign':
+            email = entry['email']
+            user_num = entry['user']
+            holder = self._holder(user_num)
+            if email in self.email_to_user or holder is not None:
+                # Only a journal replayed over the wrong snapshot gets here;
+                # applying it would hand one number to two emails
+                app.logger.error('Skipping journal entry v%s: %s cannot take user %d (held by %s)',
+                                 entry['v'], email, user_num, holder or email)
+                self.version = entry['v']
+                return
+            self.email_to_user[email] = user_num
+            bisect.insort(self._by_email, email)
+            event.update(email=email, user_number=user_num)
+            if user_num > self.high_water:
+                for gap in range(self.high_water + 1, user_num):
+                    heapq.heappush(self.free_users, gap)
+                self._emails.extend([None] * (user_num - self.high_water))
+                self.high_water = user_num
+            elif self.free_users and self.free_users[0] == user_num:
+                heapq.heappop(self.free_users)
+            self._emails[user_num - 1] = email
+            self._leave_waitlist(email)
+            # Entries without a time (bulk registration, older journals) need no confirmation
+            if 'at' in entry:
+                self.unconfirmed[email] = entry['at']
+        elif entry['op'] == 'release':
+            email = entry['email']
+            user_num = self.email_to_user.pop(email, None)
+            if user_num is not None:
+                self._emails[user_num - 1] = None
+                del self._by_email[bisect.bisect_left(self._by_email, email)]
+                heapq.heappush(self.free_users, user_num)
+            self.unconfirmed.pop(email, None)
+            self._leave_waitlist(email)
+            event.update(email=email, user_number=user_num)
+        elif entry['op'] == 'confirm':
+            self.unconfirmed.pop(entry['email'], None)
+            event.update(email=entry['email'])
+        elif entry['op'] == 'wait':
+            if entry['email'] not in self.waiting:
+                self._arrivals += 1
+                self.waiting[entry['email']] = self._arrivals
+            event.update(email=entry['email'])
+        elif entry['op'] == 'reset':
+            self._set_state({})
+        self._record(event)
+
+    def _record(self, event):
+        """Bump the version and keep event for the event stream"""
+        self.version += 1
+        event['id'] = self.version
+        self.events.append(event)
+        with self._changed:
+            self._changed.notify_all()
+
+    def changes(self, after):
+        """Return (version, events) for the changes made after version after
+
+        events is None when they are no longer held in memory (or after is
+        from an older state); the caller then has to reload everything.
+        """
+        with self.locked():
+            if after == self.version:
+                return self.version, []
+            if after > self.version or not self.events or self.events[0]['id'] > after + 1:
+                return self.version, None
+            start = after + 1 - self.events[0]['id']
+            return self.version, list(itertools.islice(self.events, start, None))
+
+    def wait(self, timeout):
+        """Sleep until this process records a change, or timeout"""
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def _holder(self, user_num):
+        """The email holding user_num, or None"""
+        return self._emails[user_num - 1] if 0 < user_num <= len(self._emails) else None
+
+    def _next_free(self):
+        """Return the lowest unassigned user number"""
+        while self.free_users and self._holder(self.free_users[0]) is not None:
+            heapq.heappop(self.free_users)
+        if self.free_users:
+            return self.free_users[0]
+        return self.high_water + 1
+
+    def _append(self, *entries):
+        """Write entries to the journal with a single flush (and fsync)"""
+        if self._journal is None:
+            created = not os.path.exists(self.journal_path)
+            self._journal = open(self.journal_path, 'a')
+            self._journal_id = os.fstat(self._journal.fileno()).st_ino
+            if created and FSYNC:
+                _fsync_dir(self.journal_path)
+        for offset, entry in enumerate(entries, 1):
+            entry.setdefault('v', self.version + offset)  # entries not applied yet
+        self._journal.write(''.join(map(_encode_entry, entries)))
+        self._journal.flush()
+        if FSYNC:
+            os.fsync(self._journal.fileno())
+        self._journal_pos = self._journal.tell()
+        self._pending += len(entries)
+
+    def _maybe_compact(self):
+        # Rewriting the snapshot costs O(assignments): waiting for at least
+        # half as many new entries keeps the cost per entry constant
+        if (self._pending >= max(COMPACT_EVERY, len(self.email_to_user) // 2)
+                or time.monotonic() - self._last_compact >= COMPACT_INTERVAL):
+            self._compact()
+
+    def lookup(self, email):
+        """Return the user number assigned to email, or None
+
+        Lock-free. Seats can be released and handed on, so a hit is only
+        trusted once a stat() shows no other process changed the files.
+        """
+        user_num = self.email_to_user.get(email)
+        if user_num is not None and self._changed_on_disk():
+            self.refresh()
+            user_num = self.email_to_user.get(email)
+        return user_num
+
+    def count(self):
+        return len(self.email_to_user)
+
+    def refresh(self):
+        """Pick up assignments made by other processes"""
+        with self.locked():
+            pass
+
+    def current_version(self):
+        """Return the state version, syncing only if the files changed on disk"""
+        if self._changed_on_disk():
+            self.refresh()
+        return self.version
+
+    def _changed_on_disk(self):
+        if _file_id(self.path) != self._snapshot_id:
+            return True
+        try:
+            st = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return self._journal_id is not None
+        return st.st_ino != self._journal_id or st.st_size != self._journal_pos
+
+    def allocate(self, email, max_users):
+        """Assign the next free user number to email
+
+        Returns (user_num, created, promoted). user_num is None when all
+        max_users slots are taken. promoted lists the waitlisted emails
+        (email, user_number) that were given a free seat first, email
+        possibly among them.
+        """
+        with self.locked():
+            user_num = self.email_to_user.get(email)
+            if user_num is not None:
+                return user_num, False, []
+            # Free seats belong to the waitlist first
+            promoted = self._promote(max_users)
+            user_num = self.email_to_user.get(email)
+            if user_num is not None:
+                return user_num, False, promoted
+            if len(self.email_to_user) >= max_users:
+                return None, False, promoted
+
+            next_user = self._next_free()
+            entry = {'op': 'assign', 'email': email, 'user': next_user, 'at': time.time()}
+            self._append(entry)
+            self._apply(entry)
+            self._maybe_compact()
+            return next_user, True, promoted
+
+    def allocate_many(self, emails, max_users):
+        """Allocate a batch of emails under one lock and one journal flush
+
+        Returns (results, promoted): a (user_num, created) pair per email,
+        and the waitlisted emails given a seat first, as allocate() does.
+        Pre-registered seats need no confirmation.
+        """
+        with self.locked():
+            promoted = self._promote(max_users)
+            results = []
+            entries = []
+            planned = {}
+            free = self._free_ahead(max_users - len(self.email_to_user))
+            for email in emails:
+                user_num = self.email_to_user.get(email) or planned.get(email)
+                if user_num is not None:
+                    results.append((user_num, False))
+                elif not free:
+                    results.append((None, False))
+                else:
+                    planned[email] = free.pop(0)
+                    entries.append({'op': 'assign', 'email': email, 'user': planned[email]})
+                    results.append((planned[email], True))
+            if entries:
+                self._commit(entries)
+                self._maybe_compact()
+            return results, promoted
+
+    def release(self, email):
+        """Free the user number held by email; returns it, or None"""
+        with self.locked():
+            user_num = self.email_to_user.get(email)
+            if user_num is None:
+                return None
+            entry = {'op': 'release', 'email': email}
+            self._append(entry)
+            self._apply(entry)
+            self._renew_passwords([user_num])
+            return user_num
+
+    def release_many(self, emails, max_users):
+        """Free the seats held by emails (and drop them from the waitlist)
+
+        Returns (released, promoted), lists of (email, user_number): the
+        freed seats and the waitlisted emails that were given one.
+        """
+        with self.locked():
+            released = self._release(emails)
+            promoted = self._promote(max_users)
+            self._maybe_compact()
+            return released, promoted
+
+    def expire(self, before, max_users):
+        """Release the seats left unconfirmed since before (a time.time() value)
+
+        Returns (released, promoted) as release_many() does.
+        """
+        with self.locked():
+            emails = [email for email, _ in itertools.takewhile(
+                lambda item: item[1] < before, self.unconfirmed.items())]
+            released = self._release(emails)
+            promoted = self._promote(max_users)
+            self._maybe_compact()
+            return released, promoted
+
+    def _release(self, emails):
+        released = []
+        entries = []
+        for email in dict.fromkeys(emails):
+            if email not in self.email_to_user and email not in self.waiting:
+                continue
+            user_num = self.email_to_user.get(email)
+            entries.append({'op': 'release', 'email': email})
+            if user_num is not None:
+                released.append((email, user_num))
+        self._commit(entries)
+        self._renew_passwords([user_num for _, user_num in released])
+        return released
+
+    def _renew_passwords(self, user_nums):
+        """Give released seats new per-seat passwords; call with the store lock held"""
+        if not user_nums:
+            return
+        config = rotate_seat_passwords(self._read_config(), user_nums)
+        if config is not None:
+            self._write_config(config)
+            self._config_changed()
+
+    def promote(self, max_users):
+        """Give free seats to the head of the waitlist; returns the (email, user_number) pairs"""
+        with self.locked():
+            promoted = self._promote(max_users)
+            self._maybe_compact()
+            return promoted
+
+    def _promote(self, max_users):
+        if not self.waiting:
+            return []
+        now = time.time()
+        free = self._free_ahead(max_users - len(self.email_to_user))
+        promoted = list(zip(self.waiting, free))
+        self._commit([{'op': 'assign', 'email': email, 'user': user_num, 'at': now}
+                      for email, user_num in promoted])
+        return promoted
+
+    def _free_ahead(self, count):
+        """The count lowest unassigned user numbers, without taking them"""
+        if count <= 0:
+            return []
+        numbers = self._free_numbers()[:count]
+        start = self.high_water + 1
+        return numbers + list(range(start, start + count - len(numbers)))
+
+    def _commit(self, entries):
+        """Journal entries, then apply them: a failed write leaves the state as it was"""
+        if entries:
+            self._append(*entries)
+            for entry in entries:
+                self._apply(entry)
+
+    def join_waitlist(self, email):
+        """Queue email for the next free seat; returns its position (0 if it has a seat)"""
+        with self.locked():
+            if email in self.email_to_user:
+                return 0
+            if email not in self.waiting:
+                entry = {'op': 'wait', 'email': email}
+                self._append(entry)
+                self._apply(entry)
+            return self._position(email)
+
+    def waitlist_position(self, email):
+        """Return the 1-based waitlist position of email, or None"""
+        with self.locked():
+            return self._position(email) if email in self.waiting else None
+
+    def _position(self, email):
+        # Arrival numbers count up without gaps, so the position is the
+        # distance from the head less the emails that left in between
+        arrival = self.waiting[email]
+        head = next(iter(self.waiting.values()))
+        return arrival - head + 1 - bisect.bisect_left(self._skipped, arrival)
+
+    def _leave_waitlist(self, email):
+        arrival = self.waiting.pop(email, None)
+        if arrival is None:
+            return
+        if not self.waiting:
+            self._skipped.clear()
+            return
+        head = next(iter(self.waiting.values()))
+        if arrival > head:
+            bisect.insort(self._skipped, arrival)
+        else:
+            # The head moved on: gaps behind it no longer count
+            del self._skipped[:bisect.bisect_left(self._skipped, head)]
+
+    def waitlist(self):
+        """Return the waitlisted emails, first in line first"""
+        with self.locked():
+            return list(self.waiting)
+
+    def waitlist_length(self):
+        return len(self.waiting)
+
+    def confirm(self, email):
+        """Confirm the seat held by email so it never expires; False if it has none"""
+        if (email in self.email_to_user and email not in self.unconfirmed
+                and not self._changed_on_disk()):
+            return True
+        with self.locked():
+            if email not in self.email_to_user:
+                return False
+            if email in self.unconfirmed:
+                entry = {'op': 'confirm', 'email': email}
+                self._append(entry)
+                self._apply(entry)
+            return True
+
+    def page(self, after=0, limit=None, email_prefix=None, user_number=None):
+        """Return (email, user_number) pairs ordered by user number
+
+        Only numbers greater than after (the pagination cursor) are returned,
+        optionally restricted to one user number or to an email prefix.
+        """
+        with self.locked():
+            if user_number is not None:
+                email = self._holder(user_number)
+                rows = [(email, user_number)] if email and user_number > after else []
+            elif email_prefix:
+                lo = bisect.bisect_left(self._by_email, email_prefix)
+                hi = bisect.bisect_left(self._by_email, email_prefix + '\uffff')
+                rows = sorted(((email, self.email_to_user[email]) for email in self._by_email[lo:hi]
+                               if self.email_to_user[email] > after), key=lambda row: row[1])
+            else:
+                start = max(after, 0)
+                rows = []
+                for n, email in enumerate(itertools.islice(self._emails, start, None), start + 1):
+                    if email is not None:
+                        rows.append((email, n))
+                        if len(rows) == limit:
+                            break
+            return rows if limit is None else rows[:limit]
+
+    def snapshot(self):
+        """Return the assignments in the lab_assignments.json format"""
+        with self.locked():
+            return self._snapshot()
+
+    def _snapshot(self):
+        return {
+            'email_to_user': dict(self.email_to_user),
+            'assigned_users': [n for n, email in enumerate(self._emails, 1) if email is not None],
+            'high_water': self.high_water,
+            'free_users': self._free_numbers(),
+            'unconfirmed': dict(self.unconfirmed),
+            'waitlist': list(self.waiting),
+            'version': self.version
+        }
+
+    def _free_numbers(self):
+        return sorted(n for n in set(self.free_users) if self._holder(n) is None)
+
+    def _write_snapshot(self):
+        if SNAPSHOT_FORMAT != 'columnar':
+            atomic_write_json(self.path, self._snapshot())
+            return
+        # Seats as one email column (index = user number - 1) and unconfirmed
+        # seats by number, so no email is written twice; see _read_snapshot
+        columns = {
+            'format': 'columnar',
+            'emails': self._emails,
+            'high_water': self.high_water,
+            'free_users': self._free_numbers(),
+            'unconfirmed': [[self.email_to_user[email], at] for email, at in self.unconfirmed.items()],
+            'waitlist': list(self.waiting),
+            'version': self.version
+        }
+        atomic_write(self.path, gzip.compress(
+            json.dumps(columns, separators=(',', ':')).encode(), compresslevel=1))
+
+    def compact(self):
+        """Fold the journal into the JSON snapshot"""
+        with self.locked():
+            self._compact()
+
+    def _compact(self):
+        self._last_compact = time.monotonic()
+        if self._pending == 0:
+            return
+        previous = self.path + '.prev'
+        journal_previous = self.journal_path + '.prev'
+        self._close_journal()
+        if self._snapshot_id is None:
+            # First snapshot (or one rebuilt by load): it starts the recovery chain
+            self._write_snapshot()
+            _link_over(self.path, previous)
+            for path in (journal_previous, self.journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        else:
+            # The replaced snapshot plus the journal folded into the new one
+            # rebuild the new one should it ever be damaged
+            _link_over(self.path, previous)
+            self._write_snapshot()
+            if os.path.exists(self.journal_path):
+                os.replace(self.journal_path, journal_previous)
+            elif os.path.exists(journal_previous):
+                os.remove(journal_previous)
+        self._snapshot_id = _file_id(self.path)
+        self._journal_id = None
+        self._journal_pos = 0
+        self._pending = 0
+
+    def replace(self, email_to_user, high_water=0, free_users=None, unconfirmed=None,
+                waitlist=()):
+        """Replace all assignments and persist them immediately"""
+        with self.locked():
+            self._set_state(email_to_user, high_water, free_users, unconfirmed, waitlist)
+            self._restart_chain()
+
+    def _restart_chain(self):
+        """Persist a state swapped in without a journal entry
+
+        The old snapshot and journal cannot rebuild it, so the new snapshot
+        starts the recovery chain, as a first one does.
+        """
+        self._record({'op': 'reset'})
+        self._pending = 1
+        self._snapshot_id = None
+        self._compact()
+
+    def exchange(self, data=None, config=None, keep=None):
+        """Replace all assignments by a snapshot() (or nothing) and the config (None deletes it)
+
+        Both change in one locked step, through the backend's _read_config()
+        and _write_config(). keep(previous config, previous snapshot()) runs
+        first, under the lock; if it raises, nothing is replaced. Returns
+        what keep returned.
+        """
+        data = data or {}
+        with self.locked():
+            previous_config = self._read_config()
+            previous = self._snapshot()
+            kept = keep(previous_config, previous) if keep else None
+            self._write_config(config)
+            self._set_state(data.get('email_to_user', {}), data.get('high_water', 0),
+                            data.get('free_users'), data.get('unconfirmed'), data.get('waitlist', ()))
+            self._restart_chain()
+        self._config_changed()
+        return kept
+
+    def reset(self):
+        """Drop all assignments, keeping the version sequence"""
+        with self.locked():
+            entry = {'op': 'reset'}
+            self._append(entry)
+            self._apply(entry)
+            self._compact()
+
+    def _record_config_change(self):
+        entry = {'op': 'config'}
+        self._append(entry)
+        self._apply(entry)
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def close(self):
+        """Compact and release file handles (they are reopened if used again)"""
+        self.compact()
+        with self._lock:
+            self._close_journal()
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+class JsonStorage(ConfigCache, Archives, AssignmentStore):
+    """Storage backend on lab_config.json plus the journaled assignment store"""
+
+    def __init__(self, config_path, path, journal_path, lock_path):
+        self.config_path = config_path
+        self.archive_dir = os.path.join(os.path.dirname(config_path), ARCHIVE_DIR)
+        super().__init__(path, journal_path, lock_path)
+
+    def _read_config(self):
+        if not os.path.exists(self.config_path):
+            return _with_defaults(None)
+        with open(self.config_path, 'r') as f:
+            return _with_defaults(json.load(f))
+
+    def save_config(self, config):
+        with self.locked():
+            self._write_config(config)
+        self._config_changed()
+
+    def delete_config(self):
+        with self.locked():
+            self._write_config(None)
+        self._config_changed()
+
+    def _write_config(self, config):
+        """Write config, or remove it if None; call with the store lock held"""
+        if config is not None:
+            atomic_write_json(self.config_path, config)
+        elif os.path.exists(self.config_path):
+            os.remove(self.config_path)
+        self._record_config_change()
+
+    def config_version(self):
+        """Token that changes whenever the config file is replaced or removed"""
+        return _file_id(self.config_path)
+
+class SqliteStorage(ConfigCache, Archives):
+    """Storage backend on a single SQLite database in WAL mode
+
+    Unique indexes on email and user number back the allocation invariants,
+    and each allocation is one IMMEDIATE transaction, so any number of
+    threads and worker processes can share the database file. Released
+    numbers wait in free_users; the lowest one is reused first. Every change
+    is also logged in events, whose ids are the version numbers.
+    Unconfirmed seats carry the time they were taken in unconfirmed_since,
+    and the waitlist is served in id order.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS config (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS assignments (
+            email TEXT NOT NULL,
+            user_number INTEGER NOT NULL,
+            unconfirmed_since REAL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS assignments_email ON assignments (email);
+        CREATE UNIQUE INDEX IF NOT EXISTS assignments_user ON assignments (user_number);
+        CREATE INDEX IF NOT EXISTS assignments_unconfirmed ON assignments (unconfirmed_since)
+            WHERE unconfirmed_since IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS waitlist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS free_users (
+            user_number INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL,
+            email TEXT,
+            user_number INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS events_op ON events (op, id);
+    '''
+
+    def __init__(self, path, json_dir=''):
+        self.path = path
+        self.archive_dir = os.path.join(json_dir, ARCHIVE_DIR)
+        self._local = threading.local()
+        created = not os.path.exists(path)
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        # Databases from before seat expiry lack the unconfirmed_since column
+        columns = {row[1] for row in db.execute('PRAGMA table_info(assignments)')}
+        if columns and 'unconfirmed_since' not in columns:
+            db.execute('ALTER TABLE assignments ADD COLUMN unconfirmed_since REAL')
+        db.executescript(self.SCHEMA)
+        if created:
+            migrate_json_to_sqlite(self, *_json_files(json_dir))
+        _open_storages.add(self)
+
+    def _after_fork(self):
+        # SQLite connections must not be used across fork
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA synchronous=FULL' if FSYNC else 'PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run a write transaction, holding the database write lock throughout"""
+        db = self._db()
+        with LOCK_WAIT_SECONDS.time():
+            db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _read_config(self):
+        rows = self._db().execute('SELECT key, value FROM config').fetchall()
+        if not rows:
+            return _with_defaults(None)
+        return _with_defaults({key: json.loads(value) for key, value in rows})
+
+    def save_config(self, config):
+        with self.transaction() as db:
+            self._write_config(db, config)
+        self._config_changed()
+
+    def delete_config(self):
+        with self.transaction() as db:
+            self._write_config(db, None)
+        self._config_changed()
+
+    def _write_config(self, db, config):
+        db.execute('DELETE FROM config')
+        if config is not None:
+            db.executemany('INSERT INTO config (key, value) VALUES (?, ?)',
+                           [(key, json.dumps(value)) for key, value in config.items()])
+        self._log(db, 'config')
+
+    def config_version(self):
+        """Id of the latest config change event"""
+        return self._db().execute(
+            "SELECT MAX(id) FROM events WHERE op = 'config'").fetchone()[0] or 0
+
+    def _log(self, db, op, email=None, user_number=None):
+        """Record a change event, pruning events beyond EVENT_BACKLOG"""
+        event_id = db.execute('INSERT INTO events (op, email, user_number) VALUES (?, ?, ?)',
+                              (op, email, user_number)).lastrowid
+        if event_id % 100 == 0:
+            db.execute('DELETE FROM events WHERE id <= ?', (event_id - EVENT_BACKLOG,))
+
+    def changes(self, after):
+        """Return (version, events) for the changes made after version after
+
+        See AssignmentStore.changes.
+        """
+        db = self._db()
+        version, oldest = db.execute('SELECT MAX(id), MIN(id) FROM events').fetchone()
+        version = version or 0
+        if after == version:
+            return version, []
+        if after > version or oldest is None or oldest > after + 1:
+            return version, None
+        rows = db.execute('SELECT id, op, email, user_number FROM events WHERE id > ? '
+                          'AND id <= ? ORDER BY id', (after, version))
+        events = []
+        for event_id, op, email, user_number in rows:
+            event = {'id': event_id, 'op': op}
+            if email is not None:
+                event.update(email=email, user_number=user_number)
+            events.append(event)
+        return version, events
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def lookup(self, email):
+        row = self._db().execute('SELECT user_number FROM assignments WHERE email = ?',
+                                 (email,)).fetchone()
+        return row[0] if row else None
+
+    def count(self):
+        return self._db().execute('SELECT COUNT(*) FROM assignments').fetchone()[0]
+
+    def refresh(self):
+        pass
+
+    def current_version(self):
+        return self._db().execute('SELECT MAX(id) FROM events').fetchone()[0] or 0
+
+    def allocate(self, email, max_users):
+        """Assign the next free user number to email, see AssignmentStore.allocate"""
+        with self.transaction() as db:
+            # Free seats belong to the waitlist first
+            promoted = self._promote(db, max_users)
+            return (*self._allocate(db, email, max_users, time.time()), promoted)
+
+    def allocate_many(self, emails, max_users):
+        """Allocate a batch of emails in one transaction; these seats need no confirmation"""
+        with self.transaction() as db:
+            promoted = self._promote(db, max_users)
+            return [self._allocate(db, email, max_users) for email in emails], promoted
+
+    def _allocate(self, db, email, max_users, unconfirmed_since=None):
+        row = db.execute('SELECT user_number FROM assignments WHERE email = ?',
+                         (email,)).fetchone()
+        if row:
+            return row[0], False
+        if db.execute('SELECT COUNT(*) FROM assignments').fetchone()[0] >= max_users:
+            return None, False
+        next_user = db.execute('SELECT MIN(user_number) FROM free_users').fetchone()[0]
+        if next_user is not None:
+            db.execute('DELETE FROM free_users WHERE user_number = ?', (next_user,))
+        else:
+            next_user = self._high_water(db) + 1
+        db.execute('INSERT INTO assignments (email, user_number, unconfirmed_since) '
+                   'VALUES (?, ?, ?)', (email, next_user, unconfirmed_since))
+        db.execute('DELETE FROM waitlist WHERE email = ?', (email,))
+        self._log(db, 'assign', email, next_user)
+        return next_user, True
+
+    def release(self, email):
+        """Free the user number held by email; returns it, or None"""
+        with self.transaction() as db:
+            row = db.execute('SELECT user_number FROM assignments WHERE email = ?',
+                             (email,)).fetchone()
+            if row is None:
+                return None
+            db.execute('DELETE FROM assignments WHERE email = ?', (email,))
+            db.execute('INSERT OR IGNORE INTO free_users (user_number) VALUES (?)', row)
+            self._log(db, 'release', email, row[0])
+            self._renew_passwords(db, [row[0]])
+            return row[0]
+
+    def release_many(self, emails, max_users):
+        """Free the seats held by emails, see AssignmentStore.release_many"""
+        with self.transaction() as db:
+            released = self._release(db, emails)
+            return released, self._promote(db, max_users)
+
+    def expire(self, before, max_users):
+        """Release seats left unconfirmed since before, see AssignmentStore.expire"""
+        expired = 'SELECT email FROM assignments WHERE unconfirmed_since < ?'
+        if self._db().execute(expired + ' LIMIT 1', (before,)).fetchone() is None:
+            return [], []
+        with self.transaction() as db:
+            emails = [email for (email,) in db.execute(
+                expired + ' ORDER BY unconfirmed_since', (before,)).fetchall()]
+            released = self._release(db, emails)
+            return released, self._promote(db, max_users)
+
+    def _release(self, db, emails):
+        released = []
+        for email in emails:
+            row = db.execute('SELECT user_number FROM assignments WHERE email = ?',
+                             (email,)).fetchone()
+            if row:
+                db.execute('DELETE FROM assignments WHERE email = ?', (email,))
+                db.execute('INSERT OR IGNORE INTO free_users (user_number) VALUES (?)', row)
+                self._log(db, 'release', email, row[0])
+                released.append((email, row[0]))
+            elif db.execute('DELETE FROM waitlist WHERE email = ?', (email,)).rowcount:
+                self._log(db, 'release', email)
+        self._renew_passwords(db, [user_num for _, user_num in released])
+        return released
+
+    def _renew_passwords(self, db, user_nums):
+        """Give released seats new per-seat passwords, in the releasing transaction"""
+        if not user_nums:
+            return
+        config = rotate_seat_passwords(self._read_config(), user_nums)
+        if config is not None:
+            self._write_config(db, config)
+            self._config_changed()
+
+    def promote(self, max_users):
+        """Give free seats to the head of the waitlist, see AssignmentStore.promote"""
+        with self.transaction() as db:
+            return self._promote(db, max_users)
+
+    def _promote(self, db, max_users):
+        if db.execute('SELECT 1 FROM waitlist LIMIT 1').fetchone() is None:
+            return []
+        free = max_users - db.execute('SELECT COUNT(*) FROM assignments').fetchone()[0]
+        if free <= 0:
+            return []
+        promoted = []
+        for (email,) in db.execute('SELECT email FROM waitlist ORDER BY id LIMIT ?',
+                                   (free,)).fetchall():
+            user_num, _ = self._allocate(db, email, max_users, time.time())
+            promoted.append((email, user_num))
+        return promoted
+
+    def join_waitlist(self, email):
+        """Queue email for the next free seat, see AssignmentStore.join_waitlist"""
+        with self.transaction() as db:
+            if db.execute('SELECT 1 FROM assignments WHERE email = ?', (email,)).fetchone():
+                return 0
+            if db.execute('INSERT OR IGNORE INTO waitlist (email) VALUES (?)', (email,)).rowcount:
+                self._log(db, 'wait', email)
+            return self._position(db, email)
+
+    def waitlist_position(self, email):
+        return self._position(self._db(), email) or None
+
+    def _position(self, db, email):
+        return db.execute('SELECT COUNT(*) FROM waitlist WHERE id <= '
+                          '(SELECT id FROM waitlist WHERE email = ?)', (email,)).fetchone()[0]
+
+    def waitlist(self):
+        return [email for (email,) in self._db().execute('SELECT email FROM waitlist ORDER BY id')]
+
+    def waitlist_length(self):
+        return self._db().execute('SELECT COUNT(*) FROM waitlist').fetchone()[0]
+
+    def confirm(self, email):
+        """Confirm the seat held by email, see AssignmentStore.confirm"""
+        row = self._db().execute('SELECT unconfirmed_since FROM assignments WHERE email = ?',
+                                 (email,)).fetchone()
+        if row is None:
+            return False
+        if row[0] is None:
+            return True
+        with self.transaction() as db:
+            if db.execute('UPDATE assignments SET unconfirmed_since = NULL '
+                          'WHERE email = ? AND unconfirmed_since IS NOT NULL', (email,)).rowcount:
+                self._log(db, 'confirm', email)
+                return True
+            return db.execute('SELECT 1 FROM assignments WHERE email = ?',
+                              (email,)).fetchone() is not None
+
+    def page(self, after=0, limit=None, email_prefix=None, user_number=None):
+        """Return (email, user_number) pairs ordered by user number, see AssignmentStore.page"""
+        sql = 'SELECT email, user_number FROM assignments WHERE user_number > ?'
+        params = [after]
+        if user_number is not None:
+            sql += ' AND user_number = ?'
+            params.append(user_number)
+        elif email_prefix:
+            sql += ' AND email >= ? AND email < ?'
+            params += [email_prefix, email_prefix + '\uffff']
+        sql += ' ORDER BY user_number'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return self._db().execute(sql, params).fetchall()
+
+    def _high_water(self, db):
+        return max(db.execute('SELECT MAX(user_number) FROM assignments').fetchone()[0] or 0,
+                   db.execute('SELECT MAX(user_number) FROM free_users').fetchone()[0] or 0)
+
+    def snapshot(self):
+        """Return the assignments in the lab_assignments.json format"""
+        return self._snapshot(self._db())
+
+    def _snapshot(self, db):
+        email_to_user = dict(db.execute('SELECT email, user_number FROM assignments'))
+        return {
+            'email_to_user': email_to_user,
+            'assigned_users': sorted(email_to_user.values()),
+            'high_water': self._high_water(db),
+            'free_users': [n for (n,) in db.execute(
+                'SELECT user_number FROM free_users ORDER BY user_number')],
+            'unconfirmed': dict(db.execute('SELECT email, unconfirmed_since FROM assignments '
+                                           'WHERE unconfirmed_since IS NOT NULL')),
+            'waitlist': [email for (email,) in db.execute(
+                'SELECT email FROM waitlist ORDER BY id')]
+        }
+
+    def replace(self, email_to_user, high_water=0, free_users=None, unconfirmed=None,
+                waitlist=()):
+        """Replace all assignments and the waitlist in one transaction"""
+        with self.transaction() as db:
+            self._replace(db, email_to_user, high_water, free_users, unconfirmed, waitlist)
+
+    def exchange(self, data=None, config=None, keep=None):
+        """Swap the assignments and the config in one transaction, see AssignmentStore.exchange"""
+        data = data or {}
+        with self.transaction() as db:
+            previous_config = self._read_config()
+            previous = self._snapshot(db)
+            kept = keep(previous_config, previous) if keep else None
+            self._write_config(db, config)
+            self._replace(db, data.get('email_to_user', {}), data.get('high_water', 0),
+                          data.get('free_users'), data.get('unconfirmed'), data.get('waitlist', ()))
+        self._config_changed()
+        return kept
+
+    def _replace(self, db, email_to_user, high_water, free_users, unconfirmed, waitlist):
+        assigned = set(email_to_user.values())
+        high_water = max(high_water, max(assigned, default=0))
+        if free_users is None:
+            free_users = range(1, high_water + 1)
+        unconfirmed = unconfirmed or {}
+        db.execute('DELETE FROM assignments')
+        db.execute('DELETE FROM free_users')
+        db.execute('DELETE FROM waitlist')
+        db.executemany('INSERT INTO assignments (email, user_number, unconfirmed_since) '
+                       'VALUES (?, ?, ?)', [(email, n, unconfirmed.get(email))
+                                            for email, n in email_to_user.items()])
+        db.executemany('INSERT OR IGNORE INTO free_users (user_number) VALUES (?)',
+                       [(n,) for n in free_users if n not in assigned and n <= high_water])
+        db.executemany('INSERT OR IGNORE INTO waitlist (email) VALUES (?)',
+                       [(email,) for email in waitlist if email not in email_to_user])
+        self._log(db, 'reset')
+
+    def reset(self):
+        """Drop all assignments and the waitlist"""
+        with self.transaction() as db:
+            db.execute('DELETE FROM assignments')
+            db.execute('DELETE FROM free_users')
+            db.execute('DELETE FROM waitlist')
+            self._log(db, 'reset')
+
+    def compact(self):
+        """Fold the WAL back into the database file"""
+        self._db().execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def close(self):
+        """Checkpoint and close this thread's connection"""
+        self.compact()
+        self._local.db.close()
+        self._local.db = None
+
+def migrate_json_to_sqlite(target, config_path=CONFIG_FILE, path=ASSIGNMENTS_FILE,
+                           journal_path=ASSIGNMENTS_JOURNAL, lock_path=ASSIGNMENTS_LOCK):
+    """Import lab_config.json and lab_assignments.json (plus journal) into target
+
+    Returns the number of imported assignments. The JSON files are left in
+    place so the import can be rolled back by switching LAB_STORAGE back.
+    """
+    if not any(os.path.exists(p) for p in (config_path, path, journal_path)):
+        return 0
+    source = JsonStorage(config_path, path, journal_path, lock_path)
+    if os.path.exists(config_path):
+        target.save_config(source.load_config())
+    data = source.snapshot()
+    target.replace(data['email_to_user'], data['high_water'], data['free_users'],
+                   data['unconfirmed'], data['waitlist'])
+    return len(data['email_to_user'])
+
+class RemoteStorage(ConfigCache):
+    """Storage backend that forwards every call to a shared allocation authority
+
+    All workers and replicas pointing at the same authority share one
+    allocation state. Each thread keeps a keep-alive connection open.
+    """
+
+    def __init__(self, url, token='', lab=None):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.token = token
+        self.lab = lab
+        self._local = threading.local()
+        _open_storages.add(self)
+
+    def _after_fork(self):
+        self._local = threading.local()
+
+    def _call(self, op, *args):
+        body = json.dumps({'lab': self.lab, 'op': op, 'args': args})
+        headers = {'Content-Type': 'application/json', 'X-Lab-Authority-Token': self.token}
+        for attempt in range(2):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+                self._local.conn = conn
+            try:
+                conn.request('POST', '/internal/storage', body, headers)
+                response = conn.getresponse()
+                data = json.loads(response.read())
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise StorageUnavailable(f'Allocation authority unreachable: {e}')
+                continue
+            if response.status != 200:
+                raise StorageUnavailable(data.get('error', f'Authority returned {response.status}'))
+            return data['result']
+
+    def _read_config(self):
+        # Bypass the authority's own cache: the config must be at least as new as the version
+        return self._call('load_config', True)
+
+    def save_config(self, config):
+        self._call('save_config', config)
+        self._config_changed()
+
+    def delete_config(self):
+        self._call('delete_config')
+        self._config_changed()
+
+    def config_version(self):
+        return self._call('config_version')
+
+    def lookup(self, email):
+        return self._call('lookup', email)
+
+    def count(self):
+        return self._call('count')
+
+    def refresh(self):
+        pass
+
+    def current_version(self):
+        return self._call('current_version')
+
+    def allocate(self, email, max_users):
+        return tuple(self._call('allocate', email, max_users))
+
+    def allocate_many(self, emails, max_users):
+        results, promoted = self._call('allocate_many', emails, max_users)
+        return [tuple(result) for result in results], promoted
+
+    def release(self, email):
+        return self._call('release', email)
+
+    def release_many(self, emails, max_users):
+        return self._call('release_many', emails, max_users)
+
+    def expire(self, before, max_users):
+        return self._call('expire', before, max_users)
+
+    def promote(self, max_users):
+        return self._call('promote', max_users)
+
+    def join_waitlist(self, email):
+        return self._call('join_waitlist', email)
+
+    def waitlist_position(self, email):
+        return self._call('waitlist_position', email)
+
+    def waitlist(self):
+        return self._call('waitlist')
+
+    def waitlist_length(self):
+        return self._call('waitlist_length')
+
+    def confirm(self, email):
+        return self._call('confirm', email)
+
+    def archive_and_reset(self):
+        return self._call('archive_and_reset')
+
+    def restore_archive(self, name):
+        return self._call('restore_archive', name)
+
+    def archives(self):
+        return self._call('archives')
+
+    def read_archive(self, name, encoded=False):
+        # Archives live with the authority; they travel as base64 text
+        data = self._call('read_archive', name, True)
+        return data if data is None or encoded else base64.b64decode(data)
+
+    def page(self, after=0, limit=None, email_prefix=None, user_number=None):
+        return [tuple(row) for row in self._call('page', after, limit, email_prefix, user_number)]
+
+    def snapshot(self):
+        return self._call('snapshot')
+
+    def replace(self, email_to_user, high_water=0, free_users=None, unconfirmed=None,
+                waitlist=()):
+        self._call('replace', email_to_user, high_water, free_users, unconfirmed, list(waitlist))
+
+    def changes(self, after):
+        return tuple(self._call('changes', after))
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def reset(self):
+        self._call('reset')
+
+    def compact(self):
+        try:
+            self._call('compact')
+        except StorageUnavailable:
+            pass
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def lab_exists(self, slug):
+        return self._call('lab_exists', slug)
+
+    def lab_slugs(self):
+        return self._call('lab_slugs')
+
+    def lab_create(self, slug):
+        return self._call('lab_create', slug)
+
+# Operations a RemoteStorage may invoke on the authority
+AUTHORITY_OPS = {'load_config', 'save_config', 'delete_config', 'lookup', 'count',
+                 'allocate', 'allocate_many', 'release', 'page', 'snapshot', 'replace',
+                 'reset', 'compact', 'changes', 'current_version', 'config_version',
+                 'release_many', 'expire', 'promote', 'join_waitlist', 'waitlist_position',
+                 'waitlist', 'waitlist_length', 'confirm', 'archive_and_reset',
+                 'restore_archive', 'archives', 'read_archive'}
+
+def _json_files(directory=''):
+    """Config, assignments, journal and lock paths of the lab in directory"""
+    return tuple(os.path.join(directory, name) for name in
+                 (CONFIG_FILE, ASSIGNMENTS_FILE, ASSIGNMENTS_JOURNAL, ASSIGNMENTS_LOCK))
+
+def open_storage(directory='', lab=None):
+    """Open the storage backend selected by LAB_STORAGE
+
+    The default lab keeps its files in the working directory; other labs
+    (lab is their slug) keep them in their own directory.
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        path = os.path.join(directory, os.path.basename(DB_FILE)) if lab else DB_FILE
+        return SqliteStorage(path, directory)
+    if STORAGE_BACKEND == 'remote':
+        return RemoteStorage(AUTHORITY_URL, AUTHORITY_TOKEN, lab)
+    if STORAGE_BACKEND != 'json':
+        raise ValueError(f'Unknown LAB_STORAGE backend: {STORAGE_BACKEND}')
+    return JsonStorage(*_json_files(directory))
+
+@app.errorhandler(StorageUnavailable)
+def storage_unavailable(e):
+    return jsonify({'error': f'Service temporarily unavailable: {e}'}), 503
+
+ReadmeEntry = collections.namedtuple('ReadmeEntry', 'key data etag mtime size')
+
+class ReadmeCache:
+    """Cached copy of the readme PDF, keyed by inode, size and mtime
+
+    Each request costs one stat(); the file is re-read only when it changes.
+    The ETag is a content hash, so it is strong and identical across workers.
+    Files larger than README_CACHE_MAX are not held in memory (data is None).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entry = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the ReadmeEntry for the current file (OSError if missing)"""
+        st = os.stat(self.path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        entry = self.entry
+        if entry is None or entry.key != key:
+            with self._lock:
+                entry = self.entry
+                if entry is None or entry.key != key:
+                    entry = self.entry = self._load()
+        return entry
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            key = (st.st_ino, st.st_size, st.st_mtime_ns)
+            if st.st_size <= README_CACHE_MAX:
+                data = f.read()
+                digest = hashlib.sha256(data).hexdigest()
+            else:
+                data = None
+                digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return ReadmeEntry(key, data, digest[:32], st.st_mtime, len(data) if data else st.st_size)
+
+class _CloseHook:
+    """File mixin that calls on_close once the server has finished with it"""
+    on_close = None
+
+    def close(self):
+        if not self.closed and self.on_close is not None:
+            self.on_close()
+        super().close()
+
+class _TimedBytesIO(_CloseHook, io.BytesIO):
+    pass
+
+class _TimedFileIO(_CloseHook, io.FileIO):
+    pass
+
+class Lab:
+    """One lab: its storage, readme and rendered pages"""
+
+    def __init__(self, slug, storage, readme):
+        self.slug = slug
+        self.storage = storage
+        self.readme = readme
+        self.base = f'/lab/{slug}' if slug else ''
+        self.pages = {}
+        self.last_used = time.monotonic()
+        # asyncio.Lock queueing this lab's allocations in ASGI mode
+        self.alloc_lock = None
+        # _EventFeed behind this lab's event streams in ASGI mode
+        self.event_feed = None
+
+class Labs:
+    """The default lab plus the labs under LABS_DIR, opened on first use
+
+    Only labs in use hold memory: a lab left idle for LAB_IDLE_TIMEOUT
+    seconds is compacted and dropped, and reloaded from its files by the
+    next request for it. The default lab is opened on first use too (see
+    warm_up), so importing the module reads no lab files.
+    """
+
+    def __init__(self):
+        self._default = None
+        self._default_lock = threading.Lock()
+        self._open = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    @property
+    def default(self):
+        if self._default is None:
+            with self._default_lock:
+                if self._default is None:
+                    self._default = Lab(None, open_storage(),
+                                        ReadmeCache(os.path.join(README_DIR, README_NAME)))
+        return self._default
+
+    def exists(self, slug):
+        if STORAGE_BACKEND == 'remote':
+            return self.default.storage.lab_exists(slug)
+        return os.path.isdir(os.path.join(LABS_DIR, slug))
+
+    def slugs(self):
+        """Slugs of all labs, loaded or not"""
+        if STORAGE_BACKEND == 'remote':
+            return self.default.storage.lab_slugs()
+        try:
+            names = os.listdir(LABS_DIR)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if LAB_SLUG.fullmatch(name)
+                      and os.path.isdir(os.path.join(LABS_DIR, name)))
+
+    def loaded(self):
+        with self._lock:
+            return [lab for lab in (self._default, *self._open.values()) if lab is not None]
+
+    def get(self, slug, create=False):
+        """Return the lab for slug (None for the default lab), or None if there is no such lab"""
+        now = time.monotonic()
+        if slug is None:
+            lab = self.default
+        elif not LAB_SLUG.fullmatch(slug):
+            return None
+        else:
+            with self._lock:
+                lab = self._open.get(slug)
+                if lab is None:
+                    if not self.exists(slug):
+                        if not create:
+                            return None
+                        self._create(slug)
+                    lab = self._open[slug] = self._load(slug)
+        lab.last_used = now
+        if now - self._last_sweep >= min(LAB_IDLE_TIMEOUT, 60):
+            self._sweep(now)
+        return lab
+
+    def create(self, slug):
+        """Create the lab for slug; returns False if it already existed"""
+        with self._lock:
+            if slug in self._open or self.exists(slug):
+                return False
+            self._create(slug)
+            return True
+
+    def _create(self, slug):
+        if STORAGE_BACKEND == 'remote':
+            self.default.storage.lab_create(slug)
+        else:
+            os.makedirs(os.path.join(LABS_DIR, slug), exist_ok=True)
+
+    def _load(self, slug):
+        directory = os.path.join(LABS_DIR, slug)
+        return Lab(slug, open_storage(directory, slug),
+                   ReadmeCache(os.path.join(directory, README_NAME)))
+
+    def _sweep(self, now):
+        """Unload labs that have been idle for LAB_IDLE_TIMEOUT"""
+        with self._lock:
+            self._last_sweep = now
+            idle = [slug for slug, lab in self._open.items()
+                    if now - lab.last_used >= LAB_IDLE_TIMEOUT]
+            closing = [self._open.pop(slug) for slug in idle]
+        for lab in closing:
+            lab.storage.close()
+
+    def compact(self):
+        for lab in self.loaded():
+            lab.storage.compact()
+
+labs = Labs()
+atexit.register(labs.compact)
+
+class WebhookSink:
+    """POST each batch as {"entries": [...]} to a URL; any non-2xx status is a failure"""
+
+    def __init__(self, url, token=PROVISION_TOKEN):
+        parsed = urllib.parse.urlsplit(url)
+        self.https = parsed.scheme == 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = urllib.parse.urlunsplit(('', '', parsed.path or '/', parsed.query, ''))
+        self.token = token
+
+    def send(self, entries):
+        connection = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        conn = connection(self.host, self.port, timeout=PROVISION_TIMEOUT)
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        try:
+            conn.request('POST', self.path, json.dumps({'entries': entries}), headers)
+            response = conn.getresponse()
+            response.read()
+        finally:
+            conn.close()
+        if not 200 <= response.status < 300:
+            raise OSError(f'webhook returned {response.status}')
+
+class ScriptSink:
+    """Run a command with the batch as NDJSON on stdin; a non-zero exit is a failure"""
+
+    def __init__(self, command):
+        self.command = shlex.split(command)
+
+    def send(self, entries):
+        subprocess.run(self.command, input=''.join(json.dumps(entry) + '\n' for entry in entries),
+                       text=True, timeout=PROVISION_TIMEOUT, check=True, capture_output=True)
+
+class FileSink:
+    """Drop each batch into directory as its own NDJSON file, renamed in once complete"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._sequence = itertools.count(1)
+
+    def send(self, entries):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        name = f'provision-{stamp}-{os.getpid()}-{next(self._sequence)}.ndjson'
+        tmp_path = os.path.join(self.directory, '.' + name)
+        with open(tmp_path, 'w') as f:
+            f.writelines(json.dumps(entry) + '\n' for entry in entries)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+
+class FakeSink:
+    """In-memory sink for testing: keeps every delivered batch, fails failure_rate of sends"""
+
+    def __init__(self, failure_rate=0.0):
+        self.failure_rate = failure_rate
+        self.batches = []
+
+    def send(self, entries):
+        if random.random() < self.failure_rate:
+            raise OSError('fake sink failure')
+        self.batches.append(list(entries))
+        app.logger.info('Provisioned %d entries (fake sink)', len(entries))
+
+def make_sink(spec):
+    """The provisioning sink for a LAB_PROVISION_SINK value"""
+    kind, _, target = spec.partition(':')
+    if kind in ('http', 'https'):
+        return WebhookSink(spec)
+    if kind == 'script' and target:
+        return ScriptSink(target)
+    if kind == 'file' and target:
+        return FileSink(target)
+    if kind == 'fake':
+        return FakeSink(float(target or 0))
+    raise ValueError(f'Unknown LAB_PROVISION_SINK: {spec}')
+
+def coalesce(entries):
+    """Keep the latest entry per lab account (lab, user number), in order of last change"""
+    latest = {}
+    for entry in entries:
+        key = (entry['lab'], entry['user_number'])
+        latest.pop(key, None)
+        latest[key] = entry
+    return list(latest.values())
+
+class Provisioner:
+    """Pushes assignment changes to a sink from a background thread
+
+    Sign-ups only append to a bounded in-memory queue and never wait on the
+    sink. The worker takes up to PROVISION_BATCH entries, waiting up to
+    PROVISION_BATCH_WAIT seconds for a batch to fill, coalesces them and
+    retries a failed delivery with exponential backoff. While it retries the
+    queue fills up: entries that do not fit, and batches still failing after
+    PROVISION_RETRIES retries, are appended to the dead-letter file instead.
+    Delivery is at least once, so sinks should treat entries as upserts.
+    """
+
+    def __init__(self, sink, dead_letter=PROVISION_DEAD_LETTER):
+        self.sink = sink
+        self.dead_letter = dead_letter
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._in_flight = []
+        self._thread = None
+        self._closed = False
+
+    def __len__(self):
+        return len(self._queue) + len(self._in_flight)
+
+    def _after_fork(self):
+        # Only the thread that forked survives; the child starts with an empty queue
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._in_flight = []
+        self._thread = None
+
+    def submit(self, entries):
+        """Queue entries for delivery; never blocks on the sink"""
+        with self._cond:
+            room = 0 if self._closed else max(PROVISION_QUEUE - len(self._queue), 0)
+            self._queue.extend(entries[:room])
+            overflow = entries[room:]
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name='lab-provision', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        PROVISION_ENTRIES.inc('queued', amount=len(entries) - len(overflow))
+        if overflow:
+            app.logger.warning('Provisioning queue full, %d entries written to %s',
+                               len(overflow), self.dead_letter)
+            self._write_dead_letter(overflow, 'overflow')
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            deadline = time.monotonic() + PROVISION_BATCH_WAIT
+            while len(self._queue) < PROVISION_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = [self._queue.popleft() for _ in range(min(len(self._queue), PROVISION_BATCH))]
+            self._in_flight = coalesce(batch)
+            PROVISION_ENTRIES.inc('coalesced', amount=len(batch) - len(self._in_flight))
+            return self._in_flight
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            self._deliver(batch)
+            with self._cond:
+                self._in_flight = []
+
+    def _deliver(self, batch):
+        for attempt in range(PROVISION_RETRIES + 1):
+            started = time.perf_counter()
+            try:
+                self.sink.send(batch)
+            except Exception as e:
+                PROVISION_SECONDS.observe(time.perf_counter() - started, 'error')
+                app.logger.warning('Provisioning %d entries failed (attempt %d): %s',
+                                   len(batch), attempt + 1, e)
+            else:
+                PROVISION_SECONDS.observe(time.perf_counter() - started, 'ok')
+                PROVISION_ENTRIES.inc('delivered', amount=len(batch))
+                return
+            if attempt < PROVISION_RETRIES:
+                # 1s, 2s, 4s... up to a minute, with jitter so replicas do not retry in step
+                time.sleep(min(2 ** attempt, 60) * random.uniform(0.5, 1))
+        app.logger.error('Giving up on %d provisioning entries, written to %s',
+                         len(batch), self.dead_letter)
+        self._write_dead_letter(batch, 'failed')
+
+    def _write_dead_letter(self, entries, outcome):
+        with self._cond:
+            with open(self.dead_letter, 'a') as f:
+                f.writelines(json.dumps(entry) + '\n' for entry in entries)
+        PROVISION_ENTRIES.inc(outcome, amount=len(entries))
+
+    def close(self):
+        """At exit: keep undelivered entries (including the batch being sent) as dead letters"""
+        with self._cond:
+            self._closed = True
+            pending = self._in_flight + list(self._queue)
+            self._queue.clear()
+        if pending:
+            self._write_dead_letter(pending, 'undelivered')
+
+    def replay(self):
+        """Send the dead-letter file to the sink again; returns (sent, still failing)"""
+        replaying = self.dead_letter + '.replaying'
+        with self._cond:
+            if not os.path.exists(self.dead_letter):
+                return 0, 0
+            os.replace(self.dead_letter, replaying)
+        with open(replaying) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        failing = 0
+        for start in range(0, len(entries), PROVISION_BATCH):
+            try:
+                self.sink.send(coalesce(entries[start:start + PROVISION_BATCH]))
+            except Exception as e:
+                app.logger.error('Replay stopped: %s', e)
+                failing = len(entries) - start
+                self._write_dead_letter(entries[start:], 'failed')
+                break
+        os.remove(replaying)
+        return len(entries) - failing, failing
+
+provisioner = Provisioner(make_sink(PROVISION_SINK)) if PROVISION_SINK else None
+if provisioner is not None:
+    atexit.register(provisioner.close)
+    os.register_at_fork(after_in_child=provisioner._after_fork)
+
+def provision(lab, op, pairs, config=None):
+    """Queue assignment changes, (email, user_number) pairs, for the provisioning sink
+
+    op is 'assign' or 'release'. Assign entries carry the seat's password
+    from config, and so do release entries in per-seat mode: the seat's
+    password was renewed on release, which locks its previous holder out.
+    """
+    if provisioner is None or not pairs:
+        return
+    entries = []
+    for email, user_num in pairs:
+        entry = {'op': op, 'lab': lab.slug or '', 'email': email,
+                 'user_number': user_num, 'username': username_for(user_num)}
+        if op == 'assign' or (config and config['per_seat_passwords']):
+            entry['password'] = seat_password(config, user_num)
+        entries.append(entry)
+    provisioner.submit(entries)
+
+# Compiled templates (see compile_templates) and content-addressed static assets
+TEMPLATES = {}
+ASSETS = {}
+
+def _extract_assets(page, html):
+    """Move inline <style>/<script> blocks into content-hashed /assets/ files"""
+    def move(match, extension, mimetype, tag):
+        body = match.group(1).encode()
+        name = f'{page}.{hashlib.sha256(body).hexdigest()[:12]}.{extension}'
+        ASSETS[name] = (body, mimetype)
+        return tag.format(url=f'/assets/{name}')
+    html = re.sub(r'<style>(.*?)</style>',
+                  lambda m: move(m, 'css', 'text/css', '<link rel="stylesheet" href="{url}">'),
+                  html, flags=re.S)
+    return re.sub(r'<script>(.*?)</script>',
+                  lambda m: move(m, 'js', 'text/javascript', '<script src="{url}"></script>'),
+                  html, flags=re.S)
+
+_templates_lock = threading.Lock()
+
+def compile_templates():
+    """Compile the page templates once, with their CSS and JS split out"""
+    global TEMPLATES
+    with _templates_lock:
+        if TEMPLATES:
+            return
+        # Published in one assignment, once ASSETS holds every file they link to
+        TEMPLATES = {name: app.jinja_env.from_string(_extract_assets(page, html))
+                     for name, page, html in (('setup', 'setup', SETUP_REQUIRED_HTML),
+                                              ('user', 'user', USER_HTML),
+                                              ('admin', 'admin', ADMIN_HTML))}
+
+def template(name):
+    """The compiled page template, compiling them all on first use"""
+    if not TEMPLATES:
+        compile_templates()
+    return TEMPLATES[name]
+
+def _cached_page(name, build):
+    """Serve a rendered page, re-rendering it only when the lab's config changes"""
+    version = g.lab.storage.cached_config()[0]
+    # Lab.pages: name -> (config version, html, etag)
+    cached = g.lab.pages.get(name)
+    if cached is None or cached[0] != version:
+        html = build()
+        cached = (version, html, hashlib.sha256(html.encode()).hexdigest()[:32])
+        g.lab.pages[name] = cached
+    not_modified = _not_modified(cached[2])
+    if not_modified:
+        return not_modified
+    return _with_etag(Response(cached[1], mimetype='text/html'), cached[2])
+
+def lab_route(rule, **options):
+    """Route rule for the default lab, and under /lab/<slug> for every other lab"""
+    def decorator(view):
+        app.route(rule, **options)(view)
+        app.route(f'/lab/<slug>{rule}', **options)(view)
+        return view
+    return decorator
+
+@app.url_value_preprocessor
+def pull_lab(endpoint, values):
+    slug = values.pop('slug', None) if values else None
+    # Saving the first config of a new lab creates it; any other request gets a 404
+    g.lab = labs.get(slug, create=endpoint == 'set_config')
+
+@lab_route('/')
+def index():
+    def build():
+        config = load_config()
+        if config['max_users'] == 0:
+            return template('setup').render(base=g.lab.base)
+        return template('user').render(lab_name=config['lab_name'], base=g.lab.base)
+    return _cached_page('index', build)
+
+@lab_route('/admin')
+def admin():
+    return _cached_page('admin', lambda: template('admin').render(base=g.lab.base))
+
+@app.route('/assets/<name>')
+def asset(name):
+    """Serve a page stylesheet or script; the name carries its content hash"""
+    if not TEMPLATES:
+        compile_templates()
+    if name not in ASSETS:
+        return jsonify({'error': 'Not found'}), 404
+    body, mimetype = ASSETS[name]
+    response = Response(body, mimetype=mimetype)
+    # The name carries the content hash, so it doubles as the ETag
+    response.set_etag(name)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+def _lab_readme(lab):
+    """Return (cache, entry) for the lab's readme, or the default lab's if it has none"""
+    try:
+        return lab.readme, lab.readme.get()
+    except FileNotFoundError:
+        if lab is labs.default:
+            raise
+    return labs.default.readme, labs.default.readme.get()
+
+@lab_route('/download/readme')
+def download_readme():
+    """Serve the lab README PDF"""
+    return readme_response(g.lab, request.environ)
+
+def readme_response(lab, environ):
+    """Build the readme download response (shared by the WSGI and ASGI paths)"""
+    started = time.perf_counter()
+    try:
+        cache, entry = _lab_readme(lab)
+    except OSError as e:
+        response = app.json.response({'error': f'File not found: {str(e)}'})
+        response.status_code = 404
+        return response
+
+    # Servers with a native file wrapper (gunicorn) sendfile() straight from
+    # the page cache; elsewhere serve the in-memory copy
+    from_disk = entry.data is None or 'wsgi.file_wrapper' in environ
+    body = _TimedFileIO(cache.path) if from_disk else _TimedBytesIO(entry.data)
+    size = os.fstat(body.fileno()).st_size if from_disk else entry.size
+
+    requested_range = environ.get('HTTP_RANGE', '-')
+    def log_download():
+        sent = 0 if response.status_code == 304 else response.content_length or 0
+        README_BYTES.inc('disk' if from_disk else 'memory', amount=sent)
+        app.logger.info('readme download: status=%s bytes=%s range=%s source=%s %.1f ms',
+                        response.status_code, sent, requested_range,
+                        'disk' if from_disk else 'memory',
+                        (time.perf_counter() - started) * 1000)
+    body.on_close = log_download
+
+    response = Response(wrap_file(environ, body), mimetype='application/pdf',
+                        direct_passthrough=True)
+    response.content_length = size
+    response.last_modified = entry.mtime
+    response.set_etag(entry.etag)
+    response.cache_control.no_cache = True
+    response.headers.set('Content-Disposition', 'attachment', filename=README_NAME)
+    try:
+        response.make_conditional(environ, accept_ranges=True, complete_length=size)
+    except RequestedRangeNotSatisfiable:
+        response.status_code = 416
+        response.content_length = 0
+        body.close()
+        raise
+    response.headers['Server-Timing'] = f'readme;dur={(time.perf_counter() - started) * 1000:.2f}'
+    if response.status_code == 304:
+        body.close()
+    return response
+
+def _not_modified(etag):
+    """Return a 304 response if the client already holds etag (in any encoding), else None"""
+    for tag in (etag, *(f'{etag}-{coding}' for coding in CODINGS)):
+        if tag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(tag)
+            response.headers['Cache-Control'] = 'no-cache'
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+def _with_etag(response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _gzip(body):
+    # mtime=0: the same body always compresses to the same bytes
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+def _brotli(body):
+    return brotli.compress(body, quality=5)
+
+# Content codings offered, preferred first when the client accepts several equally
+CODINGS = {'br': _brotli, 'gzip': _gzip} if brotli else {'gzip': _gzip}
+COMPRESSIBLE = {'text/html', 'application/json', 'text/css', 'text/javascript'}
+# Compressed bodies of tagged responses, (path, query, etag, coding) -> bytes
+COMPRESSED_CACHE_SIZE = 128
+_compressed = collections.OrderedDict()
+_compressed_lock = threading.Lock()
+
+def compress_response(response, environ):
+    """Encode the body in the best coding the client accepts (WSGI and ASGI paths)
+
+    Streamed and passthrough responses (exports, events, the readme) are
+    left alone. The ETag gets the coding appended, since the bytes differ;
+    tagged bodies are compressed once and then served from a small cache.
+    """
+    if (not COMPRESS or response.direct_passthrough or response.is_streamed
+            or response.status_code != 200 or response.mimetype not in COMPRESSIBLE
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    coding = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING')).best_match(list(CODINGS))
+    if coding is None:
+        return response
+
+    etag, weak = response.get_etag()
+    key = (environ.get('PATH_INFO'), environ.get('QUERY_STRING'), etag, coding)
+    with _compressed_lock:
+        encoded = _compressed.get(key) if etag else None
+        if encoded is not None:
+            _compressed.move_to_end(key)
+    if encoded is None:
+        encoded = CODINGS[coding](body)
+        if etag:
+            with _compressed_lock:
+                _compressed[key] = encoded
+                if len(_compressed) > COMPRESSED_CACHE_SIZE:
+                    _compressed.popitem(last=False)
+    COMPRESSED_BYTES.inc(coding, 'original', amount=len(body))
+    COMPRESSED_BYTES.inc(coding, 'encoded', amount=len(encoded))
+    response.set_data(encoded)
+    response.headers['Content-Encoding'] = coding
+    if etag:
+        response.set_etag(f'{etag}-{coding}', weak)
+    return response
+
+def select_fields(payload, args):
+    """Keep only the top-level keys listed in ?fields= (comma-separated); errors always stay"""
+    fields = args.get('fields')
+    if not fields:
+        return payload
+    wanted = {field.strip() for field in fields.split(',')} | {'error'}
+    return {key: value for key, value in payload.items() if key in wanted}
+
+@lab_route('/api/config', methods=['GET'])
+def get_config():
+    """Get current lab configuration"""
+    # The ETag is the state version; read it first so a change made while the
+    # payload is built can only make the tag older than the content
+    version = g.lab.storage.current_version()
+    etag = f'v{version}'
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    config = load_config(at_version=version)
+    total_assigned = g.lab.storage.count()
+    return _with_etag(jsonify(select_fields({
+        'max_users': config['max_users'],
+        'lab_name': config['lab_name'],
+        'password': config['password'],
+        'url': config['url'],
+        'seat_expiry_minutes': config['seat_expiry_minutes'],
+        'waitlist': config['waitlist'],
+        'per_seat_passwords': config['per_seat_passwords'],
+        'total_assigned': total_assigned,
+        'slots_remaining': config['max_users'] - total_assigned,
+        'waitlisted': g.lab.storage.waitlist_length()
+    }, request.args)), etag)
+
+@lab_route('/api/config', methods=['POST'])
+def set_config():
+    """Set lab configuration (max users)"""
+    data = request.json
+    max_users = data.get('max_users', 0)
+    lab_name = data.get('lab_name', 'Hands-On Lab')
+    password = data.get('password', '')
+    url = data.get('url', '')
+    seat_expiry_minutes = data.get('seat_expiry_minutes', 0)
+    waitlist = bool(data.get('waitlist', False))
+    per_seat_passwords = bool(data.get('per_seat_passwords', False))
+
+    if max_users <= 0:
+        return jsonify({'error': 'max_users must be greater than 0'}), 400
+    if not isinstance(seat_expiry_minutes, (int, float)) or seat_expiry_minutes < 0:
+        return jsonify({'error': 'seat_expiry_minutes must be 0 or more'}), 400
+
+    config = {
+        'max_users': max_users,
+        'lab_name': lab_name,
+        'password': password,
+        'url': url,
+        'seat_expiry_minutes': seat_expiry_minutes,
+        'waitlist': waitlist,
+        'per_seat_passwords': per_seat_passwords
+    }
+    if per_seat_passwords:
+        # Generated here in bulk so a sign-up only slices a string; seats keep
+        # their passwords across reconfigurations unless rotate_passwords is set
+        existing = ''
+        if not data.get('rotate_passwords'):
+            existing = g.lab.storage.load_config(fresh=True).get('seat_passwords', '')
+        config['seat_passwords'] = generate_seat_passwords(max_users, existing)
+    save_config(config)
+    # Seats added by a larger max_users go to the waitlist first
+    provision(g.lab, 'assign', g.lab.storage.promote(max_users), config)
+
+    return jsonify({'message': f'Lab configured for {max_users} users', 'config': public_config(config)})
+
+@lab_route('/api/request-username', methods=['POST'])
+def request_username():
+    """Request a username for an email"""
+    data = request.json
+    email = normalize_email(data.get('email'))
+    rejected = screen_signup(request.environ, email)
+    if rejected:
+        payload, status, headers = rejected
+        return jsonify(payload), status, headers
+    payload, status = claim_username(g.lab, email)
+    return jsonify(select_fields(payload, request.args)), status
+
+def client_ip(environ):
+    """The client address, as seen by the first of PROXY_HOPS trusted proxies"""
+    if PROXY_HOPS:
+        forwarded = [ip.strip() for ip in environ.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+        if len(forwarded) >= PROXY_HOPS and forwarded[-PROXY_HOPS]:
+            return forwarded[-PROXY_HOPS]
+    return environ.get('REMOTE_ADDR', '')
+
+def _is_loopback(host):
+    """Whether host (a name or address) only accepts connections from this machine"""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def _domain_allowed(domain):
+    return any(domain == allowed or domain.endswith('.' + allowed) for allowed in ALLOWED_DOMAINS)
+
+def screen_signup(environ, email):
+    """Checks run before any storage access; returns (payload, status, headers) to reject"""
+    domain = email.rpartition('@')[2]
+    if email and ALLOWED_DOMAINS and not _domain_allowed(domain):
+        SIGNUPS_REJECTED.inc('domain_not_allowed')
+        allowed = ', '.join(sorted(ALLOWED_DOMAINS))
+        return {'error': f'Please sign up with an email address at {allowed}.'}, 403, {}
+    for reason, limiter, key in (('ip', ip_limiter, client_ip(environ)),
+                                 ('domain', domain_limiter, domain)):
+        if limiter is None or not key:
+            continue
+        wait = limiter.take(key)
+        if wait:
+            SIGNUPS_REJECTED.inc(reason)
+            retry = math.ceil(wait)
+            return ({'error': f'Too many sign-up attempts. Please try again in {retry} seconds.'},
+                    429, {'Retry-After': str(retry)})
+    return None
+
+def claim_username(lab, email, allocate=True):
+    """Sign-up logic shared by the WSGI and ASGI paths; returns (payload, status)
+
+    With allocate=False only the lock-free lookup runs, and None is
+    returned when email has no username yet. When the lab is full, seats
+    left unconfirmed past the lab's seat_expiry_minutes are released first;
+    if none is left for email it joins the waitlist (202) when the lab has one.
+    New assignments (and seats changing hands on expiry) are queued for
+    provisioning.
+    """
+    storage = lab.storage
+    if not email:
+        return {'error': 'Email is required'}, 400
+    
+    # Load config and assignments
+    with STORAGE_SECONDS.time('load_config'):
+        config = storage.load_config()
+        if config['max_users'] == 0:
+            # Never turn an attendee away on a cached config; the lab may just have been set up
+            config = storage.load_config(fresh=True)
+    if config['max_users'] == 0:
+        return {'error': 'Lab not configured. Please contact administrator.'}, 400
+    
+    # Check if email already has an assignment (lock-free fast path)
+    with STORAGE_SECONDS.time('lookup'):
+        user_num = storage.lookup(email)
+    created = False
+    if user_num is None:
+        if not allocate:
+            return None
+        # Allocate under the storage lock; the response is rendered after release
+        with STORAGE_SECONDS.time('allocate'):
+            user_num, created, promoted = storage.allocate(email, config['max_users'])
+            provision(lab, 'assign', promoted, config)
+            if user_num is None:
+                fresh = storage.load_config(fresh=True)
+                if fresh['max_users'] > config['max_users']:
+                    config = fresh
+                    user_num, created, promoted = storage.allocate(email, config['max_users'])
+                    provision(lab, 'assign', promoted, config)
+            if user_num is None and config['seat_expiry_minutes']:
+                released, promoted = storage.expire(
+                    time.time() - config['seat_expiry_minutes'] * 60, config['max_users'])
+                if released:
+                    config = storage.load_config(fresh=True)
+                provision(lab, 'release', released, config)
+                provision(lab, 'assign', promoted, config)
+                if released:
+                    # email may have been promoted from the waitlist, or get a freed seat
+                    user_num, created, promoted = storage.allocate(email, config['max_users'])
+                    provision(lab, 'assign', promoted, config)
+        if user_num is None:
+            if config['waitlist']:
+                position = storage.join_waitlist(email)
+                if position:
+                    return {
+                        'waitlisted': True,
+                        'position': position,
+                        'message': f'All {config["max_users"]} slots are taken. You are '
+                                   f'number {position} on the waitlist.'
+                    }, 202
+                user_num = storage.lookup(email)
+            if user_num is None:
+                return {'error': f'All {config["max_users"]} slots have been assigned.'}, 400
+    if config['per_seat_passwords']:
+        # Released seats get new passwords; never show a recycled seat's old one
+        config = storage.load_config(fresh=True)
+
+    if not created:
+        return {
+            'already_assigned': True,
+            'user_number': user_num,
+            'username': username_for(user_num),
+            'password': seat_password(config, user_num),
+            'url': config['url'],
+            'confirm_within_minutes': config['seat_expiry_minutes'],
+            'message': 'You have already been assigned a username.'
+        }, 200
+    
+    provision(lab, 'assign', [(email, user_num)], config)
+    total_assigned = storage.count()
+    
+    return {
+        'already_assigned': False,
+        'user_number': user_num,
+        'username': username_for(user_num),
+        'password': seat_password(config, user_num),
+        'url': config['url'],
+        'confirm_within_minutes': config['seat_expiry_minutes'],
+        'total_assigned': total_assigned,
+        'slots_remaining': config['max_users'] - total_assigned
+    }, 200
+
+@lab_route('/api/confirm-seat', methods=['POST'])
+def confirm_seat():
+    """Confirm an attendee is present, so their seat is never released for expiry"""
+    data = request.json
+    email = normalize_email(data.get('email'))
+    if not email:
+        return jsonify({'error': 'Email is required'}), 400
+    if not g.lab.storage.confirm(email):
+        return jsonify({'error': 'No username is assigned to this email.'}), 404
+    return jsonify({'confirmed': True, 'message': 'Your seat is confirmed.'})
+
+# Rows per storage read when streaming an export
+EXPORT_PAGE_SIZE = 1000
+
+def _assignment_filters():
+    """Turn the ?q= search into page() filters: a username or an email prefix"""
+    q = normalize_email(request.args.get('q'))
+    match = re.fullmatch(r'user(\d+)', q)
+    if match:
+        return {'user_number': int(match.group(1))}
+    return {'email_prefix': q} if q else {}
+
+def _assignment_row(email, user_num):
+    return {
+        'email': email,
+        'user_number': user_num,
+        'username': username_for(user_num)
+    }
+
+@lab_route('/api/admin/assignments', methods=['GET'])
+def get_assignments():
+    """Get assignments, all at once, one page at a time or as a streamed export
+
+    ?limit=N&cursor=C returns up to N rows with user numbers above C plus the
+    next_cursor; ?q= searches by email prefix or username; ?format=csv or
+    ?format=ndjson streams every matching row. ?format=columnar returns the
+    rows as user_number and email columns (the username is user + the
+    number, zero-padded to 3 digits), and ?fields= picks the keys to return.
+    """
+    filters = _assignment_filters()
+    output_format = request.args.get('format')
+    if output_format in ('csv', 'ndjson'):
+        return _export_assignments(output_format, filters)
+
+    version = g.lab.storage.current_version()
+    etag = f'v{version}'
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    config = load_config(at_version=version)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, limit)
+    cursor = request.args.get('cursor', 0, type=int)
+    
+    # Rows come back from storage already ordered by user number
+    rows = g.lab.storage.page(cursor, limit, **filters)
+    total_assigned = g.lab.storage.count()
+    
+    if output_format == 'columnar':
+        assignments = {'user_number': [user_num for _, user_num in rows],
+                       'email': [email for email, _ in rows]}
+    else:
+        assignments = [_assignment_row(email, user_num) for email, user_num in rows]
+    response = {
+        'config': public_config(config),
+        'total_assigned': total_assigned,
+        'slots_remaining': config['max_users'] - total_assigned,
+        'waitlisted': g.lab.storage.waitlist_length(),
+        'assignments': assignments
+    }
+    if limit is not None:
+        response['next_cursor'] = rows[-1][1] if len(rows) == limit else None
+    return _with_etag(jsonify(select_fields(response, request.args)), etag)
+
+def _export_assignments(output_format, filters):
+    """Stream assignments as CSV or NDJSON, reading storage a page at a time"""
+    def generate():
+        if output_format == 'csv':
+            yield _csv_line(['user_number', 'username', 'email'])
+        cursor = 0
+        while True:
+            rows = g.lab.storage.page(cursor, EXPORT_PAGE_SIZE, **filters)
+            for email, user_num in rows:
+                if output_format == 'csv':
+                    yield _csv_line([user_num, username_for(user_num), email])
+                else:
+                    yield json.dumps(_assignment_row(email, user_num)) + '\n'
+            if len(rows) < EXPORT_PAGE_SIZE:
+                break
+            cursor = rows[-1][1]
+
+    if output_format == 'csv':
+        mimetype, filename = 'text/csv', 'lab_assignments.csv'
+    else:
+        mimetype, filename = 'application/x-ndjson', 'lab_assignments.ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@lab_route('/api/admin/credentials', methods=['GET'])
+def export_credentials():
+    """Every seat's username and password (plus its email once taken), for provisioning
+
+    Streams seats 1..max_users in one ?format=csv (default) or ?format=ndjson
+    download, to create all lab accounts in a single batch.
+    """
+    config = load_config()
+    output_format = request.args.get('format', 'csv')
+    if output_format not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+
+    def seats():
+        # Walk the seat numbers, merging in assignments a page at a time
+        next_seat, cursor = 1, 0
+        while True:
+            rows = g.lab.storage.page(cursor, EXPORT_PAGE_SIZE)
+            for email, user_num in rows:
+                for free in range(next_seat, min(user_num, config['max_users'] + 1)):
+                    yield free, ''
+                yield user_num, email
+                next_seat = user_num + 1
+            if len(rows) < EXPORT_PAGE_SIZE:
+                break
+            cursor = rows[-1][1]
+        for free in range(next_seat, config['max_users'] + 1):
+            yield free, ''
+
+    def generate():
+        if output_format == 'csv':
+            yield _csv_line(['user_number', 'username', 'password', 'email'])
+        for user_num, email in seats():
+            row = [user_num, username_for(user_num), seat_password(config, user_num), email]
+            if output_format == 'csv':
+                yield _csv_line(row)
+            else:
+                yield json.dumps(dict(zip(('user_number', 'username', 'password', 'email'), row))) + '\n'
+
+    if output_format == 'csv':
+        mimetype, filename = 'text/csv', 'lab_credentials.csv'
+    else:
+        mimetype, filename = 'application/x-ndjson', 'lab_credentials.ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}',
+                             'Cache-Control': 'no-store'})
+
+# Seconds between keep-alive comments on an idle event stream
+EVENT_KEEPALIVE = 15
+EVENT_STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def _sse(event, data, event_id=None):
+    """Format one Server-Sent Event"""
+    prefix = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{prefix}event: {event}\ndata: {json.dumps(data)}\n\n'
+
+def _counters(storage):
+    config = storage.load_config()
+    total_assigned = storage.count()
+    return {
+        'max_users': config['max_users'],
+        'total_assigned': total_assigned,
+        'slots_remaining': config['max_users'] - total_assigned,
+        'waitlisted': storage.waitlist_length()
+    }
+
+def _event_start(storage):
+    """Open an event stream at the current version: (SSE text, version)"""
+    version = storage.current_version()
+    return _sse('counters', _counters(storage), version), version
+
+def _event_poll(storage, after):
+    """One poll of an event stream: (SSE text, new version); text is '' if nothing changed"""
+    # Idle streams stop at the lock-free version check; changes() takes the
+    # store lock that sign-ups wait for
+    if storage.current_version() == after:
+        return '', after
+    version, events = storage.changes(after)
+    if events is None:
+        return _sse('resync', _counters(storage), version), version
+    if not events:
+        return '', after
+    chunks = []
+    for event in events:
+        if event.get('user_number') is not None:
+            event = dict(event, username=username_for(event['user_number']))
+        chunks.append(_sse(event['op'], event, event['id']))
+    chunks.append(_sse('counters', _counters(storage)))
+    return ''.join(chunks), version
+
+@lab_route('/api/admin/events')
+def assignment_events():
+    """Server-Sent Events stream of assignment changes and counters
+
+    Event ids are storage versions. A client resuming with Last-Event-ID
+    (sent automatically by EventSource) or ?last_event_id= gets every
+    change since then, or a resync event when they are no longer held.
+    """
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id', '')
+    after = int(last_id) if last_id.isdigit() else None
+    lab = g.lab
+
+    def generate():
+        nonlocal after
+        if after is None:
+            # New subscriber: start from the current version
+            text, after = _event_start(lab.storage)
+            yield text
+        idle = 0.0
+        while True:
+            text, after = _event_poll(lab.storage, after)
+            if text:
+                yield text
+                idle = 0.0
+                continue
+            if idle >= EVENT_KEEPALIVE:
+                yield ': keepalive\n\n'
+                idle = 0.0
+            # An open dashboard keeps its lab loaded
+            lab.last_used = time.monotonic()
+            lab.storage.wait(EVENT_POLL_INTERVAL)
+            idle += EVENT_POLL_INTERVAL
+
+    return Response(generate(), mimetype='text/event-stream', headers=EVENT_STREAM_HEADERS)
+
+def _bulk_emails():
+    """Read raw emails from a JSON list, a CSV body or an uploaded CSV file
+
+    Returns None when a JSON body (or its emails key) is not a list.
+    """
+    if request.is_json:
+        data = request.get_json()
+        if isinstance(data, dict):
+            data = data.get('emails', [])
+        if not isinstance(data, list):
+            return None
+        return [item.get('email') if isinstance(item, dict) else item for item in data]
+    if 'file' in request.files:
+        text = request.files['file'].read().decode('utf-8-sig')
+    else:
+        text = request.get_data(as_text=True)
+    rows = [row for row in csv.reader(io.StringIO(text)) if row]
+    column = 0
+    if rows:
+        # Use the "email" column when the CSV has a header row, else the first column
+        header = [cell.strip().lower() for cell in rows[0]]
+        if 'email' in header:
+            column = header.index('email')
+            rows = rows[1:]
+    return [row[column] for row in rows if len(row) > column]
+
+def _csv_line(values):
+    buf = io.StringIO()
+    csv.writer(buf).writerow(values)
+    return buf.getvalue()
+
+@lab_route('/api/admin/bulk-register', methods=['POST'])
+def bulk_register():
+    """Pre-register a list of attendee emails in one batch"""
+    config = load_config()
+    if config['max_users'] == 0:
+        return jsonify({'error': 'Lab not configured. Please configure the lab first.'}), 400
+
+    raw_emails = _bulk_emails()
+    if raw_emails is None:
+        return jsonify({'error': 'emails must be a list'}), 400
+
+    # Same normalization as request_username(), duplicates within the list dropped
+    emails = []
+    seen = set()
+    for raw in raw_emails:
+        email = normalize_email(raw) if isinstance(raw, str) else ''
+        if email and email not in seen:
+            seen.add(email)
+            emails.append(email)
+    if not emails:
+        return jsonify({'error': 'No emails provided'}), 400
+
+    results, promoted = g.lab.storage.allocate_many(emails, config['max_users'])
+    provision(g.lab, 'assign', promoted + [(email, user_num) for email, (user_num, created)
+                                           in zip(emails, results) if created], config)
+    output_format = request.args.get('format', 'ndjson')
+
+    def generate():
+        if output_format == 'csv':
+            yield _csv_line(['email', 'username', 'user_number', 'status'])
+        for email, (user_num, created) in zip(emails, results):
+            if user_num is None:
+                status = 'no_slot'
+            else:
+                status = 'assigned' if created else 'already_assigned'
+            if output_format == 'csv':
+                yield _csv_line([email, username_for(user_num) if user_num else '',
+                                 user_num or '', status])
+            elif user_num is None:
+                yield json.dumps({'email': email, 'status': status,
+                                  'error': f'All {config["max_users"]} slots have been assigned.'}) + '\n'
+            else:
+                yield json.dumps({'email': email, 'user_number': user_num,
+                                  'username': username_for(user_num), 'status': status}) + '\n'
+
+    mimetype = 'text/csv' if output_format == 'csv' else 'application/x-ndjson'
+    return Response(generate(), mimetype=mimetype)
+
+@lab_route('/api/admin/release', methods=['POST'])
+def release_assignments():
+    """Release the seats of {"email": ...} or {"emails": [...]}; waitlisted emails are dropped
+
+    Freed seats go to the head of the waitlist straight away.
+    """
+    data = request.json
+    emails = data.get('emails', [data.get('email')]) if isinstance(data, dict) else None
+    if not isinstance(emails, list):
+        return jsonify({'error': 'emails must be a list'}), 400
+    if not all(isinstance(raw, str) for raw in emails if raw is not None):
+        return jsonify({'error': 'emails must be strings'}), 400
+    emails = list(dict.fromkeys(filter(None, map(normalize_email, emails))))
+    if not emails:
+        return jsonify({'error': 'Email is required'}), 400
+    config = load_config()
+    released, promoted = g.lab.storage.release_many(emails, config['max_users'])
+    if released:
+        config = g.lab.storage.load_config(fresh=True)
+    provision(g.lab, 'release', released, config)
+    provision(g.lab, 'assign', promoted, config)
+    return jsonify({
+        'message': f'Released {len(released)} seat(s), {len(promoted)} given to the waitlist.',
+        'released': [_assignment_row(email, user_num) for email, user_num in released],
+        'promoted': [_assignment_row(email, user_num) for email, user_num in promoted]
+    })
+
+@lab_route('/api/admin/waitlist', methods=['GET'])
+def get_waitlist():
+    """Get the waitlist, first in line first"""
+    return jsonify({'waitlist': [{'position': position, 'email': email}
+                                 for position, email in enumerate(g.lab.storage.waitlist(), 1)]})
+
+def _archived(name):
+    return f' The previous lab was archived as {name}.' if name else ''
+
+@lab_route('/api/admin/reset', methods=['POST'])
+def reset_assignments():
+    """Reset everything - config and assignments (archived first)"""
+    name = g.lab.storage.archive_and_reset()
+    return jsonify({'message': 'All data has been reset. Please reconfigure the lab.' + _archived(name),
+                    'archive': name})
+
+@lab_route('/api/admin/reset-all', methods=['POST'])
+def reset_all():
+    """Reset everything including config (archived first)"""
+    name = g.lab.storage.archive_and_reset()
+    return jsonify({'message': 'All data has been reset.' + _archived(name), 'archive': name})
+
+@lab_route('/api/admin/archives', methods=['GET'])
+def list_archives():
+    """Archives of reset labs, newest first"""
+    return jsonify({'archives': g.lab.storage.archives()})
+
+@lab_route('/api/admin/archives/<name>', methods=['GET'])
+def download_archive(name):
+    """Download an archive (gzipped JSON: config plus assignments)"""
+    data = g.lab.storage.read_archive(name)
+    if data is None:
+        return jsonify({'error': 'Archive not found'}), 404
+    return Response(data, mimetype='application/gzip',
+                    headers={'Content-Disposition': f'attachment; filename={name}'})
+
+@lab_route('/api/admin/archives/<name>/restore', methods=['POST'])
+def restore_archive(name):
+    """Bring back an archived lab; the current state is archived first"""
+    result = g.lab.storage.restore_archive(name)
+    if result is None:
+        return jsonify({'error': 'Archive not found'}), 404
+    return jsonify(dict(result, message=f'Restored {name}.' + _archived(result['archive'])))
+
+@app.route('/internal/storage', methods=['POST'])
+def authority_storage():
+    """Allocation authority: run a storage operation for a RemoteStorage client"""
+    if not app.config.get('LAB_AUTHORITY'):
+        return jsonify({'error': 'Not an allocation authority'}), 404
+    token = request.headers.get('X-Lab-Authority-Token', '')
+    if not hmac.compare_digest(token, AUTHORITY_TOKEN):
+        return jsonify({'error': 'Invalid authority token'}), 403
+    data = request.json
+    op, args = data.get('op'), data.get('args', [])
+    if op == 'lab_exists':
+        return jsonify({'result': labs.exists(*args)})
+    if op == 'lab_slugs':
+        return jsonify({'result': labs.slugs()})
+    if op == 'lab_create':
+        return jsonify({'result': labs.get(*args, create=True) is not None})
+    if op not in AUTHORITY_OPS:
+        return jsonify({'error': f'Unknown operation: {op}'}), 400
+    # Replicas create a lab (lab_create) before sending operations for it
+    lab = labs.get(data.get('lab'))
+    if lab is None:
+        return jsonify({'error': f'Invalid lab: {data.get("lab")}'}), 400
+    with STORAGE_SECONDS.time(op):
+        result = getattr(lab.storage, op)(*args)
+    return jsonify({'result': result})
+
+@app.route('/api/labs', methods=['GET'])
+def list_labs():
+    """All labs besides the default one, with where to find them"""
+    loaded = {lab.slug for lab in labs.loaded()}
+    return jsonify({'labs': [{'slug': slug, 'url': f'/lab/{slug}/', 'admin': f'/lab/{slug}/admin',
+                              'loaded': slug in loaded}
+                             for slug in labs.slugs()]})
+
+@app.route('/api/labs', methods=['POST'])
+def create_lab():
+    """Create the lab {"slug": ...}; 201 if it is new, 200 if it already exists"""
+    slug = (request.json or {}).get('slug')
+    if not isinstance(slug, str) or not LAB_SLUG.fullmatch(slug):
+        return jsonify({'error': 'slug must be lowercase letters, digits and dashes'}), 400
+    created = labs.create(slug)
+    return jsonify({'slug': slug, 'url': f'/lab/{slug}/', 'admin': f'/lab/{slug}/admin'}), (
+        201 if created else 200)
+
+@app.before_request
+def start_timer():
+    request.environ['lab.started'] = time.perf_counter()
+
+@app.before_request
+def require_lab():
+    if g.lab is None:
+        return jsonify({'error': 'Unknown lab'}), 404
+
+@app.after_request
+def compress(response):
+    return compress_response(response, request.environ)
+
+@app.after_request
+def record_request(response):
+    started = request.environ.get('lab.started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route)
+        REQUESTS.inc(route, request.method, response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics, summed over all workers when there are several"""
+    shared = shared_metrics.collect()
+    if shared is None:
+        gauges = {}
+        for name, state in process_gauges().items():
+            Counter.merge(gauges.setdefault(name, {}), state)
+        shared = None, gauges
+    lines = []
+    for metric in METRICS:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.expose(shared[0] and shared[0][metric.name]))
+    for gauge in (LABS_LOADED, RATE_LIMITED_KEYS, PROVISION_QUEUED):
+        if gauge.name in shared[1]:
+            lines += [f'# HELP {gauge.name} {gauge.help}', f'# TYPE {gauge.name} gauge',
+                      *gauge.expose(shared[1][gauge.name])]
+    # Slot gauges for the labs loaded in this process (lab="" is the default lab)
+    slots = {'lab_slots_total': [], 'lab_slots_assigned': [], 'lab_slots_remaining': [],
+             'lab_waitlist_length': []}
+    loaded = labs.loaded()
+    for lab in loaded:
+        config = lab.storage.load_config()
+        assigned = lab.storage.count()
+        label = _label_pairs(('lab',), (lab.slug or '',))
+        slots['lab_slots_total'].append(f'lab_slots_total{{{label}}} {config["max_users"]}')
+        slots['lab_slots_assigned'].append(f'lab_slots_assigned{{{label}}} {assigned}')
+        slots['lab_slots_remaining'].append(
+            f'lab_slots_remaining{{{label}}} {max(config["max_users"] - assigned, 0)}')
+        slots['lab_waitlist_length'].append(
+            f'lab_waitlist_length{{{label}}} {lab.storage.waitlist_length()}')
+    for name, help in (('lab_slots_total', 'Configured max users'),
+                       ('lab_slots_assigned', 'Usernames assigned'),
+                       ('lab_slots_remaining', 'Usernames still available'),
+                       ('lab_waitlist_length', 'Attendees waiting for a seat')):
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge', *slots[name]]
+    return Response('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# ASGI mode (LAB_SERVER=asgi): sign-ups, readme downloads and event streams
+# are served on the event loop. Their blocking storage and file calls run on
+# a pool of THREADS threads, so connections that are only waiting (event
+# streams, slow downloads, queued sign-ups) hold no thread. Every other
+# request runs the Flask app on the same pool.
+ASGI_PATH = re.compile(r'(?:/lab/(?P<slug>[^/]+))?(?P<route>/[^?]*)')
+
+_asgi_pool = None
 
-def load_config():
-    """Load lab configuration"""
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r') as f:
-            config = json.load(f)
-            # Add default values for password and url if they don't exist
-            if 'password' not in config:
-                config['password'] = ''
-            if 'url' not in config:
-                config['url'] = ''
-            return config
-    return {
-        'max_users': 0,
-        'lab_name': 'Hands-On Lab',
-        'password': '',
-        'url': ''
+def _blocking(fn, *args):
+    """Run a blocking call on the ASGI thread pool"""
+    global _asgi_pool
+    if _asgi_pool is None:
+        _asgi_pool = ThreadPoolExecutor(THREADS, thread_name_prefix='lab-asgi')
+    return asyncio.get_running_loop().run_in_executor(_asgi_pool, fn, *args)
+
+def _wsgi_environ(scope, body):
+    """Build the WSGI environ for an ASGI HTTP request"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    root_path = scope.get('root_path', '')
+    path = scope['path'][len(root_path):] if scope['path'].startswith(root_path) else scope['path']
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode().decode('latin-1'),
+        'PATH_INFO': path.encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': WORKERS > 1,
+        'wsgi.run_once': False,
     }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key == 'CONTENT_LENGTH':
+            continue
+        if key != 'CONTENT_TYPE':
+            key = 'HTTP_' + key
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
 
-def save_config(config):
-    """Save lab configuration"""
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f, indent=2)
+async def _send_wsgi(send, status, headers, app_iter, context=None):
+    """Send a WSGI response; the body is read on the thread pool
 
-def load_assignments():
-    """Load user assignments"""
-    if os.path.exists(ASSIGNMENTS_FILE):
-        with open(ASSIGNMENTS_FILE, 'r') as f:
-            return json.load(f)
-    return {
-        'email_to_user': {},
-        'assigned_users': []
-    }
+    All reads run in one contextvars context, so generators that hold a
+    Flask request context (stream_with_context) see it from any pool thread.
+    """
+    context = context or contextvars.copy_context()
+    await send({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                            for k, v in headers]})
+    iterator = iter(app_iter)
+    try:
+        while True:
+            chunk = await _blocking(context.run, next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(app_iter, 'close'):
+            await _blocking(context.run, app_iter.close)
 
-def save_assignments(assignments):
-    """Save user assignments"""
-    with open(ASSIGNMENTS_FILE, 'w') as f:
-        json.dump(assignments, f, indent=2)
+async def _asgi_flask(environ, send):
+    """Run a request through the Flask app on the thread pool"""
+    started = []
 
-@app.route('/')
-def index():
-    config = load_config()
-    if config['max_users'] == 0:
-        return render_template_string(SETUP_REQUIRED_HTML)
-    return render_template_string(USER_HTML, lab_name=config['lab_name'])
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
 
-@app.route('/admin')
-def admin():
-    return render_template_string(ADMIN_HTML)
+    context = contextvars.copy_context()
+    app_iter = await _blocking(context.run, app, environ, start_response)
+    await _send_wsgi(send, *started, app_iter, context)
 
-@app.route('/download/readme')
-def download_readme():
-    """Serve the lab README PDF"""
+def _json_response(payload, status=200):
+    response = app.json.response(payload)
+    response.status_code = status
+    return response
+
+async def _asgi_request_username(lab, req, disconnected):
+    data = req.get_json(silent=True) if req.is_json else None
+    if not isinstance(data, dict):
+        return None  # the Flask route produces the usual error response
+    email = normalize_email(data.get('email'))
+    rejected = screen_signup(req.environ, email)
+    if rejected:
+        payload, status, headers = rejected
+        response = _json_response(payload, status)
+        response.headers.update(headers)
+        return response
+    result = await _blocking(claim_username, lab, email, False)
+    if result is None:
+        # New attendees queue here, on the event loop rather than in threads
+        # blocked on the store lock: one allocation per lab and process at a time
+        if lab.alloc_lock is None:
+            lab.alloc_lock = asyncio.Lock()
+        async with lab.alloc_lock:
+            result = await _blocking(claim_username, lab, email)
+    payload, status = result
+    return _json_response(select_fields(payload, req.args), status)
+
+async def _asgi_readme(lab, req, disconnected):
+    return await _blocking(readme_response, lab, req.environ)
+
+class _EventFeed:
+    """Shared poller behind a lab's ASGI event streams
+
+    While anyone is subscribed, one task polls the lab every
+    EVENT_POLL_INTERVAL and publishes each batch of events, so a room full of
+    open dashboards costs one storage poll per interval, not one per stream.
+    """
+
+    # Recent batches kept for streams that are a few batches behind
+    BATCHES = 16
+
+    def __init__(self, lab):
+        self.lab = lab
+        self.version = None
+        self.batches = collections.OrderedDict()  # version before -> (text, version after)
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+        self.task = None
+
+    def subscribe(self):
+        self.subscribers += 1
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            self.version = await _blocking(self.lab.storage.current_version)
+            while self.subscribers:
+                await asyncio.sleep(EVENT_POLL_INTERVAL)
+                # Subscribed dashboards keep their lab loaded
+                self.lab.last_used = time.monotonic()
+                before = self.version
+                text, version = await _blocking(_event_poll, self.lab.storage, before)
+                if text:
+                    self.batches[before] = (text, version)
+                    if len(self.batches) > self.BATCHES:
+                        self.batches.popitem(last=False)
+                    self.version = version
+                    self.changed.set()
+                    self.changed = asyncio.Event()
+        finally:
+            self.task = None
+
+async def _wait_any(events, timeout):
+    waiters = [asyncio.ensure_future(event.wait()) for event in events]
     try:
-        return send_from_directory('/home/cdsw', 'lab-readme.pdf', as_attachment=True)
-    except Exception as e:
-        return jsonify({'error': f'File not found: {str(e)}'}), 404
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
 
-@app.route('/api/config', methods=['GET'])
-def get_config():
-    """Get current lab configuration"""
-    config = load_config()
-    assignments = load_assignments()
-    return jsonify({
-        'max_users': config['max_users'],
-        'lab_name': config['lab_name'],
-        'password': config['password'],
-        'url': config['url'],
-        'total_assigned': len(assignments['email_to_user']),
-        'slots_remaining': config['max_users'] - len(assignments['email_to_user'])
-    })
+async def _asgi_events(lab, req, disconnected):
+    """Event stream as in assignment_events(), fed by the lab's _EventFeed"""
+    last_id = req.headers.get('Last-Event-ID') or req.args.get('last_event_id', '')
+    after = int(last_id) if last_id.isdigit() else None
+    if lab.event_feed is None:
+        lab.event_feed = _EventFeed(lab)
+    feed = lab.event_feed
 
-@app.route('/api/config', methods=['POST'])
-def set_config():
-    """Set lab configuration (max users)"""
-    data = request.json
-    max_users = data.get('max_users', 0)
-    lab_name = data.get('lab_name', 'Hands-On Lab')
-    password = data.get('password', '')
-    url = data.get('url', '')
+    async def stream():
+        nonlocal after
+        feed.subscribe()
+        try:
+            if after is None:
+                text, after = await _blocking(_event_start, lab.storage)
+                yield text.encode()
+            last_sent = time.monotonic()
+            while not disconnected.is_set():
+                changed = feed.changed
+                if feed.version is not None and after != feed.version:
+                    # Take the published batch; a stream resuming from
+                    # further back polls for itself
+                    text, after = (feed.batches.get(after)
+                                   or await _blocking(_event_poll, lab.storage, after))
+                    if text:
+                        yield text.encode()
+                        last_sent = time.monotonic()
+                        continue
+                if time.monotonic() - last_sent >= EVENT_KEEPALIVE:
+                    yield b': keepalive\n\n'
+                    last_sent = time.monotonic()
+                await _wait_any((changed, disconnected), EVENT_KEEPALIVE)
+        finally:
+            feed.subscribers -= 1
 
-    if max_users <= 0:
-        return jsonify({'error': 'max_users must be greater than 0'}), 400
+    response = Response(mimetype='text/event-stream', headers=EVENT_STREAM_HEADERS)
+    response.async_body = stream()
+    return response
 
-    config = {
-        'max_users': max_users,
-        'lab_name': lab_name,
-        'password': password,
-        'url': url
-    }
-    save_config(config)
+# Natively served routes (also under /lab/<slug>)
+ASGI_ROUTES = {
+    ('POST', '/api/request-username'): _asgi_request_username,
+    ('GET', '/download/readme'): _asgi_readme,
+    ('GET', '/api/admin/events'): _asgi_events,
+}
 
-    return jsonify({'message': f'Lab configured for {max_users} users', 'config': config})
+async def _watch_disconnect(receive, disconnected):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    disconnected.set()
 
-@app.route('/api/request-username', methods=['POST'])
-def request_username():
-    """Request a username for an email"""
-    data = request.json
-    email = data.get('email', '').lower().strip()
-    
-    if not email:
-        return jsonify({'error': 'Email is required'}), 400
-    
-    # Load config and assignments
-    config = load_config()
-    if config['max_users'] == 0:
-        return jsonify({'error': 'Lab not configured. Please contact administrator.'}), 400
-    
-    assignments = load_assignments()
-    
-    # Check if email already has an assignment
-    if email in assignments['email_to_user']:
-        user_num = assignments['email_to_user'][email]
-        return jsonify({
-            'already_assigned': True,
-            'user_number': user_num,
-            'username': f"user{str(user_num).zfill(3)}",
-            'password': config['password'],
-            'url': config['url'],
-            'message': 'You have already been assigned a username.'
-        })
-    
-    # Check if we have slots available
-    if len(assignments['email_to_user']) >= config['max_users']:
-        return jsonify({'error': f'All {config["max_users"]} slots have been assigned.'}), 400
-    
-    # Find next available user number
-    next_user = 1
-    while next_user in assignments['assigned_users']:
-        next_user += 1
-    
-    # Assign user number
-    assignments['email_to_user'][email] = next_user
-    assignments['assigned_users'].append(next_user)
-    assignments['assigned_users'].sort()
-    
-    # Save assignments
-    save_assignments(assignments)
-    
-    return jsonify({
-        'already_assigned': False,
-        'user_number': next_user,
-        'username': f"user{str(next_user).zfill(3)}",
-        'password': config['password'],
-        'url': config['url'],
-        'total_assigned': len(assignments['email_to_user']),
-        'slots_remaining': config['max_users'] - len(assignments['email_to_user'])
-    })
+async def asgi_app(scope, receive, send):
+    """ASGI entry point: the hot routes natively, everything else through Flask"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await _blocking(labs.compact)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
 
-@app.route('/api/admin/assignments', methods=['GET'])
-def get_assignments():
-    """Get all assignments"""
-    config = load_config()
-    assignments = load_assignments()
-    
-    # Build list of assignments with details
-    assignment_list = []
-    for email, user_num in assignments['email_to_user'].items():
-        assignment_list.append({
-            'email': email,
-            'user_number': user_num,
-            'username': f"user{str(user_num).zfill(3)}"
-        })
-    
-    # Sort by user number
-    assignment_list.sort(key=lambda x: x['user_number'])
-    
-    return jsonify({
-        'config': config,
-        'total_assigned': len(assignments['email_to_user']),
-        'slots_remaining': config['max_users'] - len(assignments['email_to_user']),
-        'assignments': assignment_list
-    })
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    environ = _wsgi_environ(scope, b''.join(chunks))
 
-@app.route('/api/admin/reset', methods=['POST'])
-def reset_assignments():
-    """Reset everything - config and assignments"""
-    if os.path.exists(ASSIGNMENTS_FILE):
-        os.remove(ASSIGNMENTS_FILE)
-    if os.path.exists(CONFIG_FILE):
-        os.remove(CONFIG_FILE)
-    return jsonify({'message': 'All data has been reset. Please reconfigure the lab.'})
-
-@app.route('/api/admin/reset-all', methods=['POST'])
-def reset_all():
-    """Reset everything including config"""
-    if os.path.exists(ASSIGNMENTS_FILE):
-        os.remove(ASSIGNMENTS_FILE)
-    if os.path.exists(CONFIG_FILE):
-        os.remove(CONFIG_FILE)
-    return jsonify({'message': 'All data has been reset.'})
+    match = ASGI_PATH.fullmatch(environ['PATH_INFO'])
+    handler = ASGI_ROUTES.get((scope['method'], match['route'])) if match else None
+    if handler is None:
+        await _asgi_flask(environ, send)
+        return
+
+    started = time.perf_counter()
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(_watch_disconnect(receive, disconnected))
+    try:
+        try:
+            lab = await _blocking(labs.get, match['slug'])
+            if lab is None:
+                response = _json_response({'error': 'Unknown lab'}, 404)
+            else:
+                response = await handler(lab, app.request_class(environ), disconnected)
+        except StorageUnavailable as e:
+            response = _json_response({'error': f'Service temporarily unavailable: {e}'}, 503)
+        except HTTPException as e:
+            response = e.get_response(environ)
+        if response is None:
+            await _asgi_flask(environ, send)
+            return
+        route = ('/lab/<slug>' if match['slug'] is not None else '') + match['route']
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route)
+        REQUESTS.inc(route, scope['method'], response.status_code)
+        async_body = getattr(response, 'async_body', None)
+        if async_body is None:
+            compress_response(response, environ)
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        if async_body is None:
+            await _send_wsgi(send, status, headers, app_iter)
+            return
+        await send({'type': 'http.response.start', 'status': response.status_code,
+                    'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                                for k, v in headers if k.lower() != 'content-length']})
+        async for chunk in async_body:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+
+def warm_up():
+    """Load what the first requests would otherwise pay for
+
+    Compiles the page templates and loads the default lab's state, config
+    and readme. serve() runs it before the port opens (in the gunicorn
+    master, before it forks), so a restarted engine answers its first
+    requests at full speed; without it everything still loads on first use.
+    """
+    started = time.perf_counter()
+    compile_templates()
+    lab = labs.default
+    try:
+        lab.storage.cached_config()
+    except StorageUnavailable as e:
+        app.logger.warning('Warm-up skipped the lab state: %s', e)
+    with contextlib.suppress(OSError):
+        lab.readme.get()
+    app.logger.info('Warmed up in %.0f ms', (time.perf_counter() - started) * 1000)
+
+def serve(port, host='127.0.0.1', workers=WORKERS, threads=THREADS):
+    """Run the app, under gunicorn when more than one worker is requested"""
+    warm_up()
+    if SERVER == 'asgi':
+        try:
+            import uvicorn
+        except ImportError:
+            sys.exit('LAB_SERVER=asgi requires uvicorn (pip install uvicorn)')
+        if workers <= 1:
+            uvicorn.run(asgi_app, host=host, port=port)
+            return
+    elif workers <= 1:
+        app.run(host=host, port=port, threaded=True)
+        return
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit('LAB_WORKERS > 1 requires gunicorn (pip install gunicorn)')
+    shared_metrics.start()
+
+    class PortalApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('child_exit', lambda server, worker: shared_metrics.retire(worker.pid))
+            if SERVER == 'asgi':
+                self.cfg.set('worker_class', 'uvicorn.workers.UvicornWorker')
+            else:
+                self.cfg.set('threads', threads)
+
+        def load(self):
+            return asgi_app if SERVER == 'asgi' else app
+
+    PortalApplication().run()
 
 # HTML Templates
 SETUP_REQUIRED_HTML = '''
@@ -250,7 +3852,7 @@ SETUP_REQUIRED_HTML = '''
     <div class="container">
         <h1>⚙️ Lab Not Configured</h1>
         <p>This lab has not been set up yet. Please configure the number of users before participants can register.</p>
-        <a href="/admin" class="btn">Go to Admin Setup</a>
+        <a href="{{ base }}/admin" class="btn">Go to Admin Setup</a>
     </div>
 </body>
 </html>
@@ -262,6 +3864,7 @@ USER_HTML = '''
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <meta name="lab-base" content="{{ base }}">
     <title>{{ lab_name }} - Get Username</title>
     <style>
         * { margin: 0; padding: 0; box-sizing: border-box; }
@@ -412,6 +4015,28 @@ USER_HTML = '''
             border-left-color: #f59e0b;
         }
         
+        .btn-confirm {
+            width: auto;
+            padding: 10px 24px;
+            margin-top: 10px;
+        }
+        
+        .waitlist {
+            display: none;
+            margin-top: 15px;
+            padding: 12px 16px;
+            background: #fffbeb;
+            border-left: 4px solid #f59e0b;
+            border-radius: 8px;
+            color: #92400e;
+            font-size: 14px;
+        }
+        
+        .waitlist.show {
+            display: block;
+            animation: fadeIn 0.5s;
+        }
+        
         .error {
             display: none;
             margin-top: 15px;
@@ -434,7 +4059,7 @@ USER_HTML = '''
         <div class="header">
             <h1>🚀 {{ lab_name }}</h1>
             <p>Enter your email to get your username</p>
-            <a href="/download/readme" class="download-link">📄 Download Lab Instructions (PDF)</a>
+            <a href="{{ base }}/download/readme" class="download-link">📄 Download Lab Instructions (PDF)</a>
         </div>
         
         <form id="usernameForm">
@@ -446,6 +4071,7 @@ USER_HTML = '''
         </form>
         
         <div id="error" class="error"></div>
+        <div id="waitlist" class="waitlist"></div>
         
         <div id="result" class="result">
             <h2 id="resultTitle">You are:</h2>
@@ -463,25 +4089,23 @@ USER_HTML = '''
                 </div>
             </div>
             <p id="resultMessage"></p>
+            <div id="confirmBox" style="display: none;">
+                <button type="button" class="btn btn-confirm" id="confirmSeat">✅ I'm here - keep my seat</button>
+                <p id="confirmHint"></p>
+            </div>
         </div>
     </div>
 
     <script>
-        document.getElementById('usernameForm').addEventListener('submit', function(e) {
-            e.preventDefault();
-            
-            const email = document.getElementById('email').value.toLowerCase().trim();
-            const errorDiv = document.getElementById('error');
-            const resultDiv = document.getElementById('result');
-            const submitBtn = this.querySelector('button[type="submit"]');
-            
-            errorDiv.classList.remove('show');
-            resultDiv.classList.remove('show');
-            
-            submitBtn.disabled = true;
-            submitBtn.textContent = 'Processing...';
-            
-            fetch('/api/request-username', {
+        // URL prefix of this lab ('' for the default lab, '/lab/<slug>' otherwise)
+        const BASE = document.querySelector('meta[name="lab-base"]').content;
+        // Waitlisted attendees ask again this often (ms) until a seat frees up
+        const WAITLIST_POLL = 15000;
+        let waitlistTimer = null;
+        let currentEmail = '';
+        
+        function requestUsername(email) {
+            return fetch(BASE + '/api/request-username', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -495,40 +4119,117 @@ USER_HTML = '''
                     });
                 }
                 return response.json();
-            })
-            .then(data => {
-                document.getElementById('username').textContent = data.username;
-                document.getElementById('password').textContent = data.password || 'Not set';
+            });
+        }
+        
+        function showError(error) {
+            const errorDiv = document.getElementById('error');
+            document.getElementById('waitlist').classList.remove('show');
+            errorDiv.textContent = error.message;
+            errorDiv.classList.add('show');
+        }
+        
+        function showResult(data, promoted) {
+            const resultDiv = document.getElementById('result');
+            const waitlistDiv = document.getElementById('waitlist');
+            if (data.waitlisted) {
+                waitlistDiv.textContent = `${data.message} Keep this page open: your username appears here as soon as a seat is free.`;
+                waitlistDiv.classList.add('show');
+                waitlistTimer = setTimeout(pollWaitlist, WAITLIST_POLL);
+                return;
+            }
+            waitlistDiv.classList.remove('show');
 
-                const labUrlElement = document.getElementById('labUrl');
-                if (data.url) {
-                    labUrlElement.href = data.url;
-                    labUrlElement.textContent = data.url;
-                } else {
-                    labUrlElement.href = '#';
-                    labUrlElement.textContent = 'Not set';
-                }
+            document.getElementById('username').textContent = data.username;
+            document.getElementById('password').textContent = data.password || 'Not set';
 
-                if (data.already_assigned) {
-                    document.getElementById('resultTitle').textContent = 'You already have a username:';
-                    document.getElementById('resultMessage').textContent = 'You previously registered with this email address.';
-                    resultDiv.classList.add('already-assigned');
-                } else {
-                    document.getElementById('resultTitle').textContent = 'You are:';
-                    document.getElementById('resultMessage').textContent = `Successfully assigned! ${data.slots_remaining} slots remaining.`;
-                    resultDiv.classList.remove('already-assigned');
-                }
+            const labUrlElement = document.getElementById('labUrl');
+            if (data.url) {
+                labUrlElement.href = data.url;
+                labUrlElement.textContent = data.url;
+            } else {
+                labUrlElement.href = '#';
+                labUrlElement.textContent = 'Not set';
+            }
 
-                resultDiv.classList.add('show');
-            })
-            .catch(error => {
-                errorDiv.textContent = error.message;
-                errorDiv.classList.add('show');
+            if (promoted) {
+                document.getElementById('resultTitle').textContent = 'A seat opened up! You are:';
+                document.getElementById('resultMessage').textContent = 'You have been moved off the waitlist.';
+                resultDiv.classList.remove('already-assigned');
+            } else if (data.already_assigned) {
+                document.getElementById('resultTitle').textContent = 'You already have a username:';
+                document.getElementById('resultMessage').textContent = 'You previously registered with this email address.';
+                resultDiv.classList.add('already-assigned');
+            } else {
+                document.getElementById('resultTitle').textContent = 'You are:';
+                document.getElementById('resultMessage').textContent = `Successfully assigned! ${data.slots_remaining} slots remaining.`;
+                resultDiv.classList.remove('already-assigned');
+            }
+
+            const confirmBox = document.getElementById('confirmBox');
+            const confirmButton = document.getElementById('confirmSeat');
+            if (data.confirm_within_minutes) {
+                confirmButton.disabled = false;
+                confirmButton.textContent = "✅ I'm here - keep my seat";
+                document.getElementById('confirmHint').textContent = `Seats not confirmed within ${data.confirm_within_minutes} minutes are given to someone else.`;
+                confirmBox.style.display = 'block';
+            } else {
+                confirmBox.style.display = 'none';
+            }
+
+            resultDiv.classList.add('show');
+        }
+        
+        function pollWaitlist() {
+            requestUsername(currentEmail)
+                .then(data => showResult(data, true))
+                .catch(showError);
+        }
+        
+        function confirmSeat() {
+            fetch(BASE + '/api/confirm-seat', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ email: currentEmail })
             })
-            .finally(() => {
-                submitBtn.disabled = false;
-                submitBtn.textContent = 'Get My Username';
+            .then(r => r.json())
+            .then(data => {
+                if (!data.confirmed) return;
+                const confirmButton = document.getElementById('confirmSeat');
+                confirmButton.disabled = true;
+                confirmButton.textContent = '✅ Seat confirmed';
+                document.getElementById('confirmHint').textContent = '';
             });
+        }
+        
+        document.getElementById('confirmSeat').addEventListener('click', confirmSeat);
+        // Opening the lab counts as being here
+        document.getElementById('labUrl').addEventListener('click', () => {
+            if (document.getElementById('confirmBox').style.display === 'block') confirmSeat();
+        });
+        
+        document.getElementById('usernameForm').addEventListener('submit', function(e) {
+            e.preventDefault();
+            
+            const email = document.getElementById('email').value.toLowerCase().trim();
+            const submitBtn = this.querySelector('button[type="submit"]');
+            
+            clearTimeout(waitlistTimer);
+            currentEmail = email;
+            document.getElementById('error').classList.remove('show');
+            document.getElementById('waitlist').classList.remove('show');
+            document.getElementById('result').classList.remove('show');
+            
+            submitBtn.disabled = true;
+            submitBtn.textContent = 'Processing...';
+            
+            requestUsername(email)
+                .then(data => showResult(data, false))
+                .catch(showError)
+                .finally(() => {
+                    submitBtn.disabled = false;
+                    submitBtn.textContent = 'Get My Username';
+                });
         });
     </script>
 </body>
@@ -541,6 +4242,7 @@ ADMIN_HTML = '''
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <meta name="lab-base" content="{{ base }}">
     <title>Admin - Lab Setup</title>
     <style>
         * { margin: 0; padding: 0; box-sizing: border-box; }
@@ -607,8 +4309,11 @@ ADMIN_HTML = '''
         }
         
         .btn:hover { background: #5a67d8; }
+        a.btn { display: inline-block; text-decoration: none; }
         .btn-danger { background: #f56565; }
         .btn-danger:hover { background: #e53e3e; }
+        .btn-small { padding: 4px 12px; font-size: 12px; }
+        .form-group input[type="checkbox"] { width: auto; margin-right: 8px; }
         
         .stats {
             display: grid;
@@ -644,6 +4349,15 @@ ADMIN_HTML = '''
             box-shadow: 0 2px 10px rgba(0,0,0,0.1);
         }
         
+        .search {
+            width: 280px;
+            padding: 9px 12px;
+            border: 2px solid #e2e8f0;
+            border-radius: 8px;
+            font-size: 14px;
+            vertical-align: middle;
+        }
+        
         table {
             width: 100%;
             border-collapse: collapse;
@@ -703,6 +4417,16 @@ ADMIN_HTML = '''
                     <label for="url">URL to Access Lab (same for all users)</label>
                     <input type="url" id="url" placeholder="e.g., https://lab.example.com">
                 </div>
+                <div class="form-group">
+                    <label for="seatExpiry">Release Unconfirmed Seats After (minutes, 0 = never)</label>
+                    <input type="number" id="seatExpiry" min="0" placeholder="e.g., 15">
+                </div>
+                <div class="form-group">
+                    <label><input type="checkbox" id="waitlist">Put latecomers on a waitlist when the lab is full</label>
+                </div>
+                <div class="form-group">
+                    <label><input type="checkbox" id="perSeatPasswords">Generate a unique password for every seat (replaces the password above)</label>
+                </div>
                 <button type="submit" class="btn">💾 Save Configuration</button>
             </form>
         </div>
@@ -720,6 +4444,10 @@ ADMIN_HTML = '''
                 <h3>Remaining</h3>
                 <div class="value" id="remainingDisplay">-</div>
             </div>
+            <div class="stat-card">
+                <h3>Waitlist</h3>
+                <div class="value" id="waitlistDisplay">-</div>
+            </div>
         </div>
         
         <div class="assignments-section">
@@ -727,12 +4455,28 @@ ADMIN_HTML = '''
             <div style="margin: 20px 0;">
                 <button class="btn" onclick="loadAssignments()">🔄 Refresh</button>
                 <button class="btn btn-danger" onclick="resetAssignments()">⚠️ Reset Everything</button>
+                <a class="btn" href="{{ base }}/api/admin/assignments?format=csv">⬇️ Export CSV</a>
+                <a class="btn" href="{{ base }}/api/admin/credentials?format=csv">🔑 Export Credentials</a>
+                <input type="search" id="search" class="search" placeholder="Search email or username" oninput="searchAssignments()">
             </div>
             <div id="assignmentsTable"></div>
+            <button class="btn" id="loadMore" style="display: none; margin-top: 20px;" onclick="loadMoreAssignments()">Load more</button>
+        </div>
+        
+        <div class="assignments-section" id="waitlistSection" style="display: none; margin-top: 30px;">
+            <h2>Waitlist</h2>
+            <div id="waitlistTable"></div>
+        </div>
+        
+        <div class="assignments-section" style="margin-top: 30px;">
+            <h2>Archived Labs</h2>
+            <div id="archivesTable"></div>
         </div>
     </div>
 
     <script>
+        // URL prefix of this lab ('' for the default lab, '/lab/<slug>' otherwise)
+        const BASE = document.querySelector('meta[name="lab-base"]').content;
         function showMessage(text, type) {
             const msg = document.getElementById('message');
             msg.textContent = text;
@@ -740,45 +4484,214 @@ ADMIN_HTML = '''
             setTimeout(() => msg.classList.remove('show'), 5000);
         }
         
+        let shownWaitlisted = null;
+        
+        function showCounters(data) {
+            document.getElementById('maxUsersDisplay').textContent = data.max_users;
+            document.getElementById('assignedDisplay').textContent = data.total_assigned;
+            document.getElementById('remainingDisplay').textContent = data.slots_remaining;
+            document.getElementById('waitlistDisplay').textContent = data.waitlisted;
+            if (data.waitlisted !== shownWaitlisted) {
+                shownWaitlisted = data.waitlisted;
+                loadWaitlist();
+            }
+        }
+        
+        // Last ETag and payload per URL: unchanged data costs a bodyless 304
+        const etagCache = {};
+        
+        function fetchJson(url) {
+            const cached = etagCache[url];
+            const headers = cached ? { 'If-None-Match': cached.etag } : {};
+            return fetch(url, { headers: headers, cache: 'no-store' })
+                .then(r => {
+                    if (r.status === 304 && cached) return cached.data;
+                    return r.json().then(data => {
+                        const etag = r.headers.get('ETag');
+                        if (etag) etagCache[url] = { etag: etag, data: data };
+                        return data;
+                    });
+                });
+        }
+        
         function loadConfig() {
-            fetch('/api/config')
-                .then(r => r.json())
+            fetchJson(BASE + '/api/config')
                 .then(data => {
-                    document.getElementById('maxUsersDisplay').textContent = data.max_users;
-                    document.getElementById('assignedDisplay').textContent = data.total_assigned;
-                    document.getElementById('remainingDisplay').textContent = data.slots_remaining;
+                    showCounters(data);
+
+                    // Populate form fields
+                    document.getElementById('labName').value = data.lab_name || '';
+                    document.getElementById('maxUsers').value = data.max_users || '';
+                    document.getElementById('password').value = data.password || '';
+                    document.getElementById('url').value = data.url || '';
+                    document.getElementById('seatExpiry').value = data.seat_expiry_minutes || 0;
+                    document.getElementById('waitlist').checked = !!data.waitlist;
+                    document.getElementById('perSeatPasswords').checked = !!data.per_seat_passwords;
                 });
         }
         
+        const PAGE_SIZE = 200;
+        // The table needs neither the config (loadConfig has it) nor a username per row
+        const ASSIGNMENT_FIELDS = 'total_assigned,slots_remaining,waitlisted,assignments,next_cursor';
+        let nextCursor = null;
+        let searchTimer = null;
+        
+        function assignmentsUrl(cursor, limit) {
+            const params = new URLSearchParams({
+                cursor: cursor, limit: limit, format: 'columnar', fields: ASSIGNMENT_FIELDS
+            });
+            const q = document.getElementById('search').value.trim();
+            if (q) params.set('q', q);
+            return BASE + '/api/admin/assignments?' + params;
+        }
+        
         function loadAssignments() {
-            fetch('/api/admin/assignments')
-                .then(r => r.json())
+            // Reload as many rows as are shown so a refresh keeps the table length
+            const shown = document.querySelectorAll('#assignmentsTable tbody tr').length;
+            fetchJson(assignmentsUrl(0, Math.max(PAGE_SIZE, shown)))
                 .then(data => {
-                    document.getElementById('maxUsersDisplay').textContent = data.config.max_users;
-                    document.getElementById('assignedDisplay').textContent = data.total_assigned;
-                    document.getElementById('remainingDisplay').textContent = data.slots_remaining;
+                    showCounters({
+                        max_users: data.total_assigned + data.slots_remaining,
+                        total_assigned: data.total_assigned,
+                        slots_remaining: data.slots_remaining,
+                        waitlisted: data.waitlisted
+                    });
+                    renderAssignments(data, false);
+                });
+        }
+        
+        function loadMoreAssignments() {
+            fetchJson(assignmentsUrl(nextCursor, PAGE_SIZE))
+                .then(data => renderAssignments(data, true));
+        }
+        
+        function searchAssignments() {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(() => {
+                fetchJson(assignmentsUrl(0, PAGE_SIZE))
+                    .then(data => renderAssignments(data, false));
+            }, 250);
+        }
+        
+        // Rows of a ?format=columnar response, with the username the server left out
+        function assignmentRows(columns) {
+            return columns.user_number.map((n, i) => ({
+                user_number: n,
+                username: 'user' + String(n).padStart(3, '0'),
+                email: columns.email[i]
+            }));
+        }
+        
+        function renderAssignments(data, append) {
+            const container = document.getElementById('assignmentsTable');
+            const assignments = assignmentRows(data.assignments);
+            let tbody = container.querySelector('tbody');
 
-                    // Populate form fields
-                    document.getElementById('labName').value = data.config.lab_name || '';
-                    document.getElementById('maxUsers').value = data.config.max_users || '';
-                    document.getElementById('password').value = data.config.password || '';
-                    document.getElementById('url').value = data.config.url || '';
-
-                    let html = '<table><thead><tr><th>User #</th><th>Username</th><th>Email</th></tr></thead><tbody>';
-
-                    if (data.assignments.length === 0) {
-                        html = '<p style="color: #718096; padding: 20px; text-align: center;">No assignments yet</p>';
-                    } else {
-                        data.assignments.forEach(a => {
-                            html += `<tr><td>${a.user_number}</td><td>${a.username}</td><td>${a.email}</td></tr>`;
-                        });
-                        html += '</tbody></table>';
-                    }
+            if (!append || !tbody) {
+                if (assignments.length === 0) {
+                    const text = document.getElementById('search').value.trim() ? 'No matching assignments' : 'No assignments yet';
+                    container.innerHTML = `<p style="color: #718096; padding: 20px; text-align: center;">${text}</p>`;
+                    tbody = null;
+                } else {
+                    container.innerHTML = '<table><thead><tr><th>User #</th><th>Username</th><th>Email</th><th></th></tr></thead><tbody></tbody></table>';
+                    tbody = container.querySelector('tbody');
+                }
+            }
 
-                    document.getElementById('assignmentsTable').innerHTML = html;
+            // Build new rows off-document and attach them in one go
+            if (tbody) {
+                const rows = document.createDocumentFragment();
+                assignments.forEach(a => rows.appendChild(assignmentRow(a)));
+                tbody.appendChild(rows);
+            }
+
+            nextCursor = data.next_cursor;
+            document.getElementById('loadMore').style.display = nextCursor == null ? 'none' : 'inline-block';
+        }
+        
+        function assignmentRow(a) {
+            const tr = document.createElement('tr');
+            [a.user_number, a.username, a.email].forEach(value => {
+                const td = document.createElement('td');
+                td.textContent = value;
+                tr.appendChild(td);
+            });
+            tr.appendChild(releaseCell(a.email, 'Release', `Release ${a.username} (${a.email})? The seat goes to the next person in line.`));
+            return tr;
+        }
+        
+        function releaseCell(email, label, question) {
+            const td = document.createElement('td');
+            const button = document.createElement('button');
+            button.className = 'btn btn-danger btn-small';
+            button.textContent = label;
+            button.addEventListener('click', () => releaseSeat(email, question));
+            td.appendChild(button);
+            return td;
+        }
+        
+        function releaseSeat(email, question) {
+            if (!confirm(question)) return;
+            
+            fetch(BASE + '/api/admin/release', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ email: email })
+            })
+            .then(r => r.json())
+            .then(data => {
+                showMessage(data.message || data.error, data.error ? 'error' : 'success');
+                // With an event stream the table updates itself
+                if (!window.EventSource) loadAssignments();
+            });
+        }
+        
+        function loadWaitlist() {
+            fetch(BASE + '/api/admin/waitlist', { cache: 'no-store' })
+                .then(r => r.json())
+                .then(data => {
+                    const section = document.getElementById('waitlistSection');
+                    const container = document.getElementById('waitlistTable');
+                    section.style.display = data.waitlist.length ? 'block' : 'none';
+                    container.innerHTML = '<table><thead><tr><th>#</th><th>Email</th><th></th></tr></thead><tbody></tbody></table>';
+                    const tbody = container.querySelector('tbody');
+                    data.waitlist.forEach(w => {
+                        const tr = document.createElement('tr');
+                        [w.position, w.email].forEach(value => {
+                            const td = document.createElement('td');
+                            td.textContent = value;
+                            tr.appendChild(td);
+                        });
+                        tr.appendChild(releaseCell(w.email, 'Remove', `Remove ${w.email} from the waitlist?`));
+                        tbody.appendChild(tr);
+                    });
                 });
         }
         
+        function applyAssignmentEvent(event, assigned) {
+            // Search results are filtered server-side, so rerun the search
+            if (document.getElementById('search').value.trim()) {
+                searchAssignments();
+                return;
+            }
+            const tbody = document.querySelector('#assignmentsTable tbody');
+            if (!tbody) {
+                loadAssignments();
+                return;
+            }
+            const rows = Array.from(tbody.rows);
+            const index = rows.findIndex(tr => Number(tr.cells[0].textContent) >= event.user_number);
+            const existing = index >= 0 && Number(rows[index].cells[0].textContent) === event.user_number;
+            if (!assigned) {
+                if (existing) rows[index].remove();
+                return;
+            }
+            if (existing) rows[index].remove();
+            // Rows past the loaded pages arrive with "Load more"
+            if (index < 0 && nextCursor != null) return;
+            tbody.insertBefore(assignmentRow(event), index >= 0 ? rows[index] : null);
+        }
+        
         document.getElementById('configForm').addEventListener('submit', function(e) {
             e.preventDefault();
 
@@ -786,17 +4699,20 @@ ADMIN_HTML = '''
                 lab_name: document.getElementById('labName').value,
                 max_users: parseInt(document.getElementById('maxUsers').value),
                 password: document.getElementById('password').value,
-                url: document.getElementById('url').value
+                url: document.getElementById('url').value,
+                seat_expiry_minutes: parseFloat(document.getElementById('seatExpiry').value) || 0,
+                waitlist: document.getElementById('waitlist').checked,
+                per_seat_passwords: document.getElementById('perSeatPasswords').checked
             };
 
-            fetch('/api/config', {
+            fetch(BASE + '/api/config', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify(config)
             })
             .then(r => r.json())
             .then(data => {
-                showMessage(data.message, 'success');
+                showMessage(data.message || data.error, data.error ? 'error' : 'success');
                 loadConfig();
                 loadAssignments();
             })
@@ -806,9 +4722,9 @@ ADMIN_HTML = '''
         });
         
         function resetAssignments() {
-            if (!confirm('Reset EVERYTHING (config + assignments)? You will need to reconfigure the lab.')) return;
+            if (!confirm('Reset EVERYTHING (config + assignments)? You will need to reconfigure the lab. The current lab is archived and can be restored.')) return;
             
-            fetch('/api/admin/reset', { method: 'POST' })
+            fetch(BASE + '/api/admin/reset', { method: 'POST' })
                 .then(r => r.json())
                 .then(data => {
                     showMessage(data.message, 'success');
@@ -816,22 +4732,120 @@ ADMIN_HTML = '''
                     document.getElementById('maxUsers').value = '';
                     loadConfig();
                     loadAssignments();
+                    loadArchives();
+                });
+        }
+        
+        function loadArchives() {
+            fetch(BASE + '/api/admin/archives', { cache: 'no-store' })
+                .then(r => r.json())
+                .then(data => {
+                    const container = document.getElementById('archivesTable');
+                    if (data.archives.length === 0) {
+                        container.innerHTML = '<p style="color: #718096; padding: 20px; text-align: center;">No archived labs yet</p>';
+                        return;
+                    }
+                    container.innerHTML = '<table><thead><tr><th>Archived</th><th>Size</th><th></th></tr></thead><tbody></tbody></table>';
+                    const tbody = container.querySelector('tbody');
+                    data.archives.forEach(archive => {
+                        const tr = document.createElement('tr');
+                        [new Date(archive.archived_at).toLocaleString(), `${Math.ceil(archive.size / 1024)} KB`].forEach(value => {
+                            const td = document.createElement('td');
+                            td.textContent = value;
+                            tr.appendChild(td);
+                        });
+                        const td = document.createElement('td');
+                        const download = document.createElement('a');
+                        download.className = 'btn btn-small';
+                        download.href = `${BASE}/api/admin/archives/${encodeURIComponent(archive.name)}`;
+                        download.textContent = 'Download';
+                        const restore = document.createElement('button');
+                        restore.className = 'btn btn-small';
+                        restore.style.marginLeft = '8px';
+                        restore.textContent = 'Restore';
+                        restore.addEventListener('click', () => restoreArchive(archive.name));
+                        td.appendChild(download);
+                        td.appendChild(restore);
+                        tr.appendChild(td);
+                        tbody.appendChild(tr);
+                    });
+                });
+        }
+        
+        function restoreArchive(name) {
+            if (!confirm(`Restore ${name}? The current config and assignments are archived first.`)) return;
+            
+            fetch(`${BASE}/api/admin/archives/${encodeURIComponent(name)}/restore`, { method: 'POST' })
+                .then(r => r.json())
+                .then(data => {
+                    showMessage(data.message || data.error, data.error ? 'error' : 'success');
+                    loadConfig();
+                    loadAssignments();
+                    loadArchives();
                 });
         }
         
         // Load data on page load
         loadConfig();
         loadAssignments();
+        loadArchives();
         
-        // Auto-refresh every 30 seconds
-        setInterval(() => {
-            loadConfig();
-            loadAssignments();
-        }, 30000);
+        // Live updates pushed by the server; EventSource reconnects and
+        // resumes from the last event id on its own
+        if (window.EventSource) {
+            const events = new EventSource(BASE + '/api/admin/events');
+            events.addEventListener('counters', e => showCounters(JSON.parse(e.data)));
+            events.addEventListener('assign', e => applyAssignmentEvent(JSON.parse(e.data), true));
+            events.addEventListener('release', e => applyAssignmentEvent(JSON.parse(e.data), false));
+            ['config', 'reset', 'resync'].forEach(type => events.addEventListener(type, () => {
+                loadConfig();
+                loadAssignments();
+            }));
+        } else {
+            // Auto-refresh every 30 seconds
+            setInterval(() => {
+                loadConfig();
+                loadAssignments();
+            }, 30000);
+        }
     </script>
 </body>
 </html>
 '''
 
 if __name__ == '__main__':
-    app.run(host="127.0.0.1", port=int(os.environ["CDSW_READONLY_PORT"]))
\ No newline at end of file
+    if sys.argv[1:] == ['migrate']:
+        # python app.py migrate: import the JSON files into the SQLite database
+        imported = migrate_json_to_sqlite(SqliteStorage(DB_FILE))
+        print(f'Imported {imported} assignments into {DB_FILE}')
+        for slug in labs.slugs():
+            directory = os.path.join(LABS_DIR, slug)
+            path = os.path.join(directory, os.path.basename(DB_FILE))
+            imported = migrate_json_to_sqlite(SqliteStorage(path, directory), *_json_files(directory))
+            print(f'Imported {imported} assignments into {path}')
+        sys.exit(0)
+    if sys.argv[1:] == ['export-json']:
+        # python app.py export-json: print the default lab's assignments in the
+        # lab_assignments.json layout, whatever the backend or snapshot format
+        print(json.dumps(labs.default.storage.snapshot(), indent=2))
+        sys.exit(0)
+    if sys.argv[1:] == ['provision-replay']:
+        # python app.py provision-replay: resend the dead-letter file to the sink
+        if provisioner is None:
+            sys.exit('Set LAB_PROVISION_SINK first')
+        sent, failing = provisioner.replay()
+        print(f'Replayed {sent} entries, {failing} still failing (left in {PROVISION_DEAD_LETTER})')
+        sys.exit(1 if failing else 0)
+    if sys.argv[1:] == ['authority']:
+        # python app.py authority: serve the shared allocation state to
+        # replicas running with LAB_STORAGE=remote (also the local stand-in)
+        if STORAGE_BACKEND == 'remote':
+            sys.exit('The authority needs a local backend: LAB_STORAGE=json or sqlite')
+        app.config['LAB_AUTHORITY'] = True
+        authority = urllib.parse.urlsplit(AUTHORITY_URL)
+        if not AUTHORITY_TOKEN and not _is_loopback(authority.hostname):
+            sys.exit(f'The authority listens on {authority.hostname}: set LAB_AUTHORITY_TOKEN, '
+                     'or anyone who can reach it can read and change every lab')
+        serve(authority.port or 80, host=authority.hostname)
+        sys.exit(0)
+    serve(int(os.environ["CDSW_READONLY_PORT"]))
\ No newline at end of file
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+Sign-up burst benchmark for the Lab Username Portal
+
+Starts local portal instances (nothing leaves 127.0.0.1) and replays a room
+of attendees opening the portal at the same moment: each one loads the page,
+requests a username, asks again (a double-click or reload) and downloads the
+readme, while a few admins keep polling the dashboard.
+
+Reports p50/p95/p99 latency, throughput and KB per response (clients accept
+gzip, like browsers) per endpoint, and checks the final
+assignments for duplicate, inconsistent or lost usernames. Local instances
+are also timed from launch until they answer, cold and restarted over the
+data the burst left behind; a run fails when either takes longer than
+--startup-budget seconds.
+
+    python bench.py                                  # json + sqlite, dev server + gunicorn
+    python bench.py --attendees 500 --concurrency 100 --backends json,sqlite,remote
+    python bench.py --labs 24 --attendees 1200       # many labs on one instance
+    python bench.py --servers gunicorn,asgi --streams 500  # dashboards left open
+    python bench.py --url http://127.0.0.1:8100      # an instance you started yourself
+    python bench.py --attendees 50000 --startup-budget 0.8  # restart time of a very large lab
+"""
+
+import argparse
+import collections
+import gzip
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(HERE, 'app.py')
+README_PDF = os.path.join(HERE, 'lab-readme.pdf')
+AUTHORITY_TOKEN = 'bench'
+
+ENDPOINTS = ['GET /', 'POST /api/request-username', 'POST /api/request-username (repeat)',
+             'GET /download/readme', 'GET /api/config', 'GET /api/admin/assignments']
+# What the dashboard asks for when it refreshes its table
+DASHBOARD_QUERY = ('?cursor=0&limit=200&format=columnar'
+                   '&fields=total_assigned,slots_remaining,waitlisted,assignments,next_cursor')
+
+
+class Client:
+    """Keep-alive HTTP client, one per thread"""
+
+    def __init__(self, base_url, timeout=60):
+        url = urllib.parse.urlsplit(base_url)
+        self.host, self.port, self.timeout = url.hostname, url.port or 80, timeout
+        self.conn = None
+        # Response bytes as sent over the wire (before decompression)
+        self.received = 0
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip')
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                self.received += len(data)
+                if response.will_close:
+                    self.close()
+                if response.getheader('Content-Encoding') == 'gzip':
+                    data = gzip.decompress(data)
+                return response.status, data
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class Recorder:
+    """Collects per-endpoint latencies and error counts from all threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.received = collections.Counter()
+
+    def timed(self, client, name, method, path, body=None, ok=(200,), headers=None):
+        start = time.perf_counter()
+        received = client.received
+        try:
+            status, data = client.request(method, path, body, headers)
+        except (http.client.HTTPException, OSError):
+            status, data = None, b''
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies[name].append(elapsed)
+            self.received[name] += client.received - received
+            if status not in ok:
+                self.errors[name] += 1
+        return status, data
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(base_url, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    client = Client(base_url, timeout=2)
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'server exited with status {proc.returncode}')
+        try:
+            if client.request('GET', '/api/config')[0] == 200:
+                return
+        except OSError:
+            time.sleep(0.01)
+    raise RuntimeError(f'server at {base_url} did not come up')
+
+
+class LocalServer:
+    """A throwaway portal (and authority, for the remote backend) in a temp dir"""
+
+    def __init__(self, backend, server, workers, threads):
+        self.backend, self.server = backend, server
+        self.workers = workers if server == 'gunicorn' else 1
+        self.mode = 'asgi' if server == 'asgi' else 'wsgi'
+        self.threads = threads
+        self.procs = []
+
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp(prefix='lab-bench-')
+        if os.path.exists(README_PDF):
+            shutil.copy(README_PDF, self.dir)
+        env = dict(os.environ, LAB_README_DIR=self.dir, LAB_LOG_LEVEL='WARNING',
+                   LAB_WORKERS=str(self.workers), LAB_THREADS=str(self.threads),
+                   LAB_SERVER=self.mode,
+                   LAB_STORAGE=self.backend, LAB_AUTHORITY_TOKEN=AUTHORITY_TOKEN)
+        try:
+            if self.backend == 'remote':
+                authority_port = free_port()
+                authority_env = dict(env, LAB_STORAGE='json',
+                                     LAB_AUTHORITY_URL=f'http://127.0.0.1:{authority_port}')
+                self._start(['authority'], authority_env, authority_port)
+                env['LAB_AUTHORITY_URL'] = authority_env['LAB_AUTHORITY_URL']
+            port = free_port()
+            self.url = f'http://127.0.0.1:{port}'
+            self.portal_env = dict(env, CDSW_READONLY_PORT=str(port))
+            self.startup = self._start([], self.portal_env, port)
+        except Exception:
+            self.__exit__()
+            raise
+        return self
+
+    def _start(self, args, env, port):
+        """Launch app.py; returns the seconds until it answered its first request"""
+        started = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, APP, *args], cwd=self.dir, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.procs.append(proc)
+        wait_ready(f'http://127.0.0.1:{port}', proc)
+        return time.perf_counter() - started
+
+    def restart(self):
+        """Stop the portal and start it again on its data (an engine restart); returns seconds"""
+        proc = self.procs.pop()
+        proc.terminate()
+        proc.wait(10)
+        return self._start([], self.portal_env, int(self.portal_env['CDSW_READONLY_PORT']))
+
+    def __exit__(self, *exc):
+        for proc in reversed(self.procs):
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def open_streams(base_url, paths):
+    """Open idle event-stream connections (dashboards left open) and never read them"""
+    url = urllib.parse.urlsplit(base_url)
+    streams = []
+    for path in paths:
+        sock = socket.create_connection((url.hostname, url.port or 80))
+        sock.sendall(f'GET {path} HTTP/1.1\r\nHost: {url.netloc}\r\n'
+                     f'Accept: text/event-stream\r\n\r\n'.encode())
+        streams.append(sock)
+    # Give the server a moment to accept them all before the burst starts
+    deadline = time.monotonic() + 10
+    for sock in streams:
+        sock.settimeout(max(deadline - time.monotonic(), 0.01))
+        try:
+            sock.recv(65536)
+        except OSError:
+            pass
+    return streams
+
+
+def run_burst(base_url, attendees, concurrency, seats, admins, labs=1, streams=0):
+    """Drive one sign-up burst and return the measurements
+
+    With labs > 1 the attendees are spread over that many labs
+    (/lab/bench-N/), each with seats seats and its own admins. streams
+    event-stream connections are held open (idle) throughout.
+    """
+    recorder = Recorder()
+    setup = Client(base_url)
+    prefixes = [''] if labs == 1 else [f'/lab/bench-{k}' for k in range(labs)]
+    for prefix in prefixes:
+        if prefix:
+            setup.request('POST', '/api/labs', {'slug': prefix.rsplit('/', 1)[1]})
+        status, _ = setup.request('POST', f'{prefix}/api/admin/reset')
+        if status != 200:
+            raise RuntimeError(f'reset failed with status {status}')
+        setup.request('POST', f'{prefix}/api/config',
+                      {'lab_name': 'Benchmark Lab', 'max_users': seats,
+                       'password': 'bench', 'url': 'http://lab.invalid'})
+
+    local = threading.local()
+    got = {}
+    mismatched = []
+    results_lock = threading.Lock()
+    full = 400 if -(-attendees // labs) > seats else None
+
+    def client():
+        if not hasattr(local, 'client'):
+            local.client = Client(base_url)
+        return local.client
+
+    def attendee(i):
+        c = client()
+        prefix = prefixes[i % labs]
+        email = f'attendee{i:06d}@bench.example.com'
+        recorder.timed(c, 'GET /', 'GET', f'{prefix}/')
+        first = second = None
+        ok = (200, full)
+        status, data = recorder.timed(c, 'POST /api/request-username', 'POST',
+                                      f'{prefix}/api/request-username', {'email': email}, ok)
+        if status == 200:
+            first = json.loads(data)['username']
+        status, data = recorder.timed(c, 'POST /api/request-username (repeat)', 'POST',
+                                      f'{prefix}/api/request-username', {'email': email}, ok)
+        if status == 200:
+            second = json.loads(data)['username']
+        recorder.timed(c, 'GET /download/readme', 'GET', f'{prefix}/download/readme',
+                       ok=(200, 404))
+        with results_lock:
+            if first is not None:
+                got[prefix, email] = first
+            if first != second:
+                mismatched.append(email)
+
+    done = threading.Event()
+
+    def admin(prefix):
+        c = Client(base_url)
+        while not done.is_set():
+            recorder.timed(c, 'GET /api/config', 'GET', f'{prefix}/api/config')
+            recorder.timed(c, 'GET /api/admin/assignments', 'GET',
+                           f'{prefix}/api/admin/assignments{DASHBOARD_QUERY}')
+        c.close()
+
+    idle = open_streams(base_url, [f'{prefixes[k % labs]}/api/admin/events'
+                                   for k in range(streams)])
+    admin_threads = [threading.Thread(target=admin, args=(prefix,), daemon=True)
+                     for prefix in prefixes for _ in range(admins)]
+    for thread in admin_threads:
+        thread.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(attendee, range(attendees)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    for thread in admin_threads:
+        thread.join()
+    for sock in idle:
+        sock.close()
+
+    final = {}
+    for prefix in prefixes:
+        status, data = setup.request('GET', f'{prefix}/api/admin/assignments?format=ndjson')
+        for line in data.decode().splitlines():
+            row = json.loads(line)
+            final[prefix, row['email']] = row['username']
+    setup.close()
+
+    # Usernames are unique within a lab
+    by_username = collections.Counter((prefix, username) for (prefix, _), username in got.items())
+    return {
+        'attendees': attendees,
+        'labs': labs,
+        'streams': streams,
+        'seats': seats,
+        'elapsed': elapsed,
+        'signups_per_sec': attendees / elapsed if elapsed else 0.0,
+        'endpoints': {name: {'count': len(values),
+                             'errors': recorder.errors[name],
+                             'rps': len(values) / elapsed if elapsed else 0.0,
+                             'kb': recorder.received[name] / len(values) / 1024,
+                             'p50_ms': percentile(values, 50) * 1000,
+                             'p95_ms': percentile(values, 95) * 1000,
+                             'p99_ms': percentile(values, 99) * 1000}
+                      for name, values in recorder.latencies.items()},
+        'assigned': len(got),
+        'expected': sum(min(len(range(k, attendees, labs)), seats) for k in range(labs)),
+        'duplicates': sum(n - 1 for n in by_username.values() if n > 1),
+        'inconsistent': len(mismatched),
+        'lost': sum(1 for key, username in got.items() if final.get(key) != username),
+        'unexpected': len(set(final) - set(got)),
+    }
+
+
+def report(label, result, out=sys.stdout):
+    labs = f'{result["labs"]} labs x ' if result['labs'] > 1 else ''
+    streams = f', {result["streams"]} idle streams' if result['streams'] else ''
+    print(f'\n== {label}: {result["attendees"]} attendees, {labs}{result["seats"]} seats{streams}, '
+          f'{result["elapsed"]:.2f}s ({result["signups_per_sec"]:.0f} sign-ups/s)', file=out)
+    print(f'  {"endpoint":<40}{"count":>7}{"err":>6}{"req/s":>9}'
+          f'{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"KB":>8}', file=out)
+    for name in ENDPOINTS:
+        stats = result['endpoints'].get(name)
+        if stats:
+            print(f'  {name:<40}{stats["count"]:>7}{stats["errors"]:>6}{stats["rps"]:>9.0f}'
+                  f'{stats["p50_ms"]:>9.1f}{stats["p95_ms"]:>9.1f}{stats["p99_ms"]:>9.1f}'
+                  f'{stats["kb"]:>8.1f}', file=out)
+    print(f'  assigned {result["assigned"]}/{result["expected"]}, '
+          f'duplicates {result["duplicates"]}, inconsistent {result["inconsistent"]}, '
+          f'lost {result["lost"]}, unexpected {result["unexpected"]}', file=out)
+    if 'startup_ms' in result:
+        print(f'  ready {result["startup_ms"]:.0f} ms after launch, '
+              f'{result["restart_ms"]:.0f} ms after a restart', file=out)
+
+
+def healthy(result, startup_budget=None):
+    if startup_budget is not None and 'startup_ms' in result and (
+            max(result['startup_ms'], result['restart_ms']) > startup_budget * 1000):
+        return False
+    return (result['assigned'] == result['expected'] and not result['duplicates']
+            and not result['inconsistent'] and not result['lost'] and not result['unexpected'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--attendees', type=int, default=150)
+    parser.add_argument('--concurrency', type=int, default=50, help='attendees signing up at once')
+    parser.add_argument('--seats', type=int, help='max_users per lab (default: attendees per lab)')
+    parser.add_argument('--admins', type=int, default=2, help='dashboards polling during the burst')
+    parser.add_argument('--labs', type=int, default=1,
+                        help='spread attendees over this many labs (/lab/bench-N/)')
+    parser.add_argument('--backends', default='json,sqlite', help='comma list of json, sqlite, remote')
+    parser.add_argument('--streams', type=int, default=0,
+                        help='idle event-stream connections held open during the burst')
+    parser.add_argument('--servers', default='dev,gunicorn',
+                        help='comma list of dev, gunicorn, asgi (uvicorn, one process)')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=8, help='threads per worker')
+    parser.add_argument('--url', help='benchmark a running instance instead (its data is reset!)')
+    parser.add_argument('--json', metavar='FILE', help='also write the results as JSON')
+    parser.add_argument('--startup-budget', type=float, default=1.0,
+                        help='seconds a local instance may take to answer after launch or restart')
+    args = parser.parse_args(argv)
+    seats = args.seats or -(-args.attendees // args.labs)
+
+    results = {}
+    if args.url:
+        results[args.url] = run_burst(args.url, args.attendees, args.concurrency, seats,
+                                      args.admins, args.labs, args.streams)
+        report(args.url, results[args.url])
+    else:
+        for server in args.servers.split(','):
+            for backend in args.backends.split(','):
+                label = f'{backend}/{server}'
+                if server == 'gunicorn':
+                    label += f' x{args.workers}'
+                try:
+                    with LocalServer(backend, server, args.workers, args.threads) as local:
+                        results[label] = run_burst(local.url, args.attendees, args.concurrency,
+                                                   seats, args.admins, args.labs, args.streams)
+                        results[label]['startup_ms'] = local.startup * 1000
+                        results[label]['restart_ms'] = local.restart() * 1000
+                except RuntimeError as e:
+                    print(f'\n== {label}: skipped ({e})')
+                    continue
+                report(label, results[label])
+
+    if len(results) > 1:
+        print(f'\n{"configuration":<28}{"sign-ups/s":>11}{"p95 ms":>9}{"p99 ms":>9}'
+              f'{"start ms":>10}{"restart ms":>12}  ok')
+        for label, result in results.items():
+            stats = result['endpoints']['POST /api/request-username']
+            startup = (f'{result["startup_ms"]:>10.0f}{result["restart_ms"]:>12.0f}'
+                       if 'startup_ms' in result else f'{"-":>10}{"-":>12}')
+            ok = healthy(result, args.startup_budget)
+            print(f'{label:<28}{result["signups_per_sec"]:>11.0f}{stats["p95_ms"]:>9.1f}'
+                  f'{stats["p99_ms"]:>9.1f}{startup}  {"yes" if ok else "NO"}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if results and all(healthy(result, args.startup_budget)
+                                for result in results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('LAB_FSYNC', '0')
+
+
+@pytest.fixture
+def open_store(tmp_path):
+    """Open (or reopen) a JSON-backed store in tmp_path"""
+    import app
+
+    stores = []
+
+    def open_store():
+        store = app.JsonStorage(str(tmp_path / app.CONFIG_FILE),
+                                str(tmp_path / app.ASSIGNMENTS_FILE),
+                                str(tmp_path / app.ASSIGNMENTS_JOURNAL),
+                                str(tmp_path / app.ASSIGNMENTS_LOCK))
+        stores.append(store)
+        return store
+
+    yield open_store
+    for store in stores:
+        store.close()
+
+
+@pytest.fixture
+def open_sqlite(tmp_path):
+    """Open (or reopen) a SQLite store in tmp_path, importing any JSON files there"""
+    import app
+
+    stores = []
+
+    def open_sqlite():
+        store = app.SqliteStorage(str(tmp_path / app.DB_FILE), str(tmp_path))
+        stores.append(store)
+        return store
+
+    yield open_sqlite
+    for store in stores:
+        store.close()
@@ -0,0 +1,257 @@
+import gzip
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, 'labs', app.Labs())
+    client = app.app.test_client()
+    client.post('/api/config', json={'lab_name': 'Test Lab', 'max_users': 20})
+    yield client
+    for lab in app.labs.loaded():
+        lab.storage.close()
+
+
+@pytest.mark.parametrize('body', [{'emails': 'a@x.com,b@x.com'}, {'emails': None}, 5, 'a@x.com'])
+def test_bulk_register_rejects_json_that_is_not_a_list(client, body):
+    response = client.post('/api/admin/bulk-register', json=body)
+    assert response.status_code == 400
+    assert response.json == {'error': 'emails must be a list'}
+    assert client.get('/api/config').json['total_assigned'] == 0
+
+
+def test_bulk_register_takes_a_list(client):
+    response = client.post('/api/admin/bulk-register', json={'emails': ['a@x.com', 'B@x.com ']})
+    assert response.status_code == 200
+    assert client.get('/api/config').json['total_assigned'] == 2
+
+
+def test_seats_promoted_during_a_sign_up_are_provisioned(client, monkeypatch):
+    provisioned = []
+    monkeypatch.setattr(app, 'provision',
+                        lambda lab, op, pairs, config=None: provisioned.extend(
+                            (op, email, n) for email, n in pairs))
+    client.post('/api/config', json={'max_users': 1, 'waitlist': True})
+    client.post('/api/request-username', json={'email': 'a@x.com'})
+    assert client.post('/api/request-username', json={'email': 'b@x.com'}).status_code == 202
+    # Freed by another worker without promoting anyone
+    app.labs.default.storage.release('a@x.com')
+
+    response = client.post('/api/request-username', json={'email': 'c@x.com'})
+    assert response.json['position'] == 1
+    assert provisioned == [('assign', 'a@x.com', 1), ('assign', 'b@x.com', 1)]
+
+
+@pytest.mark.parametrize('release', ['admin', 'expiry'])
+def test_a_recycled_seat_gets_a_new_password(client, monkeypatch, release):
+    provisioned = []
+    monkeypatch.setattr(app, 'provision',
+                        lambda lab, op, pairs, config=None: provisioned.extend(
+                            (op, email, n, config and app.seat_password(config, n))
+                            for email, n in pairs))
+    client.post('/api/config', json={'max_users': 1, 'per_seat_passwords': True,
+                                     'seat_expiry_minutes': 1})
+    first = client.post('/api/request-username', json={'email': 'a@x.com'}).json
+    if release == 'admin':
+        client.post('/api/admin/release', json={'email': 'a@x.com'})
+    else:
+        monkeypatch.setattr(app.time, 'time', lambda now=app.time.time(): now + 120)
+
+    second = client.post('/api/request-username', json={'email': 'b@x.com'}).json
+    assert second['user_number'] == first['user_number'] == 1
+    assert second['password'] != first['password']
+    assert provisioned[1:] == [('release', 'a@x.com', 1, second['password']),
+                               ('assign', 'b@x.com', 1, second['password'])]
+
+
+def test_labs_are_only_created_by_a_write(client):
+    assert client.get('/lab/new-lab/admin').status_code == 404
+    assert client.get('/lab/new-lab/api/config').status_code == 404
+    assert client.get('/api/labs').json['labs'] == []
+
+    assert client.post('/api/labs', json={'slug': 'Bad Slug'}).status_code == 400
+    assert client.post('/api/labs', json={'slug': 'new-lab'}).status_code == 201
+    assert client.post('/api/labs', json={'slug': 'new-lab'}).status_code == 200
+    assert client.get('/lab/new-lab/admin').status_code == 200
+
+    response = client.post('/lab/other-lab/api/config', json={'max_users': 5})
+    assert response.status_code == 200
+    assert [lab['slug'] for lab in client.get('/api/labs').json['labs']] == ['new-lab', 'other-lab']
+
+
+@pytest.fixture
+def readme(client, tmp_path):
+    """A lab with a small readme PDF; returns its bytes"""
+    client.post('/api/labs', json={'slug': 'pdf-lab'})
+    data = bytes(range(256)) * 40
+    (tmp_path / app.LABS_DIR / 'pdf-lab' / app.README_NAME).write_bytes(data)
+    return data
+
+
+def test_readme_is_served_whole_and_revalidated(client, readme):
+    response = client.get('/lab/pdf-lab/download/readme')
+    assert response.status_code == 200
+    assert response.data == readme
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    etag = response.headers['ETag']
+
+    response = client.get('/lab/pdf-lab/download/readme', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_readme_ranges(client, readme):
+    response = client.get('/lab/pdf-lab/download/readme', headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.data == readme[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(readme)}'
+    etag = response.headers['ETag']
+
+    response = client.get('/lab/pdf-lab/download/readme',
+                          headers={'Range': f'bytes={len(readme)}-'})
+    assert response.status_code == 416
+
+    # If-Range: the range only applies while the client's copy is current
+    response = client.get('/lab/pdf-lab/download/readme',
+                          headers={'Range': 'bytes=0-9', 'If-Range': etag})
+    assert (response.status_code, response.data) == (206, readme[:10])
+    response = client.get('/lab/pdf-lab/download/readme',
+                          headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert (response.status_code, response.data) == (200, readme)
+
+
+def test_readme_goes_to_the_servers_file_wrapper_from_disk(client, readme):
+    wrapped = []
+
+    def file_wrapper(file, block_size=8192):
+        wrapped.append(file)
+        return iter(lambda: file.read(block_size), b'')
+
+    response = client.get('/lab/pdf-lab/download/readme', headers={'Range': 'bytes=10-19'},
+                          environ_overrides={'wsgi.file_wrapper': file_wrapper})
+    assert (response.status_code, response.data) == (206, readme[10:20])
+    assert [type(file) for file in wrapped] == [app._TimedFileIO]
+
+
+def test_sign_ups_past_the_ip_limit_get_429_with_retry_after(client, monkeypatch):
+    monkeypatch.setattr(app, 'ip_limiter', app.TokenBuckets(2, 60))
+    statuses = [client.post('/api/request-username', json={'email': f'{i}@x.com'},
+                            environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code
+                for i in range(3)]
+    assert statuses == [200, 200, 429]
+    response = client.post('/api/request-username', json={'email': '9@x.com'},
+                           environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    assert response.status_code == 429
+    assert 1 <= int(response.headers['Retry-After']) <= 30
+    # Other addresses have their own buckets
+    assert client.post('/api/request-username', json={'email': '9@x.com'},
+                       environ_base={'REMOTE_ADDR': '10.0.0.2'}).status_code == 200
+
+
+def test_token_buckets_evict_the_least_recently_seen_key(monkeypatch):
+    buckets = app.TokenBuckets(1, 60, max_keys=2)
+    assert [buckets.take(key) for key in ('a', 'b')] == [0, 0]
+    assert buckets.take('a') > 0  # a is now the most recently seen
+    assert buckets.take('c') == 0
+    assert len(buckets) == 2
+    assert buckets.take('a') > 0
+    assert buckets.take('b') == 0  # evicted, so it starts over with a full bucket
+
+
+def test_allowed_domains_include_their_subdomains(client, monkeypatch):
+    monkeypatch.setattr(app, 'ALLOWED_DOMAINS', {'x.com'})
+    for email, status in [('a@x.com', 200), ('b@eu.x.com', 200),
+                          ('c@evilx.com', 403), ('d@x.com.evil.org', 403)]:
+        assert client.post('/api/request-username', json={'email': email}).status_code == status
+
+
+@pytest.mark.parametrize('hops, forwarded, expected', [
+    (0, '1.1.1.1', '10.0.0.1'),
+    (1, '1.1.1.1, 2.2.2.2', '2.2.2.2'),
+    (2, 'spoofed, 1.1.1.1, 2.2.2.2', '1.1.1.1'),
+    (2, '2.2.2.2', '10.0.0.1'),
+])
+def test_client_ip_trusts_only_the_configured_proxy_hops(monkeypatch, hops, forwarded, expected):
+    monkeypatch.setattr(app, 'PROXY_HOPS', hops)
+    environ = {'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': forwarded}
+    assert app.client_ip(environ) == expected
+
+
+@pytest.fixture
+def roster(client, monkeypatch):
+    """50 seats taken, so the assignments response is worth compressing"""
+    monkeypatch.setattr(app, '_compressed', type(app._compressed)())
+    client.post('/api/config', json={'max_users': 100})
+    emails = [f'attendee{i:02d}@x.com' for i in range(50)]
+    client.post('/api/admin/bulk-register', json={'emails': emails})
+    return emails
+
+
+@pytest.mark.parametrize('accept, coding', [
+    ('gzip', 'gzip'), ('br;q=1, gzip;q=0.5', 'br'), ('gzip;q=1, br;q=0.1', 'gzip'),
+    ('identity', None), ('', None)])
+def test_responses_are_compressed_in_the_preferred_coding(client, roster, accept, coding):
+    decode = {'gzip': gzip.decompress, None: bytes}
+    if coding == 'br':
+        decode['br'] = pytest.importorskip('brotli').decompress
+    plain = client.get('/api/admin/assignments')
+    response = client.get('/api/admin/assignments', headers={'Accept-Encoding': accept})
+    assert 'Accept-Encoding' in response.vary
+    assert response.content_encoding == coding
+    assert decode[coding](response.data) == plain.data
+    if coding:
+        assert len(response.data) < len(plain.data)
+        assert response.headers['ETag'] == plain.headers['ETag'][:-1] + f'-{coding}"'
+
+
+def test_a_compressed_etag_revalidates(client, roster):
+    response = client.get('/api/admin/assignments', headers={'Accept-Encoding': 'gzip'})
+    etag = response.headers['ETag']
+    assert etag.endswith('-gzip"')
+    response = client.get('/api/admin/assignments',
+                          headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert 'Accept-Encoding' in response.vary
+
+    client.post('/api/request-username', json={'email': 'late@x.com'})
+    response = client.get('/api/admin/assignments',
+                          headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 200
+
+
+def test_small_responses_are_not_compressed(client):
+    response = client.get('/api/config', headers={'Accept-Encoding': 'gzip, br'})
+    assert len(response.data) < app.COMPRESS_MIN_SIZE
+    assert response.content_encoding is None
+    assert 'Accept-Encoding' in response.vary
+
+
+def test_columnar_assignments_and_selected_fields(client, roster):
+    rows = client.get('/api/admin/assignments').json['assignments']
+    response = client.get('/api/admin/assignments?format=columnar&fields=assignments,total_assigned')
+    assert response.json == {
+        'total_assigned': 50,
+        'assignments': {'user_number': [row['user_number'] for row in rows],
+                        'email': [row['email'] for row in rows]}}
+    assert len(response.data) < len(client.get('/api/admin/assignments').data)
+    assert client.get('/api/config?fields=max_users, slots_remaining').json == {
+        'max_users': 100, 'slots_remaining': 50}
+
+
+@pytest.mark.parametrize('body, error', [
+    ({'emails': ['a@x.com', 5]}, 'emails must be strings'),
+    ({'email': ['a@x.com']}, 'emails must be strings'),
+    ({'emails': 'a@x.com'}, 'emails must be a list'),
+    (['a@x.com'], 'emails must be a list'),
+    ({'email': None}, 'Email is required'),
+])
+def test_release_rejects_bodies_that_are_not_emails(client, body, error):
+    client.post('/api/request-username', json={'email': 'a@x.com'})
+    response = client.post('/api/admin/release', json=body)
+    assert (response.status_code, response.json) == (400, {'error': error})
+    assert client.get('/api/config').json['total_assigned'] == 1
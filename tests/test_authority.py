@@ -0,0 +1,23 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app
+from conftest import ROOT
+
+
+@pytest.mark.parametrize('host, loopback', [
+    ('127.0.0.1', True), ('127.0.0.2', True), ('::1', True), ('localhost', True),
+    ('0.0.0.0', False), ('10.0.0.5', False), ('authority-host', False)])
+def test_is_loopback(host, loopback):
+    assert app._is_loopback(host) is loopback
+
+
+def test_authority_without_a_token_refuses_to_listen_beyond_loopback(tmp_path):
+    env = dict(os.environ, LAB_AUTHORITY_URL='http://0.0.0.0:8765', LAB_AUTHORITY_TOKEN='')
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'app.py'), 'authority'],
+                            cwd=tmp_path, env=env, capture_output=True, text=True, timeout=30)
+    assert result.returncode == 1
+    assert 'set LAB_AUTHORITY_TOKEN' in result.stderr
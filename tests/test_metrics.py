@@ -0,0 +1,45 @@
+import json
+
+import app
+
+
+def other_worker(directory, pid, requests, labs_loaded):
+    """Write the metrics file of another worker that answered requests GET /api/config"""
+    metrics = {metric.name: [] for metric in app.METRICS}
+    metrics[app.REQUESTS.name] = [[['/api/config', 'GET', 200], requests]]
+    metrics[app.REQUEST_SECONDS.name] = [[['/api/config'], [[requests] + [0] * len(
+        app.LATENCY_BUCKETS), 0.25]]]
+    state = {'metrics': metrics, 'gauges': {app.LABS_LOADED.name: [[[], labs_loaded]]}}
+    (directory / f'{pid}.json').write_text(json.dumps(state))
+
+
+def scrape(client, name):
+    lines = client.get('/metrics').get_data(as_text=True).splitlines()
+    return [line for line in lines if line.startswith(name)]
+
+
+def test_metrics_are_summed_over_the_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, 'labs', app.Labs())
+    shared = app.SharedMetrics()
+    shared.directory = str(tmp_path)
+    monkeypatch.setattr(app, 'shared_metrics', shared)
+    for metric in (app.REQUESTS, app.REQUEST_SECONDS):
+        monkeypatch.setattr(metric, '_series', {})
+    other_worker(tmp_path, 1001, 5, 2)
+    other_worker(tmp_path, 1002, 7, 1)
+
+    client = app.app.test_client()
+    for _ in range(3):
+        client.get('/api/config')
+    assert scrape(client, 'lab_http_requests_total{route="/api/config"') == [
+        'lab_http_requests_total{route="/api/config",method="GET",status="200"} 15']
+    assert 'lab_http_request_duration_seconds_count{route="/api/config"} 15' in scrape(
+        client, 'lab_http_request_duration_seconds_count')
+    assert scrape(client, 'lab_labs_loaded') == ['lab_labs_loaded 4']
+
+    # A worker that exited keeps its counts but no longer holds labs
+    shared.retire(1001)
+    assert scrape(client, 'lab_labs_loaded') == ['lab_labs_loaded 2']
+    assert scrape(client, 'lab_http_requests_total{route="/api/config"') == [
+        'lab_http_requests_total{route="/api/config",method="GET",status="200"} 15']
@@ -0,0 +1,83 @@
+import json
+import time
+
+import pytest
+
+import app
+
+
+def entry(op, user_num, email=None, lab=''):
+    return {'op': op, 'lab': lab, 'email': email or f'user{user_num}@x.com',
+            'user_number': user_num, 'username': app.username_for(user_num)}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def dead_letter(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'PROVISION_BATCH_WAIT', 0.05)
+    # Retry at once instead of backing off for seconds
+    monkeypatch.setattr(app.random, 'uniform', lambda a, b: 0)
+    return tmp_path / 'provision_failed.ndjson'
+
+
+def read_lines(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_coalesce_keeps_the_latest_change_per_account():
+    first = entry('assign', 1, 'a@x.com')
+    released = entry('release', 1, 'a@x.com')
+    other_lab = entry('assign', 1, 'a@x.com', lab='other')
+    second = entry('assign', 2)
+    reassigned = entry('assign', 1, 'b@x.com')
+    assert app.coalesce([first, released, other_lab, second, reassigned]) == [
+        other_lab, second, reassigned]
+
+
+def test_queued_entries_go_out_in_coalesced_batches(dead_letter, monkeypatch):
+    monkeypatch.setattr(app, 'PROVISION_BATCH', 3)
+    sink = app.make_sink('fake')
+    provisioner = app.Provisioner(sink, str(dead_letter))
+    provisioner.submit([entry('assign', 1), entry('release', 1), entry('assign', 2),
+                        entry('assign', 3), entry('assign', 4)])
+    wait_for(lambda: len(provisioner) == 0 and sum(map(len, sink.batches)) == 4)
+    assert [[(e['op'], e['user_number']) for e in batch] for batch in sink.batches] == [
+        [('release', 1), ('assign', 2)], [('assign', 3), ('assign', 4)]]
+    assert not dead_letter.exists()
+
+
+def test_failing_batches_are_retried_then_dead_lettered_and_replayed(dead_letter, monkeypatch):
+    monkeypatch.setattr(app, 'PROVISION_RETRIES', 2)
+    sink = app.make_sink('fake:1')
+    sends = []
+    send = sink.send
+    monkeypatch.setattr(sink, 'send', lambda entries: (sends.append(entries), send(entries)))
+    provisioner = app.Provisioner(sink, str(dead_letter))
+    batch = [entry('assign', 1), entry('assign', 2)]
+    provisioner.submit(batch)
+    wait_for(lambda: dead_letter.exists() and len(provisioner) == 0)
+    assert len(sends) == 3
+    assert read_lines(dead_letter) == batch
+    assert provisioner.replay() == (0, 2)
+    assert read_lines(dead_letter) == batch
+
+    sink.failure_rate = 0
+    assert provisioner.replay() == (2, 0)
+    assert sink.batches == [batch]
+    assert not dead_letter.exists()
+    assert provisioner.replay() == (0, 0)
+
+
+def test_entries_that_overflow_the_queue_are_dead_lettered(dead_letter, monkeypatch):
+    monkeypatch.setattr(app, 'PROVISION_QUEUE', 2)
+    provisioner = app.Provisioner(app.make_sink('fake'), str(dead_letter))
+    provisioner._thread = object()  # a worker that never drains the queue
+    provisioner.submit([entry('assign', n) for n in range(1, 5)])
+    assert len(provisioner) == 2
+    assert [e['user_number'] for e in read_lines(dead_letter)] == [3, 4]
@@ -0,0 +1,47 @@
+"""Startup-time budget: a restarted engine must answer attendees quickly"""
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+from conftest import ROOT
+
+# Seconds from launch until the portal is ready (bench.py --startup-budget)
+STARTUP_BUDGET = float(os.environ.get('LAB_STARTUP_BUDGET', '1.0'))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_import_and_warm_up_fit_the_budget(tmp_path):
+    code = ('import time; started = time.perf_counter(); import app; app.warm_up(); '
+            'print(time.perf_counter() - started)')
+    result = subprocess.run([sys.executable, '-c', code], cwd=tmp_path, capture_output=True,
+                            text=True, check=True, env=dict(os.environ, PYTHONPATH=ROOT))
+    assert float(result.stdout) < STARTUP_BUDGET
+
+
+def test_first_answer_after_launch_fits_the_budget(tmp_path):
+    port = free_port()
+    env = dict(os.environ, CDSW_READONLY_PORT=str(port), LAB_README_DIR=str(tmp_path))
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'app.py')], cwd=tmp_path, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            assert proc.poll() is None, 'the portal exited'
+            elapsed = time.perf_counter() - started
+            assert elapsed < STARTUP_BUDGET, f'no answer within {STARTUP_BUDGET}s'
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/api/config', timeout=1):
+                    break
+            except OSError:
+                time.sleep(0.01)
+    finally:
+        proc.terminate()
+        proc.wait(10)
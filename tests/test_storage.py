@@ -0,0 +1,258 @@
+import random
+
+import pytest
+
+import app
+
+
+def damage(path, data):
+    # A new file: .prev may be a hard link to the old one
+    path.unlink()
+    path.write_bytes(data)
+
+
+def test_damaged_snapshot_after_reset_recovers_the_new_lab(open_store, tmp_path):
+    store = open_store()
+    for i in range(1, 5):
+        store.allocate(f'old{i}@x.com', 10)
+    store.compact()
+    store.archive_and_reset()
+    store.allocate('new1@x.com', 10)
+    store.allocate('new2@x.com', 10)
+
+    # A crash (no close, so no final compaction) that left a damaged snapshot
+    damage(tmp_path / app.ASSIGNMENTS_FILE, b'{"email_to_user": {"new1')
+    store = open_store()
+    assert store.snapshot()['email_to_user'] == {'new1@x.com': 1, 'new2@x.com': 2}
+
+
+def test_damaged_snapshot_after_restore_recovers_the_restored_lab(open_store, tmp_path):
+    store = open_store()
+    store.allocate('a@x.com', 10)
+    name = store.archive_and_reset()
+    store.allocate('b@x.com', 10)
+    store.compact()
+    store.restore_archive(name)
+    store.allocate('c@x.com', 10)
+
+    damage(tmp_path / app.ASSIGNMENTS_FILE, b'')
+    store = open_store()
+    assert store.snapshot()['email_to_user'] == {'a@x.com': 1, 'c@x.com': 2}
+
+
+def test_assign_to_a_held_number_is_skipped(open_store):
+    store = open_store()
+    store.allocate('a@x.com', 10)
+    with store.locked():
+        store._apply({'op': 'assign', 'email': 'b@x.com', 'user': 1})
+        store._apply({'op': 'assign', 'email': 'a@x.com', 'user': 2})
+    assert store.snapshot()['email_to_user'] == {'a@x.com': 1}
+    assert store.allocate('b@x.com', 10) == (2, True, [])
+
+
+def test_config_follows_the_state_version_of_another_process(open_store):
+    ours, theirs = open_store(), open_store()
+    theirs.save_config({'max_users': 5, 'lab_name': 'old'})
+    version = ours.current_version()
+    assert ours.load_config(at_version=version)['lab_name'] == 'old'
+
+    theirs.save_config({'max_users': 5, 'lab_name': 'new'})
+    # Within CONFIG_CHECK_INTERVAL the plain cache still has the old config
+    assert ours.load_config()['lab_name'] == 'old'
+    version = ours.current_version()
+    assert ours.load_config(at_version=version)['lab_name'] == 'new'
+
+
+def test_allocate_reports_the_waitlisted_emails_it_promotes(open_store):
+    store = open_store()
+    store.allocate('a@x.com', 2)
+    store.allocate('b@x.com', 2)
+    store.join_waitlist('c@x.com')
+    store.join_waitlist('d@x.com')
+    store.release('a@x.com')
+    assert store.allocate('e@x.com', 2) == (None, False, [('c@x.com', 1)])
+    store.release('b@x.com')
+    assert store.allocate_many(['e@x.com'], 2) == ([(None, False)], [('d@x.com', 2)])
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+def test_reset_swaps_config_and_assignments_together(open_store, tmp_path, backend):
+    if backend == 'sqlite':
+        store = app.SqliteStorage(str(tmp_path / 'lab_portal.db'), str(tmp_path))
+    else:
+        store = open_store()
+    store.save_config({'max_users': 5, 'lab_name': 'Old Lab'})
+    store.allocate('a@x.com', 5)
+    version = store.current_version()
+
+    name = store.archive_and_reset()
+    assert store.load_config()['max_users'] == 0
+    assert store.snapshot()['email_to_user'] == {}
+    assert store.current_version() > version
+
+    restored = store.restore_archive(name)
+    assert restored == {'restored': name, 'archive': None}
+    assert store.load_config()['lab_name'] == 'Old Lab'
+    assert store.snapshot()['email_to_user'] == {'a@x.com': 1}
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+def test_failed_archive_write_keeps_the_lab(open_store, tmp_path, monkeypatch, backend):
+    def reopen():
+        if backend == 'sqlite':
+            return app.SqliteStorage(str(tmp_path / 'lab_portal.db'), str(tmp_path))
+        return open_store()
+    store = reopen()
+    store.save_config({'max_users': 5, 'lab_name': 'Old Lab'})
+    store.allocate('a@x.com', 5)
+
+    def full(config, assignments):
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(store, '_write_archive', full)
+    with pytest.raises(OSError):
+        store.archive_and_reset()
+    assert store.archives() == []
+    for store in (store, reopen()):
+        assert store.load_config()['lab_name'] == 'Old Lab'
+        assert store.snapshot()['email_to_user'] == {'a@x.com': 1}
+
+
+def test_idle_event_poll_does_not_take_the_store_lock(open_store, monkeypatch):
+    store = open_store()
+    store.allocate('a@x.com', 5)
+    text, version = app._event_start(store)
+    monkeypatch.setattr(store, 'locked', None)
+    assert app._event_poll(store, version) == ('', version)
+
+    monkeypatch.undo()
+    store.allocate('b@x.com', 5)
+    text, after = app._event_poll(store, version)
+    assert after == version + 1
+    assert 'event: assign' in text and 'b@x.com' in text
+
+
+def test_waitlist_positions_match_arrival_order(open_store):
+    store = open_store()
+    store.allocate('seat@x.com', 1)
+    rng = random.Random(18)
+    expected = []
+    for i in range(300):
+        roll = rng.random()
+        if roll < 0.5 or not expected:
+            email = f'w{i}@x.com'
+            expected.append(email)
+            assert store.join_waitlist(email) == len(expected)
+        elif roll < 0.75:
+            # The seat changes hands: the head of the waitlist gets it
+            holder = next(iter(store.snapshot()['email_to_user']))
+            _, promoted = store.release_many([holder], 1)
+            assert promoted == [(expected.pop(0), 1)]
+        else:
+            email = expected.pop(rng.randrange(len(expected)))
+            store.release_many([email], 1)
+        for position, email in enumerate(expected, 1):
+            assert store.waitlist_position(email) == position
+    assert store.waitlist() == expected
+
+
+def test_lookup_sees_a_seat_released_by_another_process(open_store):
+    ours, theirs = open_store(), open_store()
+    ours.allocate('x@x.com', 1)
+    theirs.join_waitlist('y@x.com')
+    assert ours.lookup('x@x.com') == 1
+
+    released, promoted = theirs.release_many(['x@x.com'], 1)
+    assert promoted == [('y@x.com', 1)]
+    assert ours.lookup('x@x.com') is None
+    assert ours.lookup('y@x.com') == 1
+    assert not ours.confirm('x@x.com')
+
+
+def test_failed_journal_write_leaves_the_batch_unapplied(open_store, monkeypatch):
+    store = open_store()
+    store.allocate('a@x.com', 2)
+    store.allocate('b@x.com', 2)
+    store.join_waitlist('c@x.com')
+    before = store.snapshot()
+
+    def full(*entries):
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(store, '_append', full)
+    with pytest.raises(OSError):
+        store.release_many(['a@x.com', 'a@x.com'], 2)
+    with pytest.raises(OSError):
+        store.allocate_many(['d@x.com', 'd@x.com'], 4)
+    assert store.snapshot() == before
+
+    monkeypatch.undo()
+    assert store.release_many(['a@x.com', 'a@x.com'], 2) == ([('a@x.com', 1)], [('c@x.com', 1)])
+    assert store.allocate_many(['d@x.com', 'd@x.com', 'e@x.com'], 4) == (
+        [(3, True), (3, False), (4, True)], [])
+
+
+def test_sqlite_reuses_released_numbers_lowest_first(open_sqlite):
+    store = open_sqlite()
+    assert [store.allocate(f'{c}@x.com', 3)[:2] for c in 'abc'] == [(1, True), (2, True), (3, True)]
+    assert store.allocate('d@x.com', 3) == (None, False, [])
+    assert store.allocate('a@x.com', 3) == (1, False, [])
+
+    assert store.release_many(['c@x.com', 'a@x.com', 'nobody@x.com'], 3) == (
+        [('c@x.com', 3), ('a@x.com', 1)], [])
+    assert store.lookup('a@x.com') is None
+    assert store.allocate_many(['e@x.com', 'f@x.com', 'g@x.com'], 3) == (
+        [(1, True), (3, True), (None, False)], [])
+    assert open_sqlite().snapshot()['email_to_user'] == {'b@x.com': 2, 'e@x.com': 1, 'f@x.com': 3}
+
+
+def test_sqlite_promotes_the_waitlist_in_arrival_order(open_sqlite):
+    store = open_sqlite()
+    store.allocate('a@x.com', 1)
+    assert store.join_waitlist('b@x.com') == 1
+    assert store.join_waitlist('c@x.com') == 2
+    assert store.join_waitlist('a@x.com') == 0
+
+    assert store.release_many(['a@x.com'], 1) == ([('a@x.com', 1)], [('b@x.com', 1)])
+    assert store.waitlist() == ['c@x.com']
+    assert store.waitlist_position('c@x.com') == 1
+    assert store.promote(2) == [('c@x.com', 2)]
+    assert store.waitlist_length() == 0
+
+
+def test_sqlite_changes_lists_the_events_after_a_version(open_sqlite):
+    store = open_sqlite()
+    start = store.current_version()
+    store.allocate('a@x.com', 5)
+    middle = store.current_version()
+    store.release_many(['a@x.com'], 5)
+
+    version, events = store.changes(start)
+    assert version == store.current_version()
+    assert [(e['op'], e['email'], e['user_number']) for e in events] == [
+        ('assign', 'a@x.com', 1), ('release', 'a@x.com', 1)]
+    assert store.changes(middle)[1] == events[1:]
+    assert store.changes(version) == (version, [])
+    assert store.changes(version + 1) == (version, None)
+
+
+def test_sqlite_imports_the_json_files_on_first_open(open_store, open_sqlite):
+    store = open_store()
+    store.save_config({'max_users': 3, 'lab_name': 'Old Lab'})
+    for c in 'abc':
+        store.allocate(f'{c}@x.com', 3)
+    store.join_waitlist('d@x.com')
+    store.join_waitlist('e@x.com')
+    store.release('a@x.com')
+    store.close()
+
+    imported = open_sqlite()
+    assert imported.load_config()['lab_name'] == 'Old Lab'
+    snapshot = imported.snapshot()
+    assert snapshot['email_to_user'] == {'b@x.com': 2, 'c@x.com': 3}
+    assert snapshot['free_users'] == [1]
+    assert snapshot['waitlist'] == ['d@x.com', 'e@x.com']
+    assert imported.promote(3) == [('d@x.com', 1)]
+
+    # Only a new database imports; later opens keep its own state
+    assert open_sqlite().waitlist() == ['e@x.com']